@@ -1,41 +1,64 @@
 import os
+import threading
 #from requests import session
 import streamlit as st
-from dotenv import load_dotenv
-import json
 import uuid
-import os
 from triage_module import show_triage
+from session_store import get_session_store
+from consultation_state import get_consultation_store, restore_consultation, sync_consultation
+from response_cache import get_response_cache
+from semantic_cache import SEMANTIC_CACHE_ENABLED, get_semantic_cache
+from transcript_log import get_transcript_log, mark_transcript_synced, sync_transcript
+from stream_renderer import StreamRenderer, format_metrics
+from context_manager import ContextManager, make_summarizer
+from provider_clients import get_registry, load_env_once
+from metrics import current_session_id, last_token_usage, span
+from request_scheduler import format_queue_status, get_scheduler, queue_listener
+from chat_engine import SYSTEM_PROMPT, ask_model, generate_reply, set_api_keys
 import html as html_lib
 
 
-TRIAGE_DIR = "triage_sessions"
-os.makedirs(TRIAGE_DIR, exist_ok=True)
-
-load_dotenv(".env")
+load_env_once(".env")
 
 st.set_page_config(page_icon="💊", page_title="Medical Assistant", layout="wide")
 
-# This MUST be at the top, right after imports and set_page_config
+# ---------------------------
+# API keys (Streamlit secrets or .env)
+# ---------------------------
+GEMINI_API_KEY = st.secrets.get("GEMINI_API_KEY", os.getenv("GEMINI_API_KEY"))
+GROQ_API_KEY = st.secrets.get("GROQ_API_KEY", os.getenv("GROQ_API_KEY"))
+
+# Model wrappers live in chat_engine so the triage page, tooling, benchmarks
+# and API can reuse them; set before the triage page is routed to.
+set_api_keys(gemini=GEMINI_API_KEY, groq=GROQ_API_KEY)
+
+# One id per consultation; it keys metrics/logs, the triage handoff and the
+# shared consultation store. It rides in the URL (?sid=), so a reconnect that
+# lands on another replica picks the consultation back up from the store.
+if "session_id" not in st.session_state:
+    sid = st.query_params.get("sid")
+    if sid and restore_consultation(get_consultation_store(), sid, st.session_state, SYSTEM_PROMPT):
+        st.session_state.session_id = sid
+        # The replica that held this consultation already logged its turns
+        mark_transcript_synced(st.session_state)
+    else:
+        st.session_state.session_id = str(uuid.uuid4())
+    st.query_params["sid"] = st.session_state.session_id
+current_session_id.set(st.session_state.session_id)
+
+
+def save_consultation():
+    """Write this turn's changes (only) to the shared consultation store and
+    append its messages to the transcript log."""
+    sync_consultation(get_consultation_store(), st.session_state.session_id, st.session_state)
+    sync_transcript(get_transcript_log(), st.session_state.session_id, st.session_state)
+
+
+# This MUST be at the top, right after set_page_config and the session restore
 if st.session_state.get("page") == "triage":
     show_triage()
     st.stop()
 
-# ---------------------------
-# System Prompt
-# ---------------------------
-SYSTEM_PROMPT = (
-    "You are a friendly, helpful medical chat assistant.\n"
-    "- Use simple language\n"
-    "- Never diagnose\n"
-    "- Give helpful suggestions\n"
-    "- Ask one gentle follow-up question\n"
-    "- Recommend doctor only if severe/persistent\n"
-    "- IMPORTANT: Do NOT use HTML tags, <div>, or CSS classes in your response.\n "
-    "- Return ONLY plain text or simple bullet points using dashes (-).\n"
-    "- End with: 'This is general information and not a substitute for professional medical advice.'"
-)
-
 # ---------------- Session State ----------------
 if "messages" not in st.session_state:
     st.session_state["messages"] = [{"role": "system", "content": SYSTEM_PROMPT}]
@@ -300,96 +323,6 @@ patient journey.
 </div>
 """, unsafe_allow_html=True)
 
-# ---------------------------
-# API keys (Streamlit secrets or .env)
-# ---------------------------
-GEMINI_API_KEY = st.secrets.get("GEMINI_API_KEY", os.getenv("GEMINI_API_KEY"))
-GROQ_API_KEY = st.secrets.get("GROQ_API_KEY", os.getenv("GROQ_API_KEY"))
-
-# ---------------------------
-# Gemini + Groq helpers
-# ---------------------------
-import google.generativeai as genai
-from groq import Groq, PermissionDeniedError, APIConnectionError
-
-gemini_model_obj = None
-groq_client = None
-
-
-def ensure_gemini():
-    global gemini_model_obj
-    if gemini_model_obj is not None:
-        return gemini_model_obj
-    if not GEMINI_API_KEY:
-        raise RuntimeError("GEMINI_API_KEY is not set.")
-    genai.configure(api_key=GEMINI_API_KEY)
-    gemini_model_obj = genai.GenerativeModel("gemini-2.5-flash")
-    return gemini_model_obj
-
-
-def ensure_groq():
-    global groq_client
-    if groq_client is not None:
-        return groq_client
-    if not GROQ_API_KEY:
-        raise RuntimeError("GROQ_API_KEY is not set.")
-    groq_client = Groq(api_key=GROQ_API_KEY)
-    return groq_client
-
-
-# ---------------------------
-# Model Wrappers
-# ---------------------------
-def chat_with_gemini_messages(messages: list) -> str:
-    model = ensure_gemini()
-    prompt_parts = []
-    for m in messages:
-        role = m.get("role", "user")
-        content = m.get("content", "")
-        if role == "system":
-            prompt_parts.append(f"System: {content}")
-        elif role == "user":
-            prompt_parts.append(f"User: {content}")
-        else:
-            prompt_parts.append(f"Assistant: {content}")
-    prompt = "\n\n".join(prompt_parts) + "\n\nAssistant:"
-    out = model.generate_content(prompt)
-    reply = getattr(out, "text", "") or "I couldn't generate a safe response."
-    return str(reply).strip()
-
-
-def chat_with_groq_messages(messages: list) -> str:
-    client = ensure_groq()
-    try:
-        resp = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[{"role": m["role"], "content": m["content"]} for m in messages],
-            temperature=0.25,
-        )
-        return str(resp.choices[0].message.content).strip()
-    except PermissionDeniedError:
-        return "Groq permission issue."
-    except APIConnectionError:
-        return "Groq network error."
-
-
-def generate_reply(model_choice: str, messages: list) -> str:
-    if model_choice.startswith("Gemini"):
-        return chat_with_gemini_messages(messages)
-    return chat_with_groq_messages(messages)
-
-
-# ---------------------------
-# Utility
-# ---------------------------
-def ask_model(model_choice: str, system_prompt: str, user_prompt: str):
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt},
-    ]
-    return generate_reply(model_choice, messages)
-
-
 # ---------------------------
 # Streamlit UI
 # ---------------------------
@@ -403,32 +336,42 @@ if st.session_state.show_intro:
     )
 
 # ---------------- PATIENT SELECTION (STEP 2) ----------------
-import pandas as pd
+from patient_registry import PATIENT_FILE, get_patient_registry
+
+patient_registry = get_patient_registry(PATIENT_FILE)
 
-PATIENT_FILE = "patients.csv"
 
-if os.path.exists(PATIENT_FILE):
-    patients_df = pd.read_csv(PATIENT_FILE)
+def _use_suggested_patient(name):
+    st.session_state.patient_name_input = name
+
+
+# Typing a name or picking a suggestion reruns only this fragment, not the
+# CSS, landing page and transcript around it.
+@st.fragment
+def patient_selection():
+    if not patient_registry.exists():
+        st.error("❌ patients.csv not found.")
+        return
 
     st.markdown("### 👤 Enter Patient for This Consultation")
 
-    patient_name_input = st.text_input("Enter Patient Name (as in records)")
+    patient_name_input = st.text_input(
+        "Enter Patient Name (as in records)", key="patient_name_input"
+    )
 
     if patient_name_input:
 
-        patient_match = patients_df[
-            patients_df["patient_name"].str.lower() == patient_name_input.strip().lower()
-        ]
+        with span("patient_lookup"):
+            patient = patient_registry.get_by_name(patient_name_input)
 
-        if not patient_match.empty:
-
-            selected_row = patient_match.iloc[0]
+        if patient is not None:
 
             # Store in session_state
-            st.session_state.selected_patient_id = int(selected_row["patient_id"])
-            st.session_state.selected_patient_name = selected_row["patient_name"]
-            st.session_state.selected_patient_age = int(selected_row["age"])
-            st.session_state.selected_patient_sex = selected_row["sex"]
+            st.session_state.selected_patient_id = patient["patient_id"]
+            st.session_state.selected_patient_name = patient["patient_name"]
+            st.session_state.selected_patient_age = patient["age"]
+            st.session_state.selected_patient_sex = patient["sex"]
+            save_consultation()
 
             st.success(
                 f"Patient Found: {st.session_state.selected_patient_name} | "
@@ -437,10 +380,23 @@ if os.path.exists(PATIENT_FILE):
             )
 
         else:
-            st.error("Patient not found in records. Please check spelling.")
-
-else:
-    st.error("❌ patients.csv not found.")
+            suggestions = patient_registry.suggest(patient_name_input)
+            if suggestions:
+                st.warning("Patient not found in records. Did you mean:")
+                # Name and record ID only: age and sex are not shown for
+                # records nobody has selected yet
+                for suggestion in suggestions:
+                    st.button(
+                        f"{suggestion['patient_name']} (ID {suggestion['patient_id']})",
+                        key=f"suggest_patient_{suggestion['patient_id']}",
+                        on_click=_use_suggested_patient,
+                        args=(suggestion["patient_name"],),
+                    )
+            else:
+                st.error("Patient not found in records. Please check spelling.")
+
+
+patient_selection()
 
 # model_choice = st.sidebar.selectbox("Choose model", ("Gemini", "Groq (Llama)"))
 
@@ -456,24 +412,23 @@ if "triage_answers" not in st.session_state:
 
 
 # ---------------- Render Chat ----------------
-import html as html_lib  # add at top of file
-
-# In your chat render loop:
-for m in st.session_state["messages"]:
-    if m["role"] == "system":
-        continue
-    if m["role"] == "user":
-        safe_content = html_lib.escape(m["content"]).replace('\n', '<br>')
-        st.markdown(
-            f'<div class="user-message-box">{safe_content}</div>',
-            unsafe_allow_html=True
-        )
-    else:
-        safe_content = html_lib.escape(m["content"]).replace('\n', '<br>')
-        st.markdown(
-            f'<div class="ai-response-box">{safe_content}</div>',
-            unsafe_allow_html=True
-        )
+def _message_html(m):
+    css_class = "user-message-box" if m["role"] == "user" else "ai-response-box"
+    safe_content = html_lib.escape(m["content"]).replace('\n', '<br>')
+    return f'<div class="{css_class}">{safe_content}</div>'
+
+
+def render_transcript():
+    """Render past turns as one element, escaping each message only once."""
+    rendered = st.session_state.setdefault("transcript_html", [])
+    visible = [m for m in st.session_state["messages"] if m["role"] != "system"]
+    if len(rendered) > len(visible):
+        # History was reset or replaced; start over
+        rendered.clear()
+    rendered.extend(_message_html(m) for m in visible[len(rendered):])
+    if rendered:
+        st.markdown("".join(rendered), unsafe_allow_html=True)
+
 
 # ---------------- TRIAGE READINESS INDICATOR ----------------
 TRIAGE_WORD_THRESHOLD = 500
@@ -496,124 +451,226 @@ progress = min(current_words / TRIAGE_WORD_THRESHOLD, 1.0)
        # "✅ Enough information collected. You can now generate a detailed clinical triage report."
     # )
 
-# ---------------- Chat Input ----------------
-col1, col2 = st.columns([3,1])
 
-with col1:
-    if st.session_state.show_intro:
-        st.markdown("### Start Your Consultation")
-
-with col2:
-    model_choice = st.selectbox(
-        "Choose Model",
-        ("Gemini", "Groq (Llama)"),
-        index=0
+# ---------------- Sidebar stats ----------------
+# Refreshed on a timer because the chat fragment below cannot write to the
+# sidebar, and a chat turn should not rerun the whole page just for these.
+@st.fragment(run_every="10s")
+def sidebar_stats():
+    cache_stats = get_response_cache().stats()
+    st.caption(
+        f"Response cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+        f"({cache_stats['entries']} entries)"
+    )
+    if SEMANTIC_CACHE_ENABLED:
+        semantic_stats = get_semantic_cache().stats()
+        st.caption(
+            f"Semantic cache: {semantic_stats['hit_rate']:.0%} of first questions answered from "
+            f"cache ({semantic_stats['entries']} entries, ~{semantic_stats['seconds_saved']:.0f}s saved)"
+        )
+    client_stats = get_registry().stats()
+    st.caption(
+        f"Provider connections: {client_stats['connections_reused']} reused / "
+        f"{client_stats['connections_opened']} opened"
     )
+    if "last_stream_metrics" in st.session_state:
+        st.caption(f"Last reply: {format_metrics(st.session_state.last_stream_metrics)}")
+    if "last_context_stats" in st.session_state:
+        ctx = st.session_state.last_context_stats
+        st.caption(f"Last prompt: ~{ctx['prompt_tokens']} / {ctx['budget']} tokens")
+    usage = last_token_usage(st.session_state.session_id)
+    if usage is not None:
+        st.caption(
+            f"Last call tokens ({usage['provider']}): prompt {usage['prompt']} "
+            f"(cached {usage['cached']}) · reply {usage['completion']}"
+        )
 
-user_input = st.chat_input("Describe your symptoms...")
+    scheduler_stats = get_scheduler().stats()
+    if scheduler_stats["queued"]:
+        st.caption(
+            f"Rate limiting: {scheduler_stats['waiting']} waiting · "
+            f"{scheduler_stats['queued']} queued · {scheduler_stats['rate_limited']} retried"
+        )
 
-if user_input:
-    # 🔹 STEP 2: count user words
-    word_count = len(user_input.split())
-    st.session_state.user_word_count += word_count
 
-    # store user message (NO change in logic)
-    st.session_state["messages"].append(
-        {"role": "user", "content": user_input}
-    )
-    st.session_state.show_intro = False
-    st.session_state.show_triage = False
-    st.session_state.triage_questions = []
-    st.session_state.triage_answers = []
-    st.session_state.triage_id = str(len(st.session_state["messages"]))
+with st.sidebar:
+    sidebar_stats()
 
-    # assistant response
-    with st.spinner("Thinking..."):
-        reply = generate_reply(model_choice, st.session_state["messages"])
 
-    st.session_state["messages"].append({"role": "assistant", "content": reply})
-    st.session_state.last_assistant_reply = reply
+def _queue_listener(placeholder):
+    """Show the rate-limit queue position in the reply card while waiting.
 
+    Auto routing waits on worker threads, which need this run's script
+    context to update the page.
+    """
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
-    # trigger triage
-    #st.session_state.show_triage = True
-    st.rerun()
+    ctx = get_script_run_ctx()
 
+    def listener(status):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        text = format_queue_status(status) if status else "▌"
+        placeholder.markdown(
+            f'<div class="ai-response-box">{html_lib.escape(text)}</div>', unsafe_allow_html=True
+        )
 
-# ---------------- TRIAGE INTRO + BUTTON ----------------
-TRIAGE_WORD_THRESHOLD = 500
+    return listener
 
-if (
-    "last_assistant_reply" in st.session_state
-    and st.session_state.last_assistant_reply
-    and st.session_state.user_word_count >= TRIAGE_WORD_THRESHOLD
-):
-
-   
-    # 🔘 Button (ONLY shown when ready)
-    if st.button("🩺 Assess My Triage Summary"):
-
-        if "selected_patient_id" not in st.session_state:
-            st.error("Please enter a valid patient name before proceeding.")
-            st.stop()
-
-        # 🔹 Create session_id ONCE
-        if "session_id" not in st.session_state:
-            st.session_state.session_id = str(uuid.uuid4())
-
-        triage_payload = {
-            "messages": st.session_state["messages"],
-            "last_assistant_reply": st.session_state["last_assistant_reply"],
-            "model_choice": model_choice,
-            "user_word_count": st.session_state["user_word_count"],
-            "patient_id": int(st.session_state.selected_patient_id),
-            "patient_name": str(st.session_state.selected_patient_name),
-            "patient_age": int(st.session_state.selected_patient_age),
-            "patient_sex": str(st.session_state.selected_patient_sex)
-        }
-
-        file_path = os.path.join(TRIAGE_DIR, f"{st.session_state.session_id}.json")
-        with open(file_path, "w") as f:
-            json.dump(triage_payload, f, indent=2)
-
-        st.session_state.page = "triage"
-        st.rerun()  # ← ONLY this, nothing after it
-        
 
-        #st.session_state.page = "triage"
-        #st.rerun()
+# ---------------- Chat ----------------
+# A chat turn reruns only this fragment: the transcript, input and triage
+# button. The CSS, landing markup and patient lookup above are sent once per
+# full run.
+@st.fragment
+def chat_panel():
+    render_transcript()
+
+    col1, col2 = st.columns([3,1])
+
+    with col1:
+        if st.session_state.show_intro:
+            st.markdown("### Start Your Consultation")
+
+    with col2:
+        model_choice = st.selectbox(
+            "Choose Model",
+            ("Gemini", "Groq (Llama)", "Auto (fastest)"),
+            index=0
+        )
+
+    user_input = st.chat_input("Describe your symptoms...")
+
+    if user_input:
+        # 🔹 STEP 2: count user words
+        word_count = len(user_input.split())
+        st.session_state.user_word_count += word_count
+
+        # store user message (NO change in logic)
+        st.session_state["messages"].append(
+            {"role": "user", "content": user_input}
+        )
+        first_turn = st.session_state.show_intro
+        st.session_state.show_intro = False
+        st.session_state.show_triage = False
+        st.session_state.triage_questions = []
+        st.session_state.triage_answers = []
+        st.session_state.triage_id = str(len(st.session_state["messages"]))
+
+        safe_content = html_lib.escape(user_input).replace('\n', '<br>')
+        st.markdown(
+            f'<div class="user-message-box">{safe_content}</div>',
+            unsafe_allow_html=True
+        )
+
+        # assistant response, streamed into the card as tokens arrive
+        reply_placeholder = st.empty()
+        reply_placeholder.markdown(
+            '<div class="ai-response-box">▌</div>', unsafe_allow_html=True
+        )
+        # Older turns are folded into a rolling summary so the prompt stays bounded
+        context_manager = ContextManager(
+            make_summarizer(lambda sys_p, user_p: ask_model(model_choice, sys_p, user_p))
+        )
+        # May block on a summarizer call; timed on its own, not as reply latency
+        with span("context_prepare"):
+            outgoing = context_manager.prepare(st.session_state["messages"], st.session_state)
+        st.session_state.last_context_stats = context_manager.stats(outgoing)
+        # Created after prepare() so TTFT and total time cover only the reply
+        renderer = StreamRenderer(
+            reply_placeholder,
+            render=lambda text: reply_placeholder.markdown(
+                f'<div class="ai-response-box">{html_lib.escape(text).replace(chr(10), "<br>")}</div>',
+                unsafe_allow_html=True
+            ),
+        )
+        queue_listener.set(_queue_listener(reply_placeholder))
+        reply = renderer.consume(generate_reply(model_choice, outgoing))
+        reply = reply.strip() or "I couldn't generate a safe response."
+        st.session_state.last_stream_metrics = renderer.metrics()
 
-        # ---------------- LOAD TRIAGE PAGE INTERNALLY ----------------
-        #if st.session_state.page == "triage":
-            #from triage_module import show_triage
-            #show_triage()
+        st.session_state["messages"].append({"role": "assistant", "content": reply})
+        st.session_state.last_assistant_reply = reply
+        save_consultation()
 
-        #st.success("✅ Triage data prepared successfully")
 
-        # 🔗 Build safe URL (local + cloud)
-        #base_url = st.get_option("browser.serverAddress") or "localhost"
-        #port = st.get_option("server.port")
+        # trigger triage
+        #st.session_state.show_triage = True
+        # The intro outside this fragment only needs hiding after the first turn
+        st.rerun(scope="app" if first_turn else "fragment")
 
-        #triage_url = (
-            #f"http://{base_url}:{port}/Triage"
-            #f"?session_id={st.session_state.session_id}"
+
+    # ---------------- TRIAGE INTRO + BUTTON ----------------
+    if (
+        "last_assistant_reply" in st.session_state
+        and st.session_state.last_assistant_reply
+        and st.session_state.user_word_count >= TRIAGE_WORD_THRESHOLD
+    ):
+
+
+        # 🔘 Button (ONLY shown when ready)
+        if st.button("🩺 Assess My Triage Summary"):
+
+            if "selected_patient_id" not in st.session_state:
+                st.error("Please enter a valid patient name before proceeding.")
+                st.stop()
+
+            # 🔹 Create session_id ONCE
+            if "session_id" not in st.session_state:
+                st.session_state.session_id = str(uuid.uuid4())
+
+            # The conversation itself is in the transcript log under the same session id
+            triage_payload = {
+                "last_assistant_reply": st.session_state["last_assistant_reply"],
+                "model_choice": model_choice,
+                "user_word_count": st.session_state["user_word_count"],
+                "patient_id": int(st.session_state.selected_patient_id),
+                "patient_name": str(st.session_state.selected_patient_name),
+                "patient_age": int(st.session_state.selected_patient_age),
+                "patient_sex": str(st.session_state.selected_patient_sex)
+            }
+
+            get_session_store().save(st.session_state.session_id, triage_payload)
+
+            st.session_state.page = "triage"
+            save_consultation()
+            st.rerun()  # ← ONLY this, nothing after it
         
 
-        #st.markdown(
-          #f"""
-          #<a href="/Triage?session_id={st.session_state.session_id}"
-             #target="_blank"
-             #style="
-              # display:inline-block;
-               #margin-top:16px;
-               #font-size:18px;
-               #font-weight:700;
-               #color:#032B63;
-          # ">
-               #👉 Open Standalone Triage Report
-            #</a>
-            #""",
-            #unsafe_allow_html=True
-        #)
+            #st.session_state.page = "triage"
+            #st.rerun()
+
+            # ---------------- LOAD TRIAGE PAGE INTERNALLY ----------------
+            #if st.session_state.page == "triage":
+                #from triage_module import show_triage
+                #show_triage()
 
+            #st.success("✅ Triage data prepared successfully")
+
+            # 🔗 Build safe URL (local + cloud)
+            #base_url = st.get_option("browser.serverAddress") or "localhost"
+            #port = st.get_option("server.port")
+
+            #triage_url = (
+                #f"http://{base_url}:{port}/Triage"
+                #f"?session_id={st.session_state.session_id}"
+        
 
+            #st.markdown(
+              #f"""
+              #<a href="/Triage?session_id={st.session_state.session_id}"
+                 #target="_blank"
+                 #style="
+                  # display:inline-block;
+                   #margin-top:16px;
+                   #font-size:18px;
+                   #font-weight:700;
+                   #color:#032B63;
+              # ">
+                   #👉 Open Standalone Triage Report
+                #</a>
+                #""",
+                #unsafe_allow_html=True
+            #)
+
+
+chat_panel()
@@ -1,6 +1,6 @@
 import streamlit as st
 from groq import Groq
-import time
+from stream_renderer import StreamRenderer, format_metrics
 
 # Page config
 st.set_page_config(
@@ -69,6 +69,7 @@ if prompt := st.chat_input("Describe your symptoms... (e.g., 'My chest is hurtin
     # Get bot response
     with st.chat_message("assistant"):
         message_placeholder = st.empty()
+        renderer = StreamRenderer(message_placeholder)
         full_response = ""
         
         try:
@@ -81,14 +82,13 @@ if prompt := st.chat_input("Describe your symptoms... (e.g., 'My chest is hurtin
                 stream=True
             )
             
-            # Stream the response
-            for chunk in response:
-                if chunk.choices[0].delta.content:
-                    full_response += chunk.choices[0].delta.content
-                    message_placeholder.markdown(full_response + "▌")
-                    time.sleep(0.01)
-            
-            message_placeholder.markdown(full_response)
+            # Stream the response (throttled re-renders, no per-chunk sleep)
+            full_response = renderer.consume(
+                chunk.choices[0].delta.content
+                for chunk in response
+                if chunk.choices and chunk.choices[0].delta.content
+            )
+            st.session_state.last_stream_metrics = renderer.metrics()
             
         except Exception as e:
             full_response = f"❌ Error: {str(e)}\n\nPlease check your API key in `.streamlit/secrets.toml`"
@@ -125,5 +125,8 @@ with st.sidebar:
         ]
         st.rerun()
     
+    if "last_stream_metrics" in st.session_state:
+        st.caption(f"Last reply: {format_metrics(st.session_state.last_stream_metrics)}")
+
     st.divider()
     st.caption("Powered by Groq + Llama 3.3")
\ No newline at end of file
@@ -0,0 +1,370 @@
+"""Headless asyncio HTTP API for chat and triage.
+
+Serves the same prompts, caches, rate limits and report schema as the
+Streamlit pages, but on one event loop with the providers' async clients,
+so a single process can hold hundreds of consultations at once without a
+thread and a websocket per session. Intended for programmatic access, e.g.
+from the EHR integration.
+
+    python api_server.py --port 8080
+
+Endpoints (JSON in, JSON out):
+
+    POST /v1/chat            {"messages": [...] | "session_id", "message"?, "model_choice"?,
+                              "context"?, "stream"?}
+    POST /v1/triage/summary  {"last_assistant_reply" | "session_id", "model_choice"?}
+    POST /v1/triage/report   {"last_assistant_reply", "patient_id" | "patient_name",
+                              "patient_age", "patient_sex" | "session_id", "model_choice"?}
+    POST /v1/triage/pdf      like /v1/triage/report, or with a ready "report"; returns the PDF
+    GET  /healthz
+    GET  /metrics
+
+``messages`` are the user/assistant turns without the system prompt.
+``context`` is the rolling-summary state returned by the previous chat
+call; sending it back keeps long conversations from being re-summarized.
+With ``"stream": true`` the reply is sent as NDJSON lines of
+{"delta": text}, then one {"done": true, ...} line. ``session_id`` loads a
+consultation saved by the chat page; fields in the request override it. A
+chat resumed by session_id without "messages" continues the stored history
+with the new user ``message``, and the reply is saved back to it.
+
+Every /v1/ request must carry "Authorization: Bearer <API_TOKEN>". The
+server refuses to start without API_TOKEN unless run with --insecure, and
+listens on 127.0.0.1 unless --host (or API_HOST) says otherwise.
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from aiohttp import web
+
+from chat_engine import SYSTEM_PROMPT, ask_model, generate_reply_async
+from consultation_state import get_consultation_store, restore_consultation, sync_consultation
+from context_manager import ContextManager, make_summarizer
+from metrics import current_session_id, get_metrics
+from pdf_cache import get_pdf_cache, pdf_cache_key
+from provider_clients import load_env_once
+from session_store import get_session_store
+from triage_module import (
+    PDF_TEMPLATE_VERSION,
+    build_triage_pdf,
+    generate_detailed_report_async,
+    generate_summary_async,
+    patient_info_for,
+    report_filename,
+)
+from transcript_log import get_transcript_log, mark_transcript_synced, sync_transcript
+from triage_schema import report_sections, validate_report
+
+logger = logging.getLogger(__name__)
+
+API_PDF_WORKERS = int(os.getenv("API_PDF_WORKERS", "2"))
+API_MAX_BODY_BYTES = int(os.getenv("API_MAX_BODY_BYTES", str(1024 * 1024)))
+DEFAULT_MODEL = "Gemini"
+MODEL_CHOICES = ("Gemini", "Groq (Llama)", "Auto (fastest)")
+
+_PDF_POOL = web.AppKey("pdf_pool", ProcessPoolExecutor)
+_API_TOKEN = web.AppKey("api_token", str)
+
+
+def _bad_request(message: str):
+    return web.HTTPBadRequest(
+        text=json.dumps({"error": message}), content_type="application/json"
+    )
+
+
+@web.middleware
+async def auth_middleware(request, handler):
+    token = request.app[_API_TOKEN]
+    if token and request.path.startswith("/v1/"):
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            raise web.HTTPUnauthorized(
+                text=json.dumps({"error": "unauthorized"}), content_type="application/json"
+            )
+    return await handler(request)
+
+
+@web.middleware
+async def error_middleware(request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPException:
+        raise
+    except Exception:
+        logger.exception("%s %s failed", request.method, request.path)
+        return web.json_response({"error": "internal error"}, status=500)
+
+
+async def _read_body(request, consultation=None) -> dict:
+    """Request JSON merged over the triage handoff stored for its session_id.
+
+    When ``consultation`` (a dict) is given, the chat page's stored
+    consultation for session_id is restored into it, and its history is used
+    unless the request sends "messages". Also binds the session id for
+    metrics and rate-limit fairness.
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        raise _bad_request("request body must be JSON")
+    if not isinstance(body, dict):
+        raise _bad_request("request body must be a JSON object")
+    session_id = body.get("session_id") or request.headers.get("X-Session-Id")
+    payload = {}
+    if body.get("session_id"):
+        # The stores do blocking file/socket I/O; keep it off the event loop
+        payload = await asyncio.to_thread(_load_session, body["session_id"], consultation)
+        if not payload:
+            raise web.HTTPNotFound(
+                text=json.dumps({"error": "unknown session_id"}), content_type="application/json"
+            )
+    payload.update(body)
+    payload["session_id"] = session_id or str(uuid.uuid4())
+    current_session_id.set(payload["session_id"])
+    model_choice = payload.get("model_choice") or DEFAULT_MODEL
+    if model_choice not in MODEL_CHOICES:
+        raise _bad_request(f"model_choice must be one of {', '.join(MODEL_CHOICES)}")
+    payload["model_choice"] = model_choice
+    return payload
+
+
+def _load_session(session_id: str, consultation=None) -> dict:
+    """The stored triage handoff for ``session_id``, with the restored
+    consultation's history under "messages" if there is one."""
+    payload = dict(get_session_store().load(session_id) or {})
+    restored = consultation is not None and restore_consultation(
+        get_consultation_store(), session_id, consultation, SYSTEM_PROMPT
+    )
+    if restored:
+        # The consultation's turns are already in its transcript log
+        mark_transcript_synced(consultation)
+        payload["messages"] = consultation["messages"]
+    return payload
+
+
+def _require(payload: dict, field: str):
+    value = payload.get(field)
+    if not value:
+        raise _bad_request(f"{field} is required")
+    return value
+
+
+# ---------------------------
+# Chat
+# ---------------------------
+def _chat_messages(payload: dict) -> list:
+    messages = payload.get("messages")
+    if not isinstance(messages, list):
+        raise _bad_request("messages must be a non-empty list")
+    # Stored histories start with the system prompt; the current one is added below
+    messages = [m for m in messages if not (isinstance(m, dict) and m.get("role") == "system")]
+    if payload.get("message"):
+        messages.append({"role": "user", "content": payload["message"]})
+    if not messages:
+        raise _bad_request("messages must be a non-empty list")
+    turns = []
+    for m in messages:
+        if not isinstance(m, dict) or m.get("role") not in ("user", "assistant"):
+            raise _bad_request('each message needs a "role" of "user" or "assistant"')
+        turns.append({"role": m["role"], "content": str(m.get("content", ""))})
+    if turns[-1]["role"] != "user":
+        raise _bad_request("the last message must be from the user")
+    return [{"role": "system", "content": SYSTEM_PROMPT}] + turns
+
+
+def _chat_context(context) -> dict:
+    """The rolling-summary state a client sent back, type-checked."""
+    if context is None:
+        return {}
+    if not isinstance(context, dict):
+        raise _bad_request("context must be an object")
+    summary = context.get("context_summary", "")
+    upto = context.get("context_summarized_upto", 0)
+    if not isinstance(summary, str):
+        raise _bad_request("context.context_summary must be a string")
+    if isinstance(upto, bool) or not isinstance(upto, int) or upto < 0:
+        raise _bad_request("context.context_summarized_upto must be a non-negative integer")
+    return {"context_summary": summary, "context_summarized_upto": upto}
+
+
+def _save_turn(session_id, consultation, messages, reply, context):
+    """Append a resumed consultation's new turns to its stores, as the chat page does."""
+    consultation["messages"] = messages + [{"role": "assistant", "content": reply}]
+    consultation["last_assistant_reply"] = reply
+    consultation.update(context)
+    sync_consultation(get_consultation_store(), session_id, consultation)
+    sync_transcript(get_transcript_log(), session_id, consultation)
+
+
+async def chat(request):
+    consultation = {}
+    payload = await _read_body(request, consultation)
+    model_choice = payload["model_choice"]
+    messages = _chat_messages(payload)
+    # A resumed consultation continues from its stored rolling summary
+    resumed = bool(consultation) and payload["messages"] is consultation["messages"]
+    if resumed and "context" not in payload:
+        payload["context"] = {
+            name: consultation[name]
+            for name in ("context_summary", "context_summarized_upto") if name in consultation
+        }
+    context = _chat_context(payload.get("context"))
+    context_manager = ContextManager(
+        make_summarizer(lambda sys_p, user_p: ask_model(model_choice, sys_p, user_p))
+    )
+    # Summarizing older turns is rare and uses the sync client; keep it off the loop
+    outgoing = await asyncio.to_thread(context_manager.prepare, messages, context)
+    meta = {"session_id": payload["session_id"], "context": context}
+
+    if not payload.get("stream"):
+        parts = [chunk async for chunk in generate_reply_async(model_choice, outgoing)]
+        reply = "".join(parts).strip() or "I couldn't generate a safe response."
+        if resumed:
+            await asyncio.to_thread(
+                _save_turn, payload["session_id"], consultation, messages, reply, context
+            )
+        return web.json_response({"reply": reply, **meta})
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    parts = []
+    async for chunk in generate_reply_async(model_choice, outgoing):
+        parts.append(chunk)
+        await response.write(json.dumps({"delta": chunk}).encode("utf-8") + b"\n")
+    reply = "".join(parts).strip() or "I couldn't generate a safe response."
+    if resumed:
+        await asyncio.to_thread(
+            _save_turn, payload["session_id"], consultation, messages, reply, context
+        )
+    await response.write(json.dumps({"done": True, "reply": reply, **meta}).encode("utf-8") + b"\n")
+    await response.write_eof()
+    return response
+
+
+# ---------------------------
+# Triage
+# ---------------------------
+async def triage_summary(request):
+    payload = await _read_body(request)
+    last_reply = _require(payload, "last_assistant_reply")
+    summary = await generate_summary_async(payload["model_choice"], last_reply)
+    return web.json_response({"session_id": payload["session_id"], "summary": summary})
+
+
+async def _report_for(payload: dict):
+    """(patient info, report, missing fields) for a request payload."""
+    if not payload.get("patient_id") and not payload.get("patient_name"):
+        raise _bad_request("patient_id or patient_name is required")
+    info = patient_info_for(payload["session_id"], payload)
+    if isinstance(payload.get("report"), dict):
+        report, missing = validate_report(payload["report"])
+        return info, report, missing
+    last_reply = _require(payload, "last_assistant_reply")
+    report, missing = await generate_detailed_report_async(
+        payload["model_choice"], info["name"], info["age"], info["sex"], last_reply
+    )
+    return info, report, missing
+
+
+async def triage_report(request):
+    payload = await _read_body(request)
+    info, report, missing = await _report_for(payload)
+    return web.json_response({
+        "session_id": payload["session_id"],
+        "patient": info,
+        "report": report,
+        "sections": report_sections(report),
+        "missing": missing,
+    })
+
+
+async def triage_pdf(request):
+    payload = await _read_body(request)
+    info, report, _ = await _report_for(payload)
+    sections = report_sections(report)
+    if not sections:
+        raise _bad_request("no usable report fields")
+    key = pdf_cache_key(sections, info, PDF_TEMPLATE_VERSION)
+    pdf_bytes = get_pdf_cache().get(key)
+    if pdf_bytes is None:
+        # ReportLab layout is CPU-bound; build in a worker process
+        pdf_bytes = await asyncio.get_running_loop().run_in_executor(
+            request.app[_PDF_POOL], build_triage_pdf, sections, info
+        )
+        get_pdf_cache().put(key, pdf_bytes)
+    return web.Response(
+        body=pdf_bytes,
+        content_type="application/pdf",
+        headers={"Content-Disposition": f'attachment; filename="{report_filename(info)}"'},
+    )
+
+
+# ---------------------------
+# Service
+# ---------------------------
+async def healthz(request):
+    return web.json_response({"status": "ok"})
+
+
+async def metrics(request):
+    return web.Response(
+        text=get_metrics().render_prometheus(), content_type="text/plain", charset="utf-8"
+    )
+
+
+async def _start_pool(app):
+    # spawn, not fork: forking a process with a running event loop and threads is unsafe
+    app[_PDF_POOL] = ProcessPoolExecutor(
+        max_workers=API_PDF_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+async def _stop_pool(app):
+    app[_PDF_POOL].shutdown(wait=False, cancel_futures=True)
+
+
+def create_app(insecure=False) -> web.Application:
+    """The API application; without API_TOKEN it only starts if ``insecure``."""
+    load_env_once(".env")
+    token = os.getenv("API_TOKEN", "")
+    if not token and not insecure:
+        raise RuntimeError("API_TOKEN is not set; refusing to serve patient data unauthenticated")
+    app = web.Application(
+        middlewares=[error_middleware, auth_middleware], client_max_size=API_MAX_BODY_BYTES
+    )
+    app[_API_TOKEN] = token
+    app.router.add_post("/v1/chat", chat)
+    app.router.add_post("/v1/triage/summary", triage_summary)
+    app.router.add_post("/v1/triage/report", triage_report)
+    app.router.add_post("/v1/triage/pdf", triage_pdf)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/metrics", metrics)
+    app.on_startup.append(_start_pool)
+    app.on_cleanup.append(_stop_pool)
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Async HTTP API for chat and triage")
+    parser.add_argument("--host", default=os.getenv("API_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("API_PORT", "8080")))
+    parser.add_argument(
+        "--insecure", action="store_true",
+        help="serve without API_TOKEN (anyone who can reach the port can read patient data)",
+    )
+    args = parser.parse_args(argv)
+    load_env_once(".env")
+    if not os.getenv("API_TOKEN") and not args.insecure:
+        parser.error("API_TOKEN is not set; set it, or pass --insecure for local development")
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(insecure=args.insecure), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
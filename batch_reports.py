@@ -0,0 +1,206 @@
+"""Regenerate or backfill triage PDF reports for stored sessions.
+
+LLM calls fan out on a thread pool with a bounded number of requests in
+flight (the JSON report plus any follow-ups for missing fields); the
+ReportLab build runs on a process pool. Finished session ids are appended
+to a progress file in the output directory, so an interrupted run picks up
+where it stopped.
+
+    python batch_reports.py --out reports/
+    python batch_reports.py --json-dir triage_sessions --out reports/ --concurrency 16
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+from provider_clients import load_env_once
+from session_store import (
+    SESSION_DB_PATH,
+    JSONDirSessionStore,
+    SQLiteSessionStore,
+)
+from triage_module import (
+    build_triage_pdf,
+    generate_detailed_report,
+    patient_info_for,
+    report_filename,
+)
+from triage_schema import report_sections
+
+PROGRESS_FILE = ".batch_progress"
+
+
+def generate_detailed(session_id: str, payload: dict, model_override=None):
+    """I/O-bound step, runs on the thread pool."""
+    info = patient_info_for(session_id, payload)
+    model_choice = model_override or payload.get("model_choice", "Gemini")
+    started = time.perf_counter()
+    report, _ = generate_detailed_report(
+        model_choice, info["name"], info["age"], info["sex"],
+        payload.get("last_assistant_reply", ""),
+    )
+    return session_id, info, report, time.perf_counter() - started
+
+
+def render_report(session_id: str, info: dict, report: dict):
+    """CPU-bound step, runs on the process pool."""
+    started = time.perf_counter()
+    sections = report_sections(report)
+    if not sections:
+        raise ValueError("no usable report fields in model output")
+    pdf_bytes = build_triage_pdf(sections, info)
+    return session_id, info, pdf_bytes, len(sections), time.perf_counter() - started
+
+
+def load_progress(out_dir: str) -> set:
+    path = os.path.join(out_dir, PROGRESS_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def run(store, out_dir, concurrency=8, workers=None, resume=True, model_override=None,
+        since=None, limit=None):
+    os.makedirs(out_dir, exist_ok=True)
+    done = load_progress(out_dir) if resume else set()
+    progress = open(os.path.join(out_dir, PROGRESS_FILE), "a" if resume else "w")
+
+    counts = {"ok": 0, "failed": 0, "skipped": 0}
+    llm_seconds = render_seconds = 0.0
+    llm_ok = 0
+    pdf_bytes_total = 0
+    started = time.perf_counter()
+
+    def log(msg):
+        elapsed = time.perf_counter() - started
+        finished = counts["ok"] + counts["failed"]
+        rate = finished / elapsed if elapsed else 0.0
+        print(f"[{finished} done, {counts['failed']} failed, {rate:.2f}/s] {msg}", flush=True)
+
+    sessions = store.iter_sessions(since=since)
+    llm_pending = set()
+    render_pending = set()
+    submitted = 0
+    exhausted = False
+
+    with ThreadPoolExecutor(max_workers=concurrency) as io_pool, \
+            ProcessPoolExecutor(
+                max_workers=workers,
+                # spawn, not fork: the LLM thread pool is already running
+                mp_context=multiprocessing.get_context("spawn"),
+            ) as cpu_pool:
+        try:
+            while True:
+                # Keep at most `concurrency` LLM calls in flight so a huge
+                # store is streamed rather than loaded all at once.
+                while not exhausted and len(llm_pending) < concurrency:
+                    if limit is not None and submitted >= limit:
+                        exhausted = True
+                        break
+                    try:
+                        session_id, payload = next(sessions)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if session_id in done:
+                        counts["skipped"] += 1
+                        continue
+                    llm_pending.add(io_pool.submit(generate_detailed, session_id, payload, model_override))
+                    submitted += 1
+
+                if not llm_pending and not render_pending:
+                    break
+
+                finished, _ = wait(llm_pending | render_pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    if future in llm_pending:
+                        llm_pending.discard(future)
+                        try:
+                            session_id, info, report, seconds = future.result()
+                        except Exception as e:
+                            counts["failed"] += 1
+                            log(f"LLM error: {e}")
+                            continue
+                        llm_seconds += seconds
+                        llm_ok += 1
+                        render_pending.add(cpu_pool.submit(render_report, session_id, info, report))
+                    else:
+                        render_pending.discard(future)
+                        try:
+                            session_id, info, pdf_bytes, n_sections, seconds = future.result()
+                        except Exception as e:
+                            counts["failed"] += 1
+                            log(f"render error: {e}")
+                            continue
+                        render_seconds += seconds
+                        with open(os.path.join(out_dir, report_filename(info)), "wb") as f:
+                            f.write(pdf_bytes)
+                        progress.write(session_id + "\n")
+                        progress.flush()
+                        pdf_bytes_total += len(pdf_bytes)
+                        counts["ok"] += 1
+                        log(f"{session_id}: {n_sections} sections, {len(pdf_bytes)} bytes")
+        except KeyboardInterrupt:
+            print("Interrupted; rerun with the same --out to resume.", file=sys.stderr)
+            for future in llm_pending | render_pending:
+                future.cancel()
+        finally:
+            progress.close()
+
+    elapsed = time.perf_counter() - started
+    print("\n---- batch summary ----")
+    print(f"reports written : {counts['ok']}")
+    print(f"failed          : {counts['failed']}")
+    print(f"skipped (done)  : {counts['skipped']}")
+    print(f"wall time       : {elapsed:.1f}s")
+    if elapsed:
+        print(f"throughput      : {counts['ok'] / elapsed:.2f} reports/s, "
+              f"{pdf_bytes_total / elapsed / 1024:.1f} KiB/s of PDF")
+    # Only successful calls are timed, so average over those
+    if llm_ok:
+        print(f"mean LLM time   : {llm_seconds / llm_ok:.2f}s")
+    if counts["ok"]:
+        print(f"mean render time: {render_seconds / counts['ok']:.3f}s")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch-generate triage PDF reports")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--db", default=SESSION_DB_PATH, help="SQLite session store")
+    source.add_argument("--json-dir", help="legacy directory of <session_id>.json files")
+    parser.add_argument("--out", default="reports", help="output directory for PDFs")
+    parser.add_argument("--concurrency", type=int, default=8, help="LLM calls in flight")
+    parser.add_argument("--workers", type=int, default=None, help="PDF render processes")
+    parser.add_argument("--model", choices=("Gemini", "Groq (Llama)"),
+                        help="override the model stored with each session")
+    parser.add_argument("--since", type=float, help="only sessions created at or after this epoch time")
+    parser.add_argument("--limit", type=int, help="stop after this many sessions")
+    parser.add_argument("--no-resume", action="store_true", help="ignore previous progress")
+    args = parser.parse_args(argv)
+    load_env_once(".env")
+
+    store = JSONDirSessionStore(args.json_dir) if args.json_dir else SQLiteSessionStore(args.db)
+    run(
+        store,
+        args.out,
+        concurrency=args.concurrency,
+        workers=args.workers,
+        resume=not args.no_resume,
+        model_override=args.model,
+        since=args.since,
+        limit=args.limit,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Offline benchmarks for the chat and triage pipelines.
+
+Runs against fake_provider, so no API keys or network are needed, and emits
+JSON that can be diffed across commits:
+
+    python bench_pipelines.py --json bench.json
+    python bench_pipelines.py --compare bench.json        # after a change
+
+Cases:
+  chat_turn         - one streamed consultation turn through chat_engine
+  triage_flow       - summary + streamed JSON detailed report, dispatched like
+                      show_triage (also times the first completed section)
+  triage_repair     - detailed report whose JSON needs a follow-up for missing fields
+  parse_sections    - legacy free-text section parser on a well-formed report
+  parse_malformed   - legacy free-text section parser on a malformed report
+  validate_report   - JSON report parsing and schema validation
+  pdf_build         - ReportLab build of the parsed report (needs reportlab)
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import request_scheduler
+import response_cache
+from fake_provider import (
+    CANNED_CHAT,
+    CANNED_REPORT,
+    CANNED_REPORT_JSON,
+    MALFORMED_REPORT,
+    FakeProvider,
+)
+from provider_clients import use_fake_provider
+
+
+def _stats(samples: list) -> dict:
+    ordered = sorted(samples)
+    return {
+        "n": len(ordered),
+        "mean_s": statistics.fmean(ordered),
+        "median_s": statistics.median(ordered),
+        "p95_s": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        "min_s": ordered[0],
+        "max_s": ordered[-1],
+    }
+
+
+def _time(fn, repeat: int) -> list:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+# ---------------------------
+# Cases
+# ---------------------------
+def bench_chat_turn(model_choice: str, repeat: int) -> dict:
+    from chat_engine import SYSTEM_PROMPT, generate_reply
+
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": "I have had a headache and a mild fever since yesterday."},
+    ]
+    ttfts, totals = [], []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        first = None
+        for chunk in generate_reply(model_choice, messages):
+            if first is None and chunk:
+                first = time.perf_counter() - t0
+        totals.append(time.perf_counter() - t0)
+        ttfts.append(first or totals[-1])
+    return {"total": _stats(totals), "ttft": _stats(ttfts)}
+
+
+def bench_triage_flow(model_choice: str, repeat: int) -> dict:
+    from triage_module import build_summary_prompt, generate_detailed_report, generate_reply
+
+    summary_prompt = build_summary_prompt(CANNED_CHAT)
+    first_sections = []
+
+    def run():
+        t0 = time.perf_counter()
+        first = []
+
+        def on_field(name, value):
+            if not first:
+                first.append(time.perf_counter() - t0)
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            jobs = [
+                pool.submit(generate_reply, model_choice, [{"role": "user", "content": summary_prompt}]),
+                pool.submit(generate_detailed_report, model_choice, "John Doe", 54, "Male", CANNED_CHAT,
+                            on_field=on_field),
+            ]
+            results = [j.result() for j in jobs]
+        first_sections.append(first[0] if first else time.perf_counter() - t0)
+        return results
+
+    return {"total": _stats(_time(run, repeat)), "first_section": _stats(first_sections)}
+
+
+def bench_triage_repair(model_choice: str, repeat: int) -> dict:
+    from provider_clients import get_registry
+    from triage_module import generate_detailed_report
+
+    fake = get_registry().fake
+    mode, fake.mode = fake.mode, "malformed"
+    try:
+        report, missing = generate_detailed_report(model_choice, "John Doe", 54, "Male", CANNED_CHAT)
+        samples = _time(
+            lambda: generate_detailed_report(model_choice, "John Doe", 54, "Male", CANNED_CHAT),
+            repeat,
+        )
+    finally:
+        fake.mode = mode
+    return {"total": _stats(samples), "fields": len(report), "missing": len(missing)}
+
+
+def bench_parse(text: str, repeat: int) -> dict:
+    from triage_module import parse_sections
+
+    sections = parse_sections(text)
+    return {
+        "total": _stats(_time(lambda: parse_sections(text), repeat)),
+        "sections": len(sections),
+    }
+
+
+def bench_validate(text: str, repeat: int) -> dict:
+    from triage_schema import parse_report_json, validate_report
+
+    report, missing = validate_report(parse_report_json(text))
+    return {
+        "total": _stats(_time(lambda: validate_report(parse_report_json(text)), repeat)),
+        "fields": len(report),
+        "missing": len(missing),
+    }
+
+
+def bench_pdf_build(repeat: int) -> dict:
+    try:
+        import reportlab  # noqa: F401
+    except ImportError:
+        return {"skipped": "reportlab not installed"}
+    from triage_module import build_triage_pdf, parse_sections
+
+    sections = parse_sections(CANNED_REPORT)
+    info = {"name": "John Doe", "age": 54, "sex": "Male",
+            "report_id": "bench", "report_date": "01 January 2026"}
+    size = len(build_triage_pdf(sections, info))
+    return {
+        "total": _stats(_time(lambda: build_triage_pdf(sections, info), repeat)),
+        "pdf_bytes": size,
+    }
+
+
+# ---------------------------
+# Driver
+# ---------------------------
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_suite(args) -> dict:
+    # Measure the provider path, not the response cache or rate limits
+    response_cache.CACHE_DISABLED = True
+    request_scheduler.RATE_LIMITS_DISABLED = True
+    use_fake_provider(FakeProvider(
+        latency_s=args.latency, tokens_per_s=args.tokens_per_s, mode=args.mode, seed=0
+    ))
+
+    cases = {}
+    for model_choice in ("Gemini", "Groq (Llama)"):
+        key = "gemini" if model_choice == "Gemini" else "groq"
+        cases[f"chat_turn.{key}"] = bench_chat_turn(model_choice, args.repeat)
+        cases[f"triage_flow.{key}"] = bench_triage_flow(model_choice, args.repeat)
+    cases["parse_sections"] = bench_parse(CANNED_REPORT, args.repeat * 200)
+    cases["parse_malformed"] = bench_parse(MALFORMED_REPORT, args.repeat * 200)
+    cases["triage_repair"] = bench_triage_repair("Gemini", args.repeat)
+    cases["validate_report"] = bench_validate(CANNED_REPORT_JSON, args.repeat * 200)
+    cases["pdf_build"] = bench_pdf_build(args.repeat)
+
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "config": {
+            "repeat": args.repeat,
+            "latency_s": args.latency,
+            "tokens_per_s": args.tokens_per_s,
+            "mode": args.mode,
+        },
+        "cases": cases,
+    }
+
+
+def compare(old: dict, new: dict):
+    print(f"{'case':<28}{'old median':>14}{'new median':>14}{'change':>10}")
+    for name, case in new["cases"].items():
+        before = old.get("cases", {}).get(name, {}).get("total", {}).get("median_s")
+        after = case.get("total", {}).get("median_s")
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{name:<28}{before * 1000:>12.3f}ms{after * 1000:>12.3f}ms{change:>+9.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline chat/triage pipeline benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake time to first token")
+    parser.add_argument("--tokens-per-s", type=float, default=2000.0)
+    parser.add_argument("--mode", choices=("normal", "malformed", "short"), default="normal")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    args = parser.parse_args(argv)
+
+    results = run_suite(args)
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
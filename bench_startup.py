@@ -0,0 +1,115 @@
+"""Cold-start and per-rerun benchmark for the Streamlit app.
+
+Each measurement runs in a fresh interpreter so module caches from earlier
+samples do not leak in:
+
+* import   - wall time to import Chatbot.py's helper modules and
+             triage_module, plus which heavy SDKs got pulled in with them.
+* render   - first script run of Chatbot.py through Streamlit's AppTest
+             (a fresh worker's cold start) and a follow-up rerun.
+
+    python bench_startup.py --repeat 5 --json startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+HEAVY_MODULES = ("google.generativeai", "groq", "reportlab", "pandas", "tiktoken", "PIL")
+
+IMPORT_PROBE = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import triage_module, response_cache, provider_clients, patient_registry
+import session_store, stream_renderer, context_manager, pdf_cache
+elapsed = time.perf_counter() - t0
+heavy = [m for m in %r if m in sys.modules]
+print(json.dumps({"import_s": elapsed, "heavy_loaded": heavy}))
+""" % (HEAVY_MODULES,)
+
+RENDER_PROBE = r"""
+import json, sys, time
+try:
+    from streamlit.testing.v1 import AppTest
+except ImportError:
+    print(json.dumps({"error": "streamlit.testing.v1.AppTest unavailable"}))
+    sys.exit(0)
+t0 = time.perf_counter()
+at = AppTest.from_file("Chatbot.py", default_timeout=60)
+at.secrets["GEMINI_API_KEY"] = "bench"
+at.secrets["GROQ_API_KEY"] = "bench"
+at.run()
+first = time.perf_counter() - t0
+t1 = time.perf_counter()
+at.run()
+rerun = time.perf_counter() - t1
+heavy = [m for m in %r if m in sys.modules]
+print(json.dumps({
+    "first_render_s": first,
+    "rerun_s": rerun,
+    "exceptions": [str(e.value) for e in at.exception],
+    "heavy_loaded": heavy,
+}))
+""" % (HEAVY_MODULES,)
+
+
+def _probe(code: str) -> dict:
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True, text=True, check=False, cwd=REPO_DIR,
+    )
+    lines = [line for line in out.stdout.splitlines() if line.startswith("{")]
+    if out.returncode != 0 or not lines:
+        return {"error": (out.stderr or out.stdout).strip().splitlines()[-1:] or ["no output"]}
+    return json.loads(lines[-1])
+
+
+def _summarize(samples: list, field: str) -> dict:
+    values = [s[field] for s in samples if field in s]
+    if not values:
+        return {}
+    return {
+        "median_s": statistics.median(values),
+        "min_s": min(values),
+        "max_s": max(values),
+        "n": len(values),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-render", action="store_true", help="only measure imports")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    import_samples = [_probe(IMPORT_PROBE) for _ in range(args.repeat)]
+    results = {
+        "python": sys.version.split()[0],
+        "import": _summarize(import_samples, "import_s"),
+        "import_heavy_loaded": import_samples[-1].get("heavy_loaded"),
+    }
+    errors = [s["error"] for s in import_samples if "error" in s]
+
+    if not args.skip_render:
+        render_samples = [_probe(RENDER_PROBE) for _ in range(args.repeat)]
+        results["first_render"] = _summarize(render_samples, "first_render_s")
+        results["rerun"] = _summarize(render_samples, "rerun_s")
+        results["render_heavy_loaded"] = render_samples[-1].get("heavy_loaded")
+        errors += [s["error"] for s in render_samples if "error" in s]
+
+    if errors:
+        results["errors"] = errors
+
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
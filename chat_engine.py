@@ -0,0 +1,418 @@
+"""Provider-agnostic chat helpers behind the consultation page.
+
+Chatbot.py renders the UI; everything here is plain Python so the same
+prompt and model wrappers can be driven by batch tools, benchmarks and the
+HTTP API without a Streamlit runtime.
+"""
+import asyncio
+import logging
+import os
+
+from provider_clients import (
+    MissingAPIKeyError,
+    get_async_groq_client,
+    get_gemini_model,
+    get_groq_client,
+)
+from gemini_context import get_context_cache, record_gemini_usage, to_gemini_contents
+from metrics import instrument_stream, instrument_stream_async, observe_token_usage
+from provider_router import (
+    on_cancel,
+    routed_stream,
+    routed_stream_async,
+    track_stream,
+    track_stream_async,
+)
+from request_scheduler import get_scheduler, is_rate_limited
+from response_cache import get_response_cache
+from semantic_cache import SEMANTIC_CACHE_ENABLED, get_semantic_cache, namespace_for
+
+GEMINI_MODEL = "gemini-2.5-flash"
+GROQ_MODEL = "llama-3.3-70b-versatile"
+GROQ_TEMPERATURE = 0.25
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# System Prompt
+# ---------------------------
+SYSTEM_PROMPT = (
+    "You are a friendly, helpful medical chat assistant.\n"
+    "- Use simple language\n"
+    "- Never diagnose\n"
+    "- Give helpful suggestions\n"
+    "- Ask one gentle follow-up question\n"
+    "- Recommend doctor only if severe/persistent\n"
+    "- IMPORTANT: Do NOT use HTML tags, <div>, or CSS classes in your response.\n "
+    "- Return ONLY plain text or simple bullet points using dashes (-).\n"
+    "- End with: 'This is general information and not a substitute for professional medical advice.'"
+)
+
+# ---------------------------
+# API keys
+# ---------------------------
+# Explicit overrides; otherwise the env is read at call time so .env files
+# loaded after import still take effect.
+_api_keys = {}
+
+
+def set_api_keys(gemini=None, groq=None):
+    """Override the env keys, e.g. with Streamlit secrets."""
+    if gemini:
+        _api_keys["gemini"] = gemini
+    if groq:
+        _api_keys["groq"] = groq
+
+
+# ---------------------------
+# Gemini + Groq helpers
+# ---------------------------
+# Clients live in provider_clients for the whole server process, so reruns
+# and other sessions reuse the same pooled connections. Provider SDKs are
+# imported there lazily, only when the selected model is first used.
+def gemini_api_key():
+    return _api_keys.get("gemini") or os.getenv("GEMINI_API_KEY")
+
+
+def ensure_gemini(system_instruction=None):
+    return get_gemini_model(gemini_api_key(), GEMINI_MODEL, system_instruction)
+
+
+def groq_api_key():
+    return _api_keys.get("groq") or os.getenv("GROQ_API_KEY")
+
+
+def ensure_groq():
+    return get_groq_client(groq_api_key())
+
+
+def ensure_async_groq():
+    return get_async_groq_client(groq_api_key())
+
+
+def _groq_errors():
+    try:
+        from groq import PermissionDeniedError, APIConnectionError
+    except ImportError:
+        # Running against the offline fake provider without the SDK installed
+        return (), ()
+    return PermissionDeniedError, APIConnectionError
+
+
+def _provider_errors() -> tuple:
+    """Exception types that mean a provider (not this code) failed; only
+    these become the "unavailable" fallback reply."""
+    errors = [ConnectionError, TimeoutError, MissingAPIKeyError]
+    try:
+        from groq import APIError
+        errors.append(APIError)
+    except ImportError:
+        pass
+    try:
+        from google.api_core.exceptions import GoogleAPIError
+        from google.generativeai.types import BlockedPromptException, StopCandidateException
+        errors.extend((GoogleAPIError, BlockedPromptException, StopCandidateException))
+    except ImportError:
+        pass
+    try:
+        from httpx import HTTPError
+        errors.append(HTTPError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+def _is_provider_failure(error: BaseException) -> bool:
+    return is_rate_limited(error) or isinstance(error, _provider_errors())
+
+
+UNAVAILABLE_REPLY = "Both model providers are unavailable right now. Please try again shortly."
+
+
+# ---------------------------
+# First-turn semantic cache
+# ---------------------------
+def _first_turn_question(messages: list):
+    """The user's question if ``messages`` is a consultation's opening turn
+    (SYSTEM_PROMPT plus one user message), else None."""
+    if (
+        len(messages) == 2
+        and messages[0]["role"] == "system"
+        and messages[0]["content"] == SYSTEM_PROMPT
+        and messages[1]["role"] == "user"
+    ):
+        return str(messages[1]["content"])
+    return None
+
+
+def _first_turn_cached(provider: str, messages: list, stream):
+    """``stream(messages)``, served from the semantic cache for opening
+    questions when SEMANTIC_CACHE_ENABLED is set."""
+    question = _first_turn_question(messages) if SEMANTIC_CACHE_ENABLED else None
+    if question is None:
+        return stream(messages)
+    return get_semantic_cache().stream_through(
+        namespace_for(provider, SYSTEM_PROMPT), question, lambda: stream(messages)
+    )
+
+
+def _first_turn_cached_async(provider: str, messages: list, stream):
+    question = _first_turn_question(messages) if SEMANTIC_CACHE_ENABLED else None
+    if question is None:
+        return stream(messages)
+    return get_semantic_cache().stream_through_async(
+        namespace_for(provider, SYSTEM_PROMPT), question, lambda: stream(messages)
+    )
+
+
+# ---------------------------
+# Model Wrappers
+# ---------------------------
+def _gemini_stream(messages: list):
+    """Gemini chunks, raising on provider errors (used directly by routing).
+
+    The system prompt goes in as system_instruction and the history as
+    native contents, so the unchanged prefix can be served from Gemini's
+    prompt cache instead of being re-read as one flattened string.
+    """
+    system_instruction, contents = to_gemini_contents(messages)
+
+    def _stream():
+        model, send = get_context_cache().model_for(
+            gemini_api_key(), GEMINI_MODEL, system_instruction, contents
+        )
+        response = model.generate_content(send, stream=True)
+        # Lets a hedged loser stop mid-read: cancel the underlying gRPC stream
+        abort = getattr(getattr(response, "_iterator", None), "cancel", None)
+        if abort is not None:
+            on_cancel(abort)
+        last = None
+        for chunk in response:
+            last = chunk
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunk carried no text part (e.g. a safety block)
+                continue
+            if text:
+                yield text
+        # The final chunk carries the usage totals for the whole turn
+        record_gemini_usage(last)
+
+    yield from get_response_cache().stream_through(
+        "gemini", GEMINI_MODEL, None, messages,
+        lambda: track_stream("gemini", instrument_stream(
+            get_scheduler().stream(GEMINI_MODEL, messages, _stream), "llm_call", provider="gemini"
+        )),
+    )
+
+
+def chat_with_gemini_messages(messages: list):
+    """Yield reply chunks from Gemini as they stream in."""
+    try:
+        yield from _first_turn_cached("gemini", messages, _gemini_stream)
+    except Exception as e:
+        if not is_rate_limited(e):
+            raise
+        yield "Gemini is busy right now. Please try again in a minute."
+
+
+def _record_groq_usage(usage):
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    observe_token_usage(
+        "groq",
+        prompt=getattr(usage, "prompt_tokens", 0),
+        completion=getattr(usage, "completion_tokens", 0),
+        cached=getattr(details, "cached_tokens", 0) if details is not None else 0,
+    )
+
+
+def _groq_stream(messages: list):
+    """Groq chunks, raising on provider errors (used directly by routing)."""
+    client = ensure_groq()
+
+    def _stream():
+        resp = client.chat.completions.create(
+            model=GROQ_MODEL,
+            messages=[{"role": m["role"], "content": m["content"]} for m in messages],
+            temperature=GROQ_TEMPERATURE,
+            stream=True,
+        )
+        if hasattr(resp, "close"):
+            # Lets a hedged loser drop its HTTP response mid-read
+            on_cancel(resp.close)
+        usage = None
+        for chunk in resp:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            # Groq reports usage on the final chunk under x_groq
+            usage = getattr(getattr(chunk, "x_groq", None), "usage", None) or usage
+        _record_groq_usage(usage)
+
+    yield from get_response_cache().stream_through(
+        "groq", GROQ_MODEL, GROQ_TEMPERATURE, messages,
+        lambda: track_stream("groq", instrument_stream(
+            get_scheduler().stream(GROQ_MODEL, messages, _stream), "llm_call", provider="groq"
+        )),
+    )
+
+
+def chat_with_groq_messages(messages: list):
+    """Yield reply chunks from Groq as they stream in."""
+    PermissionDeniedError, APIConnectionError = _groq_errors()
+    try:
+        yield from _first_turn_cached("groq", messages, _groq_stream)
+    except PermissionDeniedError:
+        yield "Groq permission issue."
+    except APIConnectionError:
+        yield "Groq network error."
+    except Exception as e:
+        if not is_rate_limited(e):
+            raise
+        yield "Groq is busy right now. Please try again in a minute."
+
+
+def chat_with_auto_routing(messages: list):
+    """Yield chunks from whichever provider is currently faster, hedging to
+    the other one when the first is slow to start."""
+    streams = {"gemini": _gemini_stream, "groq": _groq_stream}
+    sent = False
+    try:
+        for chunk in _first_turn_cached(
+            "auto", messages, lambda m: routed_stream(lambda provider: streams[provider](m))
+        ):
+            sent = True
+            yield chunk
+    except Exception as e:
+        if not _is_provider_failure(e):
+            logger.exception("auto-routed reply failed")
+            raise
+        logger.warning("auto-routed reply failed: %r", e)
+        if not sent:
+            # After partial output the reply just ends; never append to it
+            yield UNAVAILABLE_REPLY
+
+
+def generate_reply(model_choice: str, messages: list):
+    """Streaming generator of reply text chunks for the chosen provider."""
+    if model_choice.startswith("Auto"):
+        return chat_with_auto_routing(messages)
+    if model_choice.startswith("Gemini"):
+        return chat_with_gemini_messages(messages)
+    return chat_with_groq_messages(messages)
+
+
+# ---------------------------
+# Utility
+# ---------------------------
+def ask_model(model_choice: str, system_prompt: str, user_prompt: str):
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+    return "".join(generate_reply(model_choice, messages)).strip()
+
+
+# ---------------------------
+# Async wrappers (HTTP API)
+# ---------------------------
+# Same prompts, caching, rate limits and routing as above, on the SDKs' async
+# clients so one event loop can hold many consultations at once.
+async def _gemini_stream_async(messages: list):
+    system_instruction, contents = to_gemini_contents(messages)
+
+    async def _stream():
+        # Creating an explicit context cache is a blocking SDK call
+        model, send = await asyncio.to_thread(
+            get_context_cache().model_for, gemini_api_key(), GEMINI_MODEL, system_instruction, contents
+        )
+        last = None
+        async for chunk in await model.generate_content_async(send, stream=True):
+            last = chunk
+            try:
+                text = chunk.text
+            except ValueError:
+                continue
+            if text:
+                yield text
+        record_gemini_usage(last)
+
+    async for chunk in get_response_cache().stream_through_async(
+        "gemini", GEMINI_MODEL, None, messages,
+        lambda: track_stream_async("gemini", instrument_stream_async(
+            get_scheduler().stream_async(GEMINI_MODEL, messages, _stream), "llm_call", provider="gemini"
+        )),
+    ):
+        yield chunk
+
+
+async def _groq_stream_async(messages: list):
+    client = ensure_async_groq()
+
+    async def _stream():
+        resp = await client.chat.completions.create(
+            model=GROQ_MODEL,
+            messages=[{"role": m["role"], "content": m["content"]} for m in messages],
+            temperature=GROQ_TEMPERATURE,
+            stream=True,
+        )
+        usage = None
+        async for chunk in resp:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            usage = getattr(getattr(chunk, "x_groq", None), "usage", None) or usage
+        _record_groq_usage(usage)
+
+    async for chunk in get_response_cache().stream_through_async(
+        "groq", GROQ_MODEL, GROQ_TEMPERATURE, messages,
+        lambda: track_stream_async("groq", instrument_stream_async(
+            get_scheduler().stream_async(GROQ_MODEL, messages, _stream), "llm_call", provider="groq"
+        )),
+    ):
+        yield chunk
+
+
+async def generate_reply_async(model_choice: str, messages: list):
+    """Async counterpart of generate_reply, with the same fallback messages."""
+    if model_choice.startswith("Auto"):
+        streams = {"gemini": _gemini_stream_async, "groq": _groq_stream_async}
+        sent = False
+        try:
+            async for chunk in _first_turn_cached_async(
+                "auto", messages, lambda m: routed_stream_async(lambda provider: streams[provider](m))
+            ):
+                sent = True
+                yield chunk
+        except Exception as e:
+            if not _is_provider_failure(e):
+                logger.exception("auto-routed reply failed")
+                raise
+            logger.warning("auto-routed reply failed: %r", e)
+            if not sent:
+                yield UNAVAILABLE_REPLY
+        return
+    gemini = model_choice.startswith("Gemini")
+    PermissionDeniedError, APIConnectionError = _groq_errors()
+    try:
+        async for chunk in _first_turn_cached_async(
+            "gemini" if gemini else "groq", messages, _gemini_stream_async if gemini else _groq_stream_async
+        ):
+            yield chunk
+    except PermissionDeniedError:
+        yield "Groq permission issue."
+    except APIConnectionError:
+        yield "Groq network error."
+    except Exception as e:
+        if not is_rate_limited(e):
+            raise
+        yield f"{'Gemini' if gemini else 'Groq'} is busy right now. Please try again in a minute."
+
+
+async def ask_model_async(model_choice: str, system_prompt: str, user_prompt: str):
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+    return "".join([chunk async for chunk in generate_reply_async(model_choice, messages)]).strip()
@@ -0,0 +1,306 @@
+"""Consultation state shared by every app replica.
+
+st.session_state lives in one Streamlit process, so a reconnect that lands
+on another replica used to start an empty consultation. The conversation,
+selected patient and page flags are now also kept in a ConsultationStore
+keyed by session id (carried in the page URL as ``?sid=``), and any replica
+can restore them.
+
+Writes are incremental: ``sync_consultation`` appends only the messages
+added since the last sync and updates only the fields whose values changed,
+so a chat turn writes two messages rather than the whole history. The
+system prompt is not stored; a restored consultation gets the current one.
+
+Backends, chosen with CONSULTATION_STORE_BACKEND:
+
+    sqlite  (default) CONSULTATION_DB_PATH, for replicas on a single host.
+            The database runs in WAL mode, which needs shared memory on one
+            machine; do not put it on a network filesystem.
+    redis   a Redis-compatible server at REDIS_URL (one list and one hash per
+            consultation, both expiring after CONSULTATION_TTL_SECONDS); the
+            backend for replicas on several hosts. Needs the redis package.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from session_store import REDIS_PREFIX, REDIS_URL, get_redis_client
+
+CONSULTATION_STORE_BACKEND = os.getenv("CONSULTATION_STORE_BACKEND", "sqlite")
+CONSULTATION_DB_PATH = os.getenv("CONSULTATION_DB_PATH", "consultations.sqlite3")
+CONSULTATION_TTL_SECONDS = int(os.getenv("CONSULTATION_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# st.session_state keys that make up a consultation, besides "messages"
+PERSISTED_FIELDS = (
+    "page",
+    "show_intro",
+    "user_word_count",
+    "last_assistant_reply",
+    "triage_id",
+    "show_summary",
+    "selected_patient_id",
+    "selected_patient_name",
+    "selected_patient_age",
+    "selected_patient_sex",
+    "context_summary",
+    "context_summarized_upto",
+)
+# Shadow of what was last written, kept in the session state itself
+_SYNCED_KEY = "_consultation_synced"
+_MISSING = object()
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class ConsultationStore:
+    """Interface shared by the storage backends."""
+
+    def load(self, session_id: str):
+        """{"messages": [...], field: value, ...}, or None if unknown/expired."""
+        raise NotImplementedError
+
+    def append_messages(self, session_id: str, messages: list):
+        raise NotImplementedError
+
+    def replace_messages(self, session_id: str, messages: list):
+        raise NotImplementedError
+
+    def set_fields(self, session_id: str, fields: dict):
+        raise NotImplementedError
+
+    def delete(self, session_id: str):
+        raise NotImplementedError
+
+
+# ---------------------------
+# SQLite
+# ---------------------------
+class SQLiteConsultationStore(ConsultationStore):
+    def __init__(self, path=CONSULTATION_DB_PATH, ttl_seconds=CONSULTATION_TTL_SECONDS):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS consultations (
+                session_id TEXT PRIMARY KEY,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS consultation_messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS consultation_fields (
+                session_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (session_id, name)
+            );
+            CREATE INDEX IF NOT EXISTS consultations_updated ON consultations(updated_at);
+            """
+        )
+
+    def _touch(self, session_id):
+        self._conn.execute(
+            "INSERT INTO consultations (session_id, updated_at) VALUES (?, ?)"
+            " ON CONFLICT(session_id) DO UPDATE SET updated_at = excluded.updated_at",
+            (session_id, time.time()),
+        )
+
+    def load(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT updated_at FROM consultations WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None or (self.ttl_seconds and row[0] < time.time() - self.ttl_seconds):
+                return None
+            messages = self._conn.execute(
+                "SELECT role, content FROM consultation_messages WHERE session_id = ? ORDER BY seq",
+                (session_id,),
+            ).fetchall()
+            fields = self._conn.execute(
+                "SELECT name, value FROM consultation_fields WHERE session_id = ?", (session_id,)
+            ).fetchall()
+        state = {name: json.loads(value) for name, value in fields}
+        state["messages"] = [{"role": role, "content": content} for role, content in messages]
+        return state
+
+    def _write_messages(self, session_id, messages, replace):
+        with self._lock:
+            # One transaction, so readers never see a half-replaced history
+            self._conn.execute("BEGIN")
+            try:
+                if replace:
+                    self._conn.execute(
+                        "DELETE FROM consultation_messages WHERE session_id = ?", (session_id,)
+                    )
+                start = self._conn.execute(
+                    "SELECT COALESCE(MAX(seq) + 1, 0) FROM consultation_messages WHERE session_id = ?",
+                    (session_id,),
+                ).fetchone()[0]
+                self._conn.executemany(
+                    "INSERT INTO consultation_messages (session_id, seq, role, content)"
+                    " VALUES (?, ?, ?, ?)",
+                    [(session_id, start + i, m["role"], str(m["content"])) for i, m in enumerate(messages)],
+                )
+                self._touch(session_id)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def append_messages(self, session_id, messages):
+        self._write_messages(session_id, messages, replace=False)
+
+    def replace_messages(self, session_id, messages):
+        self._write_messages(session_id, messages, replace=True)
+
+    def set_fields(self, session_id, fields):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO consultation_fields (session_id, name, value) VALUES (?, ?, ?)"
+                " ON CONFLICT(session_id, name) DO UPDATE SET value = excluded.value",
+                [(session_id, name, _dumps(value)) for name, value in fields.items()],
+            )
+            self._touch(session_id)
+
+    def delete(self, session_id):
+        with self._lock:
+            for table in ("consultations", "consultation_messages", "consultation_fields"):
+                self._conn.execute(f"DELETE FROM {table} WHERE session_id = ?", (session_id,))
+
+    def compact(self) -> int:
+        """Drop expired consultations; return how many were removed."""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            expired = [r[0] for r in self._conn.execute(
+                "SELECT session_id FROM consultations WHERE updated_at < ?", (cutoff,)
+            ).fetchall()]
+        for session_id in expired:
+            self.delete(session_id)
+        return len(expired)
+
+
+# ---------------------------
+# Redis
+# ---------------------------
+class RedisConsultationStore(ConsultationStore):
+    def __init__(self, url=REDIS_URL, ttl_seconds=CONSULTATION_TTL_SECONDS, prefix=REDIS_PREFIX):
+        self.redis = get_redis_client(url)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def _keys(self, session_id):
+        base = f"{self.prefix}consultation:{session_id}"
+        return f"{base}:messages", f"{base}:fields"
+
+    def _expire(self, pipe, session_id):
+        if self.ttl_seconds:
+            for key in self._keys(session_id):
+                pipe.expire(key, self.ttl_seconds)
+
+    def load(self, session_id):
+        messages_key, fields_key = self._keys(session_id)
+        pipe = self.redis.pipeline()
+        pipe.lrange(messages_key, 0, -1)
+        pipe.hgetall(fields_key)
+        messages, fields = pipe.execute()
+        if not messages and not fields:
+            return None
+        state = {name.decode(): json.loads(value) for name, value in fields.items()}
+        state["messages"] = [json.loads(m) for m in messages]
+        return state
+
+    def append_messages(self, session_id, messages):
+        if not messages:
+            return
+        pipe = self.redis.pipeline()
+        pipe.rpush(self._keys(session_id)[0], *[_dumps(m) for m in messages])
+        self._expire(pipe, session_id)
+        pipe.execute()
+
+    def replace_messages(self, session_id, messages):
+        messages_key = self._keys(session_id)[0]
+        pipe = self.redis.pipeline()
+        pipe.delete(messages_key)
+        if messages:
+            pipe.rpush(messages_key, *[_dumps(m) for m in messages])
+        self._expire(pipe, session_id)
+        pipe.execute()
+
+    def set_fields(self, session_id, fields):
+        if not fields:
+            return
+        pipe = self.redis.pipeline()
+        pipe.hset(self._keys(session_id)[1], mapping={k: _dumps(v) for k, v in fields.items()})
+        self._expire(pipe, session_id)
+        pipe.execute()
+
+    def delete(self, session_id):
+        self.redis.delete(*self._keys(session_id))
+
+
+# ---------------------------
+# Session-state sync
+# ---------------------------
+def sync_consultation(store: ConsultationStore, session_id: str, state):
+    """Write what changed in ``state`` (st.session_state or any mapping)
+    since the last sync or restore."""
+    synced = state.get(_SYNCED_KEY) or {"messages": 0, "fields": {}}
+    messages = [m for m in state.get("messages", []) if m.get("role") != "system"]
+    if len(messages) < synced["messages"]:
+        # History was reset or replaced; rewrite it once
+        store.replace_messages(session_id, messages)
+    elif len(messages) > synced["messages"]:
+        store.append_messages(session_id, messages[synced["messages"]:])
+
+    changed = {
+        name: state[name] for name in PERSISTED_FIELDS
+        if name in state and synced["fields"].get(name, _MISSING) != state[name]
+    }
+    if changed:
+        store.set_fields(session_id, changed)
+    state[_SYNCED_KEY] = {
+        "messages": len(messages),
+        "fields": {**synced["fields"], **changed},
+    }
+
+
+def restore_consultation(store: ConsultationStore, session_id: str, state, system_prompt: str) -> bool:
+    """Load a stored consultation into ``state``; False if there is none."""
+    stored = store.load(session_id)
+    if stored is None:
+        return False
+    messages = stored.pop("messages")
+    state["messages"] = [{"role": "system", "content": system_prompt}] + messages
+    fields = {name: value for name, value in stored.items() if name in PERSISTED_FIELDS}
+    for name, value in fields.items():
+        state[name] = value
+    state[_SYNCED_KEY] = {"messages": len(messages), "fields": fields}
+    return True
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_consultation_store() -> ConsultationStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if CONSULTATION_STORE_BACKEND == "redis":
+                    _store = RedisConsultationStore(REDIS_URL)
+                else:
+                    _store = SQLiteConsultationStore(CONSULTATION_DB_PATH)
+    return _store
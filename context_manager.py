@@ -0,0 +1,148 @@
+"""Token-budgeted conversation context with rolling summarization.
+
+Chatbot.py keeps the whole consultation in st.session_state["messages"], and
+triage only unlocks after hundreds of user words, so sending the raw history
+makes every turn bigger than the last. ContextManager keeps the system prompt
+and the most recent turns verbatim and folds older turns into a running
+summary once the token budget is exceeded. The summary is updated
+incrementally: only turns that newly fall out of the window are summarized.
+"""
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2500"))
+CONTEXT_KEEP_RECENT = int(os.getenv("CONTEXT_KEEP_RECENT", "6"))
+SUMMARY_MAX_WORDS = int(os.getenv("CONTEXT_SUMMARY_MAX_WORDS", "250"))
+
+# Per-message overhead (role, separators) in chat-completion formats
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain a running clinical summary of a patient's symptom conversation "
+    "with a medical chat assistant. Keep every clinically relevant detail: symptoms, "
+    "onset, duration, severity, triggers, medications, history, and advice already given. "
+    "Do not add anything that was not said. Return plain text only."
+)
+
+_encoding = None
+_encoding_loaded = False
+
+
+# ---------------------------
+# Token counting
+# ---------------------------
+def _get_encoding():
+    # tiktoken is optional and slow to import, so only try on first use
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = None
+        _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # ~4 characters per token for English prose
+    return max(1, (len(text) + 3) // 4)
+
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(str(message.get("content", ""))) + MESSAGE_OVERHEAD_TOKENS
+
+
+def summary_message(summary: str) -> dict:
+    return {
+        "role": "system",
+        "content": f"Summary of the earlier conversation with this patient:\n{summary}",
+    }
+
+
+def make_summarizer(ask):
+    """Build a summarize(previous_summary, turns) callable from
+    ask(system_prompt, user_prompt) -> str."""
+
+    def summarize(previous_summary: str, turns: list) -> str:
+        transcript = "\n".join(
+            f"{m['role'].capitalize()}: {m['content']}" for m in turns
+        )
+        user_prompt = (
+            f"Current summary:\n{previous_summary or '(none yet)'}\n\n"
+            f"New conversation turns:\n{transcript}\n\n"
+            f"Rewrite the summary to include the new turns in at most {SUMMARY_MAX_WORDS} words."
+        )
+        return ask(SUMMARY_SYSTEM_PROMPT, user_prompt).strip()
+
+    return summarize
+
+
+# ---------------------------
+# Context manager
+# ---------------------------
+class ContextManager:
+    """Builds the outgoing message list for a turn.
+
+    Summary progress is kept in ``state`` (st.session_state or any mapping)
+    under ``context_summary`` and ``context_summarized_upto``, the number of
+    non-system messages already folded into the summary.
+    """
+
+    def __init__(self, summarize, budget=CONTEXT_TOKEN_BUDGET, keep_recent=CONTEXT_KEEP_RECENT):
+        self.summarize = summarize
+        self.budget = budget
+        self.keep_recent = keep_recent
+
+    def _size(self, system: list, summary: str, tail: list) -> int:
+        total = sum(message_tokens(m) for m in system) + sum(message_tokens(m) for m in tail)
+        if summary:
+            total += message_tokens(summary_message(summary))
+        return total
+
+    def prepare(self, messages: list, state) -> list:
+        system = [m for m in messages[:1] if m.get("role") == "system"]
+        body = messages[len(system):]
+
+        summary = state.get("context_summary", "")
+        upto = state.get("context_summarized_upto", 0)
+        if upto > len(body):
+            # History was cleared or replaced; start over
+            summary, upto = "", 0
+
+        tail = body[upto:]
+        if self._size(system, summary, tail) > self.budget and len(tail) > self.keep_recent:
+            cut = len(tail) - self.keep_recent
+            # Keep the verbatim window starting on a user turn
+            while cut < len(tail) and tail[cut].get("role") != "user":
+                cut += 1
+            if 0 < cut < len(tail):
+                try:
+                    summary = self.summarize(summary, tail[:cut])
+                    upto += cut
+                    tail = body[upto:]
+                except Exception:
+                    logger.exception("context summarization failed; sending full history")
+
+        state["context_summary"] = summary
+        state["context_summarized_upto"] = upto
+
+        outgoing = list(system)
+        if summary:
+            outgoing.append(summary_message(summary))
+        outgoing.extend(tail)
+        return outgoing
+
+    def stats(self, outgoing: list) -> dict:
+        return {
+            "prompt_tokens": sum(message_tokens(m) for m in outgoing),
+            "messages": len(outgoing),
+            "budget": self.budget,
+        }
@@ -0,0 +1,413 @@
+"""Offline stand-in for the Groq and Gemini SDK surfaces we use.
+
+Implements just enough of ``Groq().chat.completions.create`` (sync and async,
+streaming and not) and ``GenerativeModel.generate_content`` /
+``start_chat().send_message`` to drive Chatbot.py, triage_module and the
+benchmarks without API keys. Latency, token rate and canned outputs are
+configurable, including malformed triage reports and simulated 429s.
+
+Enable for the Streamlit app with LLM_FAKE_PROVIDER=1, or in code:
+
+    from fake_provider import FakeProvider
+    from provider_clients import use_fake_provider
+    use_fake_provider(FakeProvider(latency_s=0.2, tokens_per_s=120))
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+CANNED_CHAT = (
+    "I'm sorry you're dealing with that. A headache with a mild fever is often "
+    "caused by a common viral infection.\n"
+    "- Rest and drink plenty of fluids\n"
+    "- Paracetamol can help with both the fever and the headache\n"
+    "- Keep the room dark and quiet if light bothers you\n"
+    "How long have you had the fever, and how high has it been?\n"
+    "This is general information and not a substitute for professional medical advice."
+)
+
+CANNED_SUMMARY = (
+    "- Main symptoms: headache and mild fever for two days\n"
+    "- Overall concern: mild\n"
+    "- Rest, fluids and paracetamol are reasonable first steps\n"
+    "- No red-flag symptoms such as neck stiffness or confusion reported\n"
+    "- See a doctor if the fever lasts more than three days or exceeds 39.5 C\n"
+    "- Recovery is expected within a few days"
+)
+
+CANNED_REPORT = """Risk Level:
+Low - symptoms are consistent with a self-limiting viral illness.
+
+Key Symptoms:
+- Headache
+- Mild fever (38.1 C)
+- Fatigue
+
+Chief Complaint:
+Headache and mild fever for two days.
+
+History of Present Illness:
+The patient reports a dull frontal headache that started two days ago, followed by a mild fever and tiredness. No neck stiffness, rash or vomiting.
+
+Home Care Advice:
+- Rest and keep well hydrated
+- Use a cool compress for the headache
+
+OTC Guidance:
+- Paracetamol 500-1000 mg every 6 hours, maximum 4 g per day
+- Avoid combining products that both contain paracetamol
+
+Monitoring Advice:
+- Check temperature twice daily
+- Seek care for neck stiffness, confusion or a spreading rash
+
+Health Checks:
+- No tests needed unless symptoms persist beyond three days
+
+Reassurance:
+- These symptoms usually settle within a few days with rest
+
+Safety Disclaimer:
+This report is general information and not a substitute for professional medical advice.
+"""
+
+# Typical failure modes: markdown headings, "Key: value" lines that the colon
+# heuristic mistakes for sections, and a truncated tail.
+MALFORMED_REPORT = """## Triage Report
+**Patient Information:** Name: John Doe
+Age: 54
+**Risk Level** Moderate
+Key Symptoms
+* headache
+* fever: 38.5
+Chief Complaint: headache
+History of Present Illness - started two days ago, worse in the
+"""
+
+SHORT_REPORT = "Risk Level: Low"
+
+CANNED_REPORT_JSON = json.dumps({
+    "risk_level": "Low",
+    "risk_rationale": "Symptoms are consistent with a self-limiting viral illness.",
+    "key_symptoms": ["Headache", "Mild fever (38.1 C)", "Fatigue"],
+    "chief_complaint": "Headache and mild fever for two days.",
+    "history_of_present_illness": (
+        "The patient reports a dull frontal headache that started two days ago, followed by "
+        "a mild fever and tiredness. No neck stiffness, rash or vomiting."
+    ),
+    "home_care_advice": ["Rest and keep well hydrated", "Use a cool compress for the headache"],
+    "otc_guidance": [
+        "Paracetamol 500-1000 mg every 6 hours, maximum 4 g per day",
+        "Avoid combining products that both contain paracetamol",
+    ],
+    "monitoring_advice": [
+        "Check temperature twice daily",
+        "Seek care for neck stiffness, confusion or a spreading rash",
+    ],
+    "health_checks": ["No tests needed unless symptoms persist beyond three days"],
+    "reassurance": ["These symptoms usually settle within a few days with rest"],
+    "safety_disclaimer": (
+        "This report is general information and not a substitute for professional medical advice."
+    ),
+})
+
+# Valid JSON with fields missing, mistyped or out of range, to exercise the
+# follow-up request for missing fields.
+MALFORMED_REPORT_JSON = json.dumps({
+    "risk_level": "Probably fine",
+    "key_symptoms": "headache, fever",
+    "chief_complaint": "",
+    "home_care_advice": [{"item": "rest"}],
+})
+
+
+class FakeUpstreamError(ConnectionError):
+    """A simulated upstream failure, or a read on a stream that was closed."""
+
+
+class FakeRateLimitError(Exception):
+    """Shaped like groq.RateLimitError: status_code 429 plus retry-after."""
+
+    def __init__(self, retry_after_s=1.0):
+        super().__init__("fake provider: simulated rate limit (429)")
+        self.status_code = 429
+        self.response = SimpleNamespace(headers={"retry-after": str(retry_after_s)})
+
+
+def _pick_output(text: str, mode: str) -> str:
+    lowered = text.lower()
+    if "report so far" in lowered:
+        # Follow-up for missing fields; the caller keeps only what it asked for
+        return CANNED_REPORT_JSON
+    if "triage report as a json object" in lowered:
+        return {"malformed": MALFORMED_REPORT_JSON, "short": "{}"}.get(mode, CANNED_REPORT_JSON)
+    if "detailed clinical triage report" in lowered:
+        return {"malformed": MALFORMED_REPORT, "short": SHORT_REPORT}.get(mode, CANNED_REPORT)
+    if "triage summary" in lowered:
+        return CANNED_SUMMARY
+    return CANNED_CHAT
+
+
+def _prompt_text(prompt) -> str:
+    if isinstance(prompt, str):
+        return prompt
+    if isinstance(prompt, dict):
+        return " ".join(_prompt_text(p) for p in prompt.get("parts", []))
+    if isinstance(prompt, (list, tuple)):
+        return " ".join(_prompt_text(p) for p in prompt)
+    return str(prompt)
+
+
+class FakeProvider:
+    def __init__(self, latency_s=0.3, tokens_per_s=80.0, chunk_tokens=4, mode="normal",
+                 error_rate=0.0, rate_limit_rate=0.0, retry_after_s=1.0, outputs=None, seed=None):
+        self.latency_s = latency_s
+        self.tokens_per_s = tokens_per_s
+        self.chunk_tokens = chunk_tokens
+        self.mode = mode
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_s = retry_after_s
+        self.outputs = outputs or {}
+        self.calls = 0
+        self._random = random.Random(seed)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            latency_s=float(os.getenv("FAKE_LLM_LATENCY", "0.3")),
+            tokens_per_s=float(os.getenv("FAKE_LLM_TOKENS_PER_S", "80")),
+            mode=os.getenv("FAKE_LLM_MODE", "normal"),
+            error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", "0")),
+            rate_limit_rate=float(os.getenv("FAKE_LLM_RATE_LIMIT_RATE", "0")),
+        )
+
+    # ---------------- generation core ----------------
+    def reply_for(self, prompt_text: str) -> str:
+        for needle, output in self.outputs.items():
+            if needle.lower() in prompt_text.lower():
+                return output
+        return _pick_output(prompt_text, self.mode)
+
+    def _chunks(self, text: str) -> list:
+        words = text.split(" ")
+        size = max(1, self.chunk_tokens)
+        pieces = [" ".join(words[i:i + size]) for i in range(0, len(words), size)]
+        return [p if i == len(pieces) - 1 else p + " " for i, p in enumerate(pieces)]
+
+    def _chunk_delay(self) -> float:
+        return self.chunk_tokens / self.tokens_per_s if self.tokens_per_s else 0.0
+
+    def _maybe_fail(self):
+        self.calls += 1
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise FakeUpstreamError("fake provider: simulated upstream error")
+        if self.rate_limit_rate and self._random.random() < self.rate_limit_rate:
+            raise FakeRateLimitError(self.retry_after_s)
+
+    def complete(self, prompt_text: str) -> str:
+        self._maybe_fail()
+        text = self.reply_for(prompt_text)
+        time.sleep(self.latency_s + self._chunk_delay() * len(self._chunks(text)))
+        return text
+
+    def stream(self, prompt_text: str, closed=None):
+        """Reply chunks; setting the ``closed`` event ends the stream with
+        FakeUpstreamError, like closing a real response mid-read."""
+        closed = closed or threading.Event()
+        self._maybe_fail()
+        if closed.wait(self.latency_s):
+            raise FakeUpstreamError("fake provider: stream closed")
+        delay = self._chunk_delay()
+        for i, piece in enumerate(self._chunks(self.reply_for(prompt_text))):
+            if i and closed.wait(delay):
+                raise FakeUpstreamError("fake provider: stream closed")
+            yield piece
+
+    async def complete_async(self, prompt_text: str) -> str:
+        self._maybe_fail()
+        text = self.reply_for(prompt_text)
+        await asyncio.sleep(self.latency_s + self._chunk_delay() * len(self._chunks(text)))
+        return text
+
+    async def stream_async(self, prompt_text: str):
+        self._maybe_fail()
+        await asyncio.sleep(self.latency_s)
+        delay = self._chunk_delay()
+        for i, piece in enumerate(self._chunks(self.reply_for(prompt_text))):
+            if i:
+                await asyncio.sleep(delay)
+            yield piece
+
+    # ---------------- SDK facades ----------------
+    def groq(self):
+        return FakeGroq(self)
+
+    def async_groq(self):
+        return FakeAsyncGroq(self)
+
+    def gemini(self, model_name="gemini-2.5-flash", system_instruction=None):
+        return FakeGenerativeModel(self, model_name, system_instruction)
+
+
+# ---------------------------
+# Groq surface
+# ---------------------------
+def _groq_prompt(messages) -> str:
+    return "\n".join(str(m.get("content", "")) for m in messages)
+
+
+def _groq_response(text: str):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=text))]
+    )
+
+
+def _groq_chunk(text: str):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+def _groq_usage_chunk(prompt: str, text: str):
+    # Groq's final stream chunk has no choices, only usage under x_groq
+    usage = SimpleNamespace(prompt_tokens=_fake_tokens(prompt), completion_tokens=_fake_tokens(text))
+    return SimpleNamespace(choices=[], x_groq=SimpleNamespace(usage=usage))
+
+
+class _FakeGroqStream:
+    """Iterable of chunks with close(), like groq.Stream."""
+
+    def __init__(self, provider, prompt):
+        self._closed = threading.Event()
+        self._provider = provider
+        self._prompt = prompt
+
+    def __iter__(self):
+        text = ""
+        for piece in self._provider.stream(self._prompt, self._closed):
+            text += piece
+            yield _groq_chunk(piece)
+        yield _groq_usage_chunk(self._prompt, text)
+
+    def close(self):
+        self._closed.set()
+
+
+class _FakeCompletions:
+    def __init__(self, provider):
+        self.provider = provider
+
+    def create(self, model=None, messages=(), stream=False, **kwargs):
+        prompt = _groq_prompt(messages)
+        if stream:
+            return _FakeGroqStream(self.provider, prompt)
+        return _groq_response(self.provider.complete(prompt))
+
+
+class _FakeAsyncCompletions:
+    def __init__(self, provider):
+        self.provider = provider
+
+    async def create(self, model=None, messages=(), stream=False, **kwargs):
+        prompt = _groq_prompt(messages)
+        if stream:
+            async def _gen():
+                text = ""
+                async for piece in self.provider.stream_async(prompt):
+                    text += piece
+                    yield _groq_chunk(piece)
+                yield _groq_usage_chunk(prompt, text)
+            return _gen()
+        return _groq_response(await self.provider.complete_async(prompt))
+
+
+class FakeGroq:
+    def __init__(self, provider):
+        self.chat = SimpleNamespace(completions=_FakeCompletions(provider))
+
+
+class FakeAsyncGroq:
+    def __init__(self, provider):
+        self.chat = SimpleNamespace(completions=_FakeAsyncCompletions(provider))
+
+
+# ---------------------------
+# Gemini surface
+# ---------------------------
+def _fake_tokens(text: str) -> int:
+    return len(text.split())
+
+
+class _FakeGeminiResponse:
+    def __init__(self, text, prompt_tokens=0, completion_tokens=None):
+        self.text = text
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=_fake_tokens(text) if completion_tokens is None else completion_tokens,
+            cached_content_token_count=0,
+        )
+
+
+class _FakeGeminiStream:
+    def __init__(self, pieces, prompt_tokens=0, closed=None):
+        self._pieces = pieces
+        # Stands in for the gRPC stream a real response wraps
+        self._iterator = SimpleNamespace(cancel=closed.set if closed is not None else lambda: None)
+        self._prompt_tokens = prompt_tokens
+        self.text = ""
+
+    def __iter__(self):
+        # Like the real API, every chunk reports the running usage totals
+        for piece in self._pieces:
+            self.text += piece
+            yield _FakeGeminiResponse(piece, self._prompt_tokens, _fake_tokens(self.text))
+
+
+class FakeGenerativeModel:
+    def __init__(self, provider, model_name, system_instruction=None):
+        self.provider = provider
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+    def _prompt_tokens(self, prompt: str) -> int:
+        return _fake_tokens(self.system_instruction or "") + _fake_tokens(prompt)
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        prompt = _prompt_text(contents)
+        if stream:
+            closed = threading.Event()
+            return _FakeGeminiStream(
+                self.provider.stream(prompt, closed), self._prompt_tokens(prompt), closed
+            )
+        return _FakeGeminiResponse(self.provider.complete(prompt), self._prompt_tokens(prompt))
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        prompt = _prompt_text(contents)
+        prompt_tokens = self._prompt_tokens(prompt)
+        if stream:
+            async def _gen():
+                text = ""
+                async for piece in self.provider.stream_async(prompt):
+                    text += piece
+                    yield _FakeGeminiResponse(piece, prompt_tokens, _fake_tokens(text))
+            return _gen()
+        return _FakeGeminiResponse(await self.provider.complete_async(prompt), prompt_tokens)
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+
+class FakeChatSession:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream=False, **kwargs):
+        self.history.append({"role": "user", "parts": content})
+        response = self.model.generate_content(content, stream=stream)
+        if not stream:
+            self.history.append({"role": "model", "parts": [response.text]})
+        return response
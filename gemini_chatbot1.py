@@ -1,8 +1,7 @@
 import streamlit as st
-import google.generativeai as genai
-import time
-from PIL import Image
-import io
+from image_pipeline import IMAGE_USE_FILE_API, ImageHistory, prepare_image, upload_to_gemini
+from provider_clients import get_gemini_model
+from stream_renderer import StreamRenderer, format_metrics
 
 # Page config
 st.set_page_config(
@@ -11,9 +10,6 @@ st.set_page_config(
     layout="centered"
 )
 
-# Configure Gemini
-genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
-
 # System instruction
 SYSTEM_INSTRUCTION = """You are a helpful and empathetic medical assistant chatbot.
 You can analyze both **text** and **medical images** (like rashes, wounds, eye redness, swelling).
@@ -26,13 +22,17 @@ When an image is uploaded:
 
 MODEL_NAME = "gemini-2.0-flash-exp"
 
+model = get_gemini_model(st.secrets["GEMINI_API_KEY"], MODEL_NAME, SYSTEM_INSTRUCTION)
+
 # Initialize session
-if "chat" not in st.session_state:
-    model = genai.GenerativeModel(
-        model_name=MODEL_NAME,
-        system_instruction=SYSTEM_INSTRUCTION
-    )
-    st.session_state.chat = model.start_chat(history=[])
+# The history is kept here rather than in a ChatSession so that each image is
+# attached once and older image parts can be pruned before sending.
+def new_image_history():
+    return ImageHistory(upload=upload_to_gemini if IMAGE_USE_FILE_API else None)
+
+
+if "image_history" not in st.session_state:
+    st.session_state.image_history = new_image_history()
     st.session_state.messages = []
 
 # App header
@@ -50,9 +50,14 @@ uploaded_image = st.file_uploader("📸 Upload a medical image (optional)", type
 
 image_data = None
 if uploaded_image:
-    image = Image.open(uploaded_image)
-    st.image(image, caption="Uploaded Image", use_column_width=True)
-    image_data = image  # Store for Gemini input
+    # Downsized and re-encoded once per distinct file, not on every rerun
+    image_data = prepare_image(uploaded_image.getvalue())
+    width, height = image_data.size
+    st.image(
+        image_data.data,
+        caption=f"Uploaded Image ({width}×{height}, {len(image_data.data) // 1024} KB)",
+        use_column_width=True,
+    )
 
 # --- CHAT INPUT ---
 if prompt := st.chat_input("Describe your symptoms or image details..."):
@@ -64,30 +69,23 @@ if prompt := st.chat_input("Describe your symptoms or image details..."):
     # --- GEMINI RESPONSE ---
     with st.chat_message("assistant"):
         message_placeholder = st.empty()
+        renderer = StreamRenderer(message_placeholder)
         full_response = ""
 
+        history = st.session_state.image_history
+        # The uploader keeps its file across turns; it is only sent the first time
+        history.add_user(prompt, image_data)
+
         try:
-            # Build input
-            if image_data:
-                # Pass both text and image
-                response = st.session_state.chat.send_message(
-                    [prompt, image_data],
-                    stream=True
-                )
-            else:
-                # Text only
-                response = st.session_state.chat.send_message(prompt, stream=True)
-
-            # Stream the response
-            for chunk in response:
-                if chunk.text:
-                    full_response += chunk.text
-                    message_placeholder.markdown(full_response + "▌")
-                    time.sleep(0.01)
+            response = model.generate_content(history.contents(), stream=True)
 
-            message_placeholder.markdown(full_response)
+            # Stream the response (throttled re-renders, no per-chunk sleep)
+            full_response = renderer.consume(chunk.text for chunk in response if chunk.text)
+            st.session_state.last_stream_metrics = renderer.metrics()
+            history.add_model(full_response)
 
         except Exception as e:
+            history.drop_last()
             full_response = f"❌ **Error:** {str(e)}\n\nCheck your API key or file format."
             message_placeholder.markdown(full_response)
 
@@ -117,14 +115,20 @@ with st.sidebar:
     """)
 
     if st.button("🔄 Clear Chat History", use_container_width=True):
-        model = genai.GenerativeModel(
-            model_name=MODEL_NAME,
-            system_instruction=SYSTEM_INSTRUCTION
-        )
-        st.session_state.chat = model.start_chat(history=[])
+        st.session_state.image_history = new_image_history()
         st.session_state.messages = []
         st.rerun()
 
+    if "last_stream_metrics" in st.session_state:
+        st.caption(f"Last reply: {format_metrics(st.session_state.last_stream_metrics)}")
+    image_stats = st.session_state.image_history.stats()
+    if image_stats["images"]:
+        st.caption(
+            f"Images: {image_stats['images']} attached · "
+            f"{image_stats['bytes_sent'] // 1024} KB sent · "
+            f"{image_stats['bytes_saved'] // 1024} KB saved by resizing"
+        )
+
     st.divider()
     st.caption("Powered by Google Gemini 2.0 Flash 🧠")
     st.caption("Built with ❤️ using Streamlit")
@@ -0,0 +1,205 @@
+"""Native Gemini conversation format and explicit context caching.
+
+Gemini takes the system prompt as ``system_instruction`` and the history as
+role-tagged contents, so the stable prefix (system prompt plus earlier
+turns) is byte-identical from turn to turn. Gemini 2.5 then serves it from
+its implicit prefix cache and bills those tokens as cached.
+
+With GEMINI_CONTEXT_CACHE=1 the prefix is also stored as an explicit
+CachedContent once the uncached part of it reaches GEMINI_CACHE_MIN_TOKENS
+(the provider's minimum cache size). Later turns that extend a cached prefix
+send only the new turns. Explicit caches are billed for storage, which is why
+they are opt-in. Any caching error disables caching for the process and
+requests go out uncached.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from context_manager import count_tokens
+from metrics import observe_token_usage
+from provider_clients import get_gemini_model, get_registry
+
+logger = logging.getLogger(__name__)
+
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0").lower() in ("1", "true", "yes")
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CACHE_MIN_TOKENS", "1024"))
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", "900"))
+GEMINI_CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "64"))
+
+
+def to_gemini_contents(messages: list):
+    """Split chat-completion messages into (system_instruction, contents).
+
+    The leading system message becomes the system instruction. Later system
+    messages (e.g. the rolling context summary) become user-side context,
+    because Gemini contents only have "user" and "model" roles. Consecutive
+    turns with the same role are merged into one content.
+    """
+    system_instruction = None
+    if messages and messages[0].get("role") == "system":
+        system_instruction = messages[0].get("content", "")
+        messages = messages[1:]
+    contents = []
+    for m in messages:
+        role = "model" if m.get("role") == "assistant" else "user"
+        text = str(m.get("content", ""))
+        if m.get("role") == "system":
+            text = f"[Context]\n{text}"
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"].append(text)
+        else:
+            contents.append({"role": role, "parts": [text]})
+    return system_instruction, contents
+
+
+def record_gemini_usage(response):
+    """Report a response's (or last stream chunk's) usage_metadata."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    observe_token_usage(
+        "gemini",
+        prompt=getattr(usage, "prompt_token_count", 0),
+        completion=getattr(usage, "candidates_token_count", 0),
+        cached=getattr(usage, "cached_content_token_count", 0),
+    )
+
+
+def _content_tokens(content: dict) -> int:
+    return sum(count_tokens(part) for part in content["parts"])
+
+
+class _Entry:
+    def __init__(self, cached, length, expires):
+        self.cached = cached
+        self.length = length
+        self.expires = expires
+
+
+class ContextCache:
+    def __init__(self, enabled=GEMINI_CONTEXT_CACHE, min_tokens=GEMINI_CACHE_MIN_TOKENS,
+                 ttl=GEMINI_CACHE_TTL, max_entries=GEMINI_CACHE_MAX_ENTRIES):
+        self.enabled = enabled
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # prefix hash -> _Entry
+        self._creating = set()          # prefix hashes being created right now
+        self._lock = threading.Lock()
+        self.created = 0
+        self.hits = 0
+
+    @staticmethod
+    def _prefix_hashes(api_key, model_name, system_instruction, contents):
+        """hashes[i] identifies key + system instruction + contents[:i + 1].
+
+        Cached contents belong to the API key that created them, so the key
+        (hashed) is part of every prefix hash.
+        """
+        key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()
+        digest = hashlib.sha256(
+            f"{key_hash}\x00{model_name}\x00{system_instruction or ''}".encode("utf-8")
+        )
+        hashes = []
+        for content in contents:
+            digest.update(json.dumps(content, sort_keys=True).encode("utf-8"))
+            hashes.append(digest.copy().hexdigest())
+        return hashes
+
+    def _lookup(self, hashes, now):
+        for i in range(len(hashes) - 1, -1, -1):
+            entry = self._entries.get(hashes[i])
+            if entry is None:
+                continue
+            if entry.expires <= now:
+                del self._entries[hashes[i]]
+                continue
+            self._entries.move_to_end(hashes[i])
+            return entry
+        return None
+
+    def _create(self, model_name, system_instruction, prefix, key, now):
+        """Create a CachedContent (a blocking network call; never under the lock)."""
+        from google.generativeai import caching
+
+        cached = caching.CachedContent.create(
+            model=f"models/{model_name}",
+            system_instruction=system_instruction,
+            contents=prefix,
+            ttl=datetime.timedelta(seconds=self.ttl),
+        )
+        # Expire locally a little early so a request never races the TTL
+        entry = _Entry(cached, len(prefix), now + self.ttl * 0.9)
+        evicted = []
+        with self._lock:
+            self._entries[key] = entry
+            self.created += 1
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[1])
+        for old in evicted:
+            try:
+                old.cached.delete()
+            except Exception:
+                logger.debug("could not delete cached content", exc_info=True)
+        return entry
+
+    def model_for(self, api_key, model_name, system_instruction, contents):
+        """Return (model, contents to send), serving the longest cached prefix
+        of ``contents`` from an explicit cache when one is available."""
+        if not self.enabled or get_registry().fake is not None or len(contents) < 2:
+            return get_gemini_model(api_key, model_name, system_instruction), contents
+
+        # Configures the SDK for this key as a side effect
+        get_gemini_model(api_key, model_name, system_instruction)
+        hashes = self._prefix_hashes(api_key, model_name, system_instruction, contents)
+        now = time.monotonic()
+        create_key = None
+        try:
+            with self._lock:
+                entry = self._lookup(hashes[:-1], now)
+                start = entry.length if entry is not None else 0
+                uncached = sum(_content_tokens(c) for c in contents[start:-1])
+                if entry is None:
+                    uncached += count_tokens(system_instruction or "")
+                # Another request already creating this prefix: go on without it
+                if uncached >= self.min_tokens and hashes[-2] not in self._creating:
+                    create_key = hashes[-2]
+                    self._creating.add(create_key)
+                elif entry is not None:
+                    self.hits += 1
+            if create_key is not None:
+                entry = self._create(model_name, system_instruction, contents[:-1], create_key, now)
+            if entry is None:
+                return get_gemini_model(api_key, model_name, system_instruction), contents
+            import google.generativeai as genai
+            return genai.GenerativeModel.from_cached_content(entry.cached), contents[entry.length:]
+        except Exception as e:
+            logger.warning("Gemini context caching disabled: %s", e)
+            self.enabled = False
+            return get_gemini_model(api_key, model_name, system_instruction), contents
+        finally:
+            if create_key is not None:
+                with self._lock:
+                    self._creating.discard(create_key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "created": self.created,
+                "hits": self.hits,
+            }
+
+
+_context_cache = ContextCache()
+
+
+def get_context_cache() -> ContextCache:
+    return _context_cache
@@ -0,0 +1,185 @@
+"""Upload preprocessing and history pruning for image turns.
+
+Phone photos arrive as multi-megabyte, 4000px images, and Gemini downsamples
+them anyway. Uploads are downsized to IMAGE_MAX_DIM and re-encoded as JPEG at
+IMAGE_JPEG_QUALITY before they are sent, and each distinct image (by hash of
+the uploaded bytes) is attached to the conversation only once, on the turn
+where it first appears.
+
+An image's bytes go upstream once. By default they are sent inline only
+with the turn that uploads the image; on later turns it is replaced by a
+short text note, since the model's earlier replies already describe it. With
+IMAGE_USE_FILE_API set, each image is instead uploaded once through the
+Gemini File API, and the IMAGE_HISTORY_KEEP most recent images stay in the
+history as references to those files (older ones become notes).
+"""
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+IMAGE_MAX_DIM = int(os.getenv("IMAGE_MAX_DIM", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_HISTORY_KEEP = int(os.getenv("IMAGE_HISTORY_KEEP", "1"))
+IMAGE_USE_FILE_API = os.getenv("IMAGE_USE_FILE_API", "").lower() in ("1", "true", "yes")
+# Prepared uploads kept so reruns do not re-encode the same file
+IMAGE_CACHE_ENTRIES = 32
+
+
+class PreparedImage:
+    def __init__(self, digest, data, mime_type, size, original_bytes):
+        self.digest = digest
+        self.data = data
+        self.mime_type = mime_type
+        self.size = size                    # (width, height) after resizing
+        self.original_bytes = original_bytes
+
+    def part(self) -> dict:
+        """Inline blob part for generate_content."""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def note(self) -> str:
+        """Text left in place of the image once it is pruned."""
+        return f"[Image {self.digest[:8]} shared earlier in this conversation]"
+
+
+def _encode(data: bytes, max_dim: int, quality: int):
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        original_size = image.size
+        # Phone cameras store rotation in EXIF, which is dropped on re-encode
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_dim, max_dim), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=quality, optimize=True)
+        return out.getvalue(), image.size, original_size
+
+
+_prepared = OrderedDict()   # (digest, max_dim, quality) -> PreparedImage
+_prepared_lock = threading.Lock()
+
+
+def prepare_image(data: bytes, max_dim=IMAGE_MAX_DIM, quality=IMAGE_JPEG_QUALITY) -> PreparedImage:
+    """Downsized JPEG for ``data`` (the raw uploaded file)."""
+    digest = hashlib.sha256(data).hexdigest()
+    key = (digest, max_dim, quality)
+    with _prepared_lock:
+        prepared = _prepared.get(key)
+        if prepared is not None:
+            _prepared.move_to_end(key)
+            return prepared
+    encoded, size, original_size = _encode(data, max_dim, quality)
+    if len(encoded) >= len(data) and size == original_size:
+        # Already small; re-encoding would only lose quality
+        encoded, mime_type = data, _mime_type(data)
+    else:
+        mime_type = "image/jpeg"
+    prepared = PreparedImage(digest, encoded, mime_type, size, len(data))
+    with _prepared_lock:
+        _prepared[key] = prepared
+        while len(_prepared) > IMAGE_CACHE_ENTRIES:
+            _prepared.popitem(last=False)
+    return prepared
+
+
+def _mime_type(data: bytes) -> str:
+    return "image/png" if data.startswith(b"\x89PNG") else "image/jpeg"
+
+
+def upload_to_gemini(image: PreparedImage):
+    """Upload ``image`` through the Gemini File API; the returned file can be
+    used as a content part for as long as Gemini keeps it (48 hours)."""
+    import google.generativeai as genai
+
+    return genai.upload_file(
+        io.BytesIO(image.data), mime_type=image.mime_type, display_name=image.digest[:16]
+    )
+
+
+# ---------------------------
+# Conversation history
+# ---------------------------
+class ImageHistory:
+    """Gemini contents for one conversation, with each image attached once.
+
+    ``add_user(text, image)`` attaches ``image`` only if this conversation
+    has not seen its digest before. ``contents()`` returns the history to
+    send: an image's bytes go inline only while its turn is the newest one.
+    Given ``upload`` (e.g. ``upload_to_gemini``), images are uploaded once
+    instead and the newest ``keep`` are referenced on every turn; the rest
+    are replaced by text notes.
+    """
+
+    def __init__(self, keep=IMAGE_HISTORY_KEEP, upload=None):
+        self.keep = keep
+        self.upload = upload
+        self.turns = []     # {"role", "text", "image": PreparedImage | None}
+        self.seen = set()
+        self.files = {}     # digest -> uploaded file handle
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+
+    def add_user(self, text: str, image: PreparedImage = None) -> bool:
+        """Record a user turn; True if ``image`` was attached to it."""
+        attach = image is not None and image.digest not in self.seen
+        if attach:
+            self.seen.add(image.digest)
+            self.bytes_saved += image.original_bytes - len(image.data)
+        self.turns.append({"role": "user", "text": text, "image": image if attach else None})
+        return attach
+
+    def add_model(self, text: str):
+        self.turns.append({"role": "model", "text": text, "image": None})
+
+    def drop_last(self):
+        """Forget the last turn, e.g. a user turn whose reply failed."""
+        turn = self.turns.pop()
+        image = turn["image"]
+        if image is not None:
+            self.seen.discard(image.digest)
+            self.bytes_saved -= image.original_bytes - len(image.data)
+
+    def _file_for(self, image: PreparedImage):
+        handle = self.files.get(image.digest)
+        if handle is None:
+            handle = self.files[image.digest] = self.upload(image)
+            self.bytes_sent += len(image.data)
+        return handle
+
+    def contents(self) -> list:
+        with_images = [i for i, t in enumerate(self.turns) if t["image"] is not None]
+        kept = set(with_images[-self.keep:]) if self.keep > 0 else set()
+        newest = len(self.turns) - 1
+        contents = []
+        for i, turn in enumerate(self.turns):
+            parts = [turn["text"]]
+            image = turn["image"]
+            # Gemini reads an image best when it comes before the question
+            if image is not None:
+                if self.upload is not None and i in kept:
+                    parts.insert(0, self._file_for(image))
+                elif self.upload is None and i == newest:
+                    # The turn that uploads it; later turns only get the note
+                    parts.insert(0, image.part())
+                    self.bytes_sent += len(image.data)
+                else:
+                    parts.insert(0, image.note())
+            contents.append({"role": turn["role"], "parts": parts})
+        return contents
+
+    def stats(self) -> dict:
+        return {
+            "images": len(self.seen),
+            "files_uploaded": len(self.files),
+            "bytes_sent": self.bytes_sent,
+            "bytes_saved": self.bytes_saved,
+        }
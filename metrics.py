@@ -0,0 +1,319 @@
+"""Per-stage latency metrics for chat turns and triage generation.
+
+Stages are timed with ``span()``:
+
+    with span("pdf_build", session_id=session_id):
+        ...
+
+Each span feeds a latency histogram (labelled by stage and provider), bumps
+request/error counters for LLM stages, and writes one JSON log line keyed by
+session_id. Everything is process-wide, so all Streamlit sessions aggregate
+into the same series.
+
+Exposure (both optional, configured by env):
+  METRICS_PORT      serve Prometheus text format on http://0.0.0.0:<port>/metrics
+  METRICS_FILE      rewrite Prometheus text to this file at most every 5 seconds
+  METRICS_JSON_LOG  append structured span logs to this file
+"""
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+PREFIX = "medical_assistant"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+PDF_SIZE_BUCKETS = (10_000, 25_000, 50_000, 100_000, 250_000, 500_000, 1_000_000)
+FILE_FLUSH_INTERVAL = 5.0
+
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_JSON_LOG = os.getenv("METRICS_JSON_LOG")
+# Sessions whose last-turn token usage is kept for the UI
+USAGE_SESSIONS = 1000
+
+span_logger = logging.getLogger("medical_assistant.spans")
+
+# Session id for spans that do not pass one explicitly (e.g. deep inside
+# chat_engine). Worker threads get it via contextvars.copy_context().
+current_session_id = contextvars.ContextVar("current_session_id", default=None)
+
+
+# ---------------------------
+# Primitives
+# ---------------------------
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {}    # (stage, provider) -> Histogram
+        self.pdf_size = Histogram(PDF_SIZE_BUCKETS)
+        self.requests = {}   # provider -> count
+        self.errors = {}     # (provider, stage) -> count
+        self.tokens = {}     # (provider, kind) -> count
+
+    def observe_latency(self, stage, provider, seconds):
+        with self._lock:
+            hist = self.latency.get((stage, provider))
+            if hist is None:
+                hist = self.latency[(stage, provider)] = Histogram(LATENCY_BUCKETS)
+            hist.observe(seconds)
+
+    def observe_pdf_size(self, size):
+        with self._lock:
+            self.pdf_size.observe(size)
+
+    def count_request(self, provider):
+        with self._lock:
+            self.requests[provider] = self.requests.get(provider, 0) + 1
+
+    def count_error(self, provider, stage):
+        with self._lock:
+            key = (provider, stage)
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def count_tokens(self, provider, kind, count):
+        with self._lock:
+            key = (provider, kind)
+            self.tokens[key] = self.tokens.get(key, 0) + count
+
+    # ---------------- exposition ----------------
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            name = f"{PREFIX}_stage_duration_seconds"
+            lines += [f"# HELP {name} Latency of pipeline stages.", f"# TYPE {name} histogram"]
+            for (stage, provider), hist in sorted(self.latency.items(), key=lambda i: (i[0][0], i[0][1] or "")):
+                labels = f'stage="{stage}",provider="{provider or ""}"'
+                lines += _histogram_lines(name, labels, hist)
+
+            name = f"{PREFIX}_pdf_size_bytes"
+            lines += [f"# HELP {name} Size of generated triage PDFs.", f"# TYPE {name} histogram"]
+            lines += _histogram_lines(name, "", self.pdf_size)
+
+            name = f"{PREFIX}_llm_requests_total"
+            lines += [f"# HELP {name} LLM requests by provider.", f"# TYPE {name} counter"]
+            for provider, count in sorted(self.requests.items()):
+                lines.append(f'{name}{{provider="{provider}"}} {count}')
+
+            name = f"{PREFIX}_errors_total"
+            lines += [f"# HELP {name} Failed stages by provider.", f"# TYPE {name} counter"]
+            for (provider, stage), count in sorted(self.errors.items(), key=lambda i: (i[0][0] or "", i[0][1])):
+                lines.append(f'{name}{{provider="{provider or ""}",stage="{stage}"}} {count}')
+
+            name = f"{PREFIX}_llm_tokens_total"
+            lines += [f"# HELP {name} Provider-reported tokens by kind (prompt, cached, completion).",
+                      f"# TYPE {name} counter"]
+            for (provider, kind), count in sorted(self.tokens.items()):
+                lines.append(f'{name}{{provider="{provider}",kind="{kind}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(name, labels, hist):
+    sep = "," if labels else ""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(hist.buckets, hist.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {hist.count}')
+    suffix = f"{{{labels}}}" if labels else ""
+    lines.append(f"{name}_sum{suffix} {hist.total}")
+    lines.append(f"{name}_count{suffix} {hist.count}")
+    return lines
+
+
+_registry = Registry()
+
+
+def get_metrics() -> Registry:
+    return _registry
+
+
+# ---------------------------
+# Spans
+# ---------------------------
+def _log_span(record: dict):
+    if span_logger.isEnabledFor(logging.INFO):
+        span_logger.info(json.dumps(record, separators=(",", ":"), default=str))
+
+
+@contextmanager
+def span(stage: str, session_id=None, provider=None, llm=False, **fields):
+    """Time a stage; ``llm=True`` also counts it as a provider request."""
+    session_id = session_id or current_session_id.get()
+    if llm:
+        _registry.count_request(provider)
+    status = "ok"
+    t0 = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as e:
+        # st.stop()/st.rerun() raise control-flow exceptions; not errors
+        if isinstance(e, Exception) and type(e).__name__ not in ("StopException", "RerunException"):
+            status = "error"
+            fields.setdefault("error", f"{type(e).__name__}: {e}")
+            _registry.count_error(provider, stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        _registry.observe_latency(stage, provider, elapsed)
+        _log_span({
+            "ts": time.time(),
+            "session_id": session_id,
+            "stage": stage,
+            "provider": provider,
+            "duration_ms": round(elapsed * 1000, 3),
+            "status": status,
+            **fields,
+        })
+        _maybe_write_file()
+
+
+def instrument_stream(chunks, stage: str, provider=None, session_id=None):
+    """Wrap a streaming generator so the whole stream is one timed LLM span."""
+    with span(stage, session_id=session_id, provider=provider, llm=True) as fields:
+        chars = 0
+        first = None
+        t0 = time.perf_counter()
+        for chunk in chunks:
+            if first is None:
+                first = time.perf_counter() - t0
+            chars += len(chunk)
+            yield chunk
+        fields["ttft_ms"] = round((first or 0.0) * 1000, 3)
+        fields["chars"] = chars
+
+
+async def instrument_stream_async(chunks, stage: str, provider=None, session_id=None):
+    """instrument_stream for async chunk streams."""
+    with span(stage, session_id=session_id, provider=provider, llm=True) as fields:
+        chars = 0
+        first = None
+        t0 = time.perf_counter()
+        async for chunk in chunks:
+            if first is None:
+                first = time.perf_counter() - t0
+            chars += len(chunk)
+            yield chunk
+        fields["ttft_ms"] = round((first or 0.0) * 1000, 3)
+        fields["chars"] = chars
+
+
+def observe_pdf_size(size: int, session_id=None):
+    _registry.observe_pdf_size(size)
+    _log_span({
+        "ts": time.time(),
+        "session_id": session_id or current_session_id.get(),
+        "stage": "pdf_size",
+        "bytes": size,
+    })
+
+
+_last_usage = OrderedDict()   # session_id -> usage of its latest LLM call
+_usage_lock = threading.Lock()
+
+
+def observe_token_usage(provider, prompt=0, completion=0, cached=0, session_id=None):
+    """Record provider-reported token counts for one LLM call.
+
+    ``cached`` is the part of ``prompt`` served from the provider's prompt
+    cache.
+    """
+    session_id = session_id or current_session_id.get()
+    usage = {"provider": provider, "prompt": prompt or 0, "cached": cached or 0,
+             "completion": completion or 0}
+    for kind in ("prompt", "cached", "completion"):
+        if usage[kind]:
+            _registry.count_tokens(provider, kind, usage[kind])
+    if session_id is not None:
+        with _usage_lock:
+            _last_usage[session_id] = usage
+            _last_usage.move_to_end(session_id)
+            while len(_last_usage) > USAGE_SESSIONS:
+                _last_usage.popitem(last=False)
+    _log_span({"ts": time.time(), "session_id": session_id, "stage": "token_usage", **usage})
+
+
+def last_token_usage(session_id):
+    with _usage_lock:
+        return _last_usage.get(session_id)
+
+
+# ---------------------------
+# Exposure
+# ---------------------------
+_last_file_write = 0.0
+_file_lock = threading.Lock()
+
+
+def _maybe_write_file():
+    global _last_file_write
+    if not METRICS_FILE:
+        return
+    now = time.monotonic()
+    if now - _last_file_write < FILE_FLUSH_INTERVAL:
+        return
+    with _file_lock:
+        if now - _last_file_write < FILE_FLUSH_INTERVAL:
+            return
+        _last_file_write = now
+        tmp = f"{METRICS_FILE}.tmp"
+        with open(tmp, "w") as f:
+            f.write(_registry.render_prometheus())
+        os.replace(tmp, METRICS_FILE)
+
+
+def start_http_server(port: int):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("", "/metrics"):
+                self.send_error(404)
+                return
+            body = _registry.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+# Module import happens once per process, so this runs once even though the
+# Streamlit script reruns on every interaction.
+if METRICS_JSON_LOG:
+    _handler = logging.FileHandler(METRICS_JSON_LOG)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    span_logger.addHandler(_handler)
+    span_logger.setLevel(logging.INFO)
+    span_logger.propagate = False
+
+if METRICS_PORT:
+    try:
+        start_http_server(int(METRICS_PORT))
+    except OSError as e:
+        logging.getLogger(__name__).warning("metrics endpoint not started: %s", e)
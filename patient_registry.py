@@ -0,0 +1,153 @@
+"""Process-wide patient registry backed by patients.csv.
+
+The CSV is loaded once per process and reloaded only when its mtime/size
+changes. Lookups by id and by normalized name are dict hits; prefix and
+trigram indexes back the "did you mean" search in Chatbot.py.
+"""
+import bisect
+import csv
+import os
+import threading
+from collections import defaultdict
+
+PATIENT_FILE = "patients.csv"
+
+
+def normalize_name(name) -> str:
+    return " ".join(str(name).lower().split())
+
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class PatientRegistry:
+    def __init__(self, path=PATIENT_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None
+        self.reloads = 0
+        self._by_id = {}
+        self._by_name = {}
+        self._sorted_names = []
+        self._trigram_index = {}
+
+    # ---------------- loading ----------------
+    def _file_signature(self):
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _ensure_loaded(self):
+        signature = self._file_signature()
+        if signature == self._signature:
+            return
+        with self._lock:
+            if signature == self._signature:
+                return
+            self._load()
+            self._signature = signature
+            self.reloads += 1
+
+    def _load(self):
+        by_id = {}
+        by_name = {}
+        trigram_index = defaultdict(set)
+        # Plain csv is enough for four columns and keeps pandas off this path
+        with open(self.path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        for row in rows:
+            patient = {
+                "patient_id": int(row["patient_id"]),
+                "patient_name": row["patient_name"].strip(),
+                "age": int(row["age"]),
+                "sex": row["sex"].strip(),
+            }
+            by_id[patient["patient_id"]] = patient
+            key = normalize_name(patient["patient_name"])
+            # First row wins on duplicate names, as the old .iloc[0] did
+            if key not in by_name:
+                by_name[key] = patient
+                for gram in trigrams(key):
+                    trigram_index[gram].add(key)
+
+        # Swap in whole indexes so concurrent readers never see a half-built one
+        self._by_id = by_id
+        self._by_name = by_name
+        self._sorted_names = sorted(by_name)
+        self._trigram_index = dict(trigram_index)
+
+    # ---------------- lookups ----------------
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def get_by_id(self, patient_id):
+        self._ensure_loaded()
+        try:
+            return self._by_id.get(int(patient_id))
+        except (TypeError, ValueError):
+            return None
+
+    def get_by_name(self, name):
+        self._ensure_loaded()
+        return self._by_name.get(normalize_name(name))
+
+    def search_prefix(self, prefix, limit=10) -> list:
+        self._ensure_loaded()
+        prefix = normalize_name(prefix)
+        if not prefix:
+            return []
+        names = self._sorted_names
+        start = bisect.bisect_left(names, prefix)
+        results = []
+        for key in names[start:start + limit]:
+            if not key.startswith(prefix):
+                break
+            results.append(self._by_name[key])
+        return results
+
+    def search_fuzzy(self, query, limit=5, min_score=0.3) -> list:
+        """Trigram (Jaccard) similarity search over normalized names."""
+        self._ensure_loaded()
+        query = normalize_name(query)
+        if not query:
+            return []
+        query_grams = trigrams(query)
+        overlap = defaultdict(int)
+        for gram in query_grams:
+            for key in self._trigram_index.get(gram, ()):
+                overlap[key] += 1
+
+        scored = []
+        for key, shared in overlap.items():
+            score = shared / (len(query_grams) + len(trigrams(key)) - shared)
+            if score >= min_score:
+                scored.append((score, key))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [self._by_name[key] for _, key in scored[:limit]]
+
+    def suggest(self, query, limit=5) -> list:
+        """Prefix matches first, then fuzzy matches, without duplicates."""
+        seen = set()
+        results = []
+        for patient in self.search_prefix(query, limit) + self.search_fuzzy(query, limit):
+            if patient["patient_id"] not in seen:
+                seen.add(patient["patient_id"])
+                results.append(patient)
+        return results[:limit]
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._by_id)
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_patient_registry(path=PATIENT_FILE) -> PatientRegistry:
+    with _registries_lock:
+        registry = _registries.get(path)
+        if registry is None:
+            registry = _registries[path] = PatientRegistry(path)
+        return registry
@@ -0,0 +1,88 @@
+"""In-memory cache of rendered triage PDFs.
+
+Reports are keyed on a hash of (parsed sections, patient info, template
+version), so reruns and repeated downloads of the same report reuse the bytes
+instead of rebuilding the ReportLab document. Memory is bounded by total PDF
+size with least-recently-used eviction.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+
+def pdf_cache_key(sections: dict, patient_info: dict, template_version: str) -> str:
+    payload = json.dumps(
+        {
+            # Section order matters for the rendered document
+            "sections": [[title, list(lines)] for title, lines in sections.items()],
+            "patient": patient_info,
+            "template": template_version,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PDFCache:
+    def __init__(self, max_bytes=PDF_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            if len(data) > self.max_bytes:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old)
+            self._entries[key] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+                self.evictions += 1
+
+    def get_or_build(self, key: str, build) -> bytes:
+        data = self.get(key)
+        if data is None:
+            data = build()
+            self.put(key, data)
+        return data
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+_pdf_cache = PDFCache()
+
+
+def get_pdf_cache() -> PDFCache:
+    return _pdf_cache
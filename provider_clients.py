@@ -0,0 +1,211 @@
+"""Process-wide registry of Groq / Gemini clients.
+
+Streamlit re-executes the page script on every rerun, so module globals in
+Chatbot.py reset each turn. Imported modules, however, stay in sys.modules
+for the life of the server process, so clients registered here (and their
+pooled keep-alive HTTP connections) are shared by every session and by both
+Chatbot.py and triage_module.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "20"))
+POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "10"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "120"))
+REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+# One GenerativeModel per (key, model, system instruction); callers with
+# per-request instructions would otherwise grow this without bound
+GEMINI_MODEL_CACHE_SIZE = int(os.getenv("GEMINI_MODEL_CACHE_SIZE", "32"))
+
+
+class MissingAPIKeyError(RuntimeError):
+    """A provider was selected but its API key is not configured."""
+
+
+_env_loaded = False
+
+
+def load_env_once(path=".env"):
+    """Load .env on the first call in this process; later reruns are no-ops."""
+    global _env_loaded
+    if not _env_loaded:
+        from dotenv import load_dotenv
+        load_dotenv(path)
+        _env_loaded = True
+
+
+def _key_id(api_key: str) -> str:
+    # Never keep raw keys as dict keys that might end up in logs or stats
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+class ClientRegistry:
+    def __init__(self, max_connections=POOL_MAX_CONNECTIONS,
+                 max_keepalive=POOL_MAX_KEEPALIVE,
+                 keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+                 max_gemini_models=GEMINI_MODEL_CACHE_SIZE):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.max_gemini_models = max_gemini_models
+        self._clients = {}
+        # Models share genai's global transport, so evicting one closes nothing
+        self._gemini_models = OrderedDict()   # least recently used first
+        self._gemini_key = None
+        self.fake = None
+        self._lock = threading.Lock()
+        self.clients_created = 0
+        self.clients_reused = 0
+        self.gemini_models_evicted = 0
+        self.http_requests = 0
+        self.connections_opened = 0
+
+    # ---------------- connection accounting ----------------
+    def _trace(self, event_name, info):
+        # httpcore emits this only when a brand-new TCP connection is made
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.connections_opened += 1
+
+    def _on_request(self, request):
+        with self._lock:
+            self.http_requests += 1
+        request.extensions["trace"] = self._trace
+
+    async def _on_request_async(self, request):
+        self._on_request(request)
+
+    def _limits(self):
+        import httpx
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def _get_or_create(self, key, factory):
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self.clients_reused += 1
+                return client
+            client = factory()
+            self._clients[key] = client
+            self.clients_created += 1
+            return client
+
+    # ---------------- providers ----------------
+    def groq(self, api_key: str):
+        if self.fake is not None:
+            return self.fake.groq()
+        if not api_key:
+            raise MissingAPIKeyError("GROQ_API_KEY is not set.")
+
+        def factory():
+            import httpx
+            from groq import Groq
+            http_client = httpx.Client(
+                limits=self._limits(),
+                timeout=REQUEST_TIMEOUT,
+                event_hooks={"request": [self._on_request]},
+            )
+            return Groq(api_key=api_key, http_client=http_client)
+
+        return self._get_or_create(("groq", _key_id(api_key)), factory)
+
+    def async_groq(self, api_key: str):
+        if self.fake is not None:
+            return self.fake.async_groq()
+        if not api_key:
+            raise MissingAPIKeyError("GROQ_API_KEY is not set.")
+
+        def factory():
+            import httpx
+            from groq import AsyncGroq
+            http_client = httpx.AsyncClient(
+                limits=self._limits(),
+                timeout=REQUEST_TIMEOUT,
+                event_hooks={"request": [self._on_request_async]},
+            )
+            return AsyncGroq(api_key=api_key, http_client=http_client)
+
+        return self._get_or_create(("async_groq", _key_id(api_key)), factory)
+
+    def gemini(self, api_key: str, model_name: str = "gemini-2.5-flash",
+               system_instruction: str = None):
+        if self.fake is not None:
+            return self.fake.gemini(model_name, system_instruction)
+        if not api_key:
+            raise MissingAPIKeyError("GEMINI_API_KEY is not set.")
+
+        def factory():
+            import google.generativeai as genai
+            # genai.configure swaps the global transport; only do it when the
+            # key actually changes so the underlying gRPC channel is kept.
+            if self._gemini_key != _key_id(api_key):
+                genai.configure(api_key=api_key)
+                self._gemini_key = _key_id(api_key)
+            return genai.GenerativeModel(model_name, system_instruction=system_instruction)
+
+        sys_id = hashlib.sha256((system_instruction or "").encode("utf-8")).hexdigest()[:12]
+        key = (_key_id(api_key), model_name, sys_id)
+        with self._lock:
+            model = self._gemini_models.get(key)
+            if model is not None:
+                self._gemini_models.move_to_end(key)
+                self.clients_reused += 1
+                return model
+            model = self._gemini_models[key] = factory()
+            self.clients_created += 1
+            while len(self._gemini_models) > self.max_gemini_models:
+                self._gemini_models.popitem(last=False)
+                self.gemini_models_evicted += 1
+            return model
+
+    def stats(self) -> dict:
+        with self._lock:
+            reused = max(self.http_requests - self.connections_opened, 0)
+            return {
+                "clients": len(self._clients) + len(self._gemini_models),
+                "gemini_models": len(self._gemini_models),
+                "gemini_models_evicted": self.gemini_models_evicted,
+                "clients_created": self.clients_created,
+                "clients_reused": self.clients_reused,
+                "http_requests": self.http_requests,
+                "connections_opened": self.connections_opened,
+                "connections_reused": reused,
+                "connection_reuse_rate": (reused / self.http_requests) if self.http_requests else 0.0,
+                "pool_max_connections": self.max_connections,
+                "pool_max_keepalive": self.max_keepalive,
+            }
+
+
+_registry = ClientRegistry()
+
+if os.getenv("LLM_FAKE_PROVIDER", "").lower() in ("1", "true", "yes"):
+    from fake_provider import FakeProvider
+    _registry.fake = FakeProvider.from_env()
+
+
+def get_registry() -> ClientRegistry:
+    return _registry
+
+
+def use_fake_provider(fake):
+    """Route every client lookup to an offline fake (None restores real SDKs)."""
+    _registry.fake = fake
+
+
+def get_groq_client(api_key: str):
+    return _registry.groq(api_key)
+
+
+def get_async_groq_client(api_key: str):
+    return _registry.async_groq(api_key)
+
+
+def get_gemini_model(api_key: str, model_name: str = "gemini-2.5-flash",
+                     system_instruction: str = None):
+    return _registry.gemini(api_key, model_name, system_instruction)
@@ -0,0 +1,383 @@
+"""Latency-aware routing and hedged requests between Gemini and Groq.
+
+Every uncached provider stream reports its time to first token (or its
+failure) to a process-wide LatencyTracker. The "Auto" model choice then:
+
+1. routes the primary request to whichever provider currently has the lower
+   recent median time to first token, and
+2. if the primary has produced nothing after its own HEDGE_PERCENTILE latency,
+   starts the same request on the other provider, streams whichever answers
+   first, and cancels the loser.
+
+Streams run on worker threads that feed queues, because provider SDK
+iterators block. Cancelling a worker runs the aborts its stream registered
+with ``on_cancel()`` (closing the HTTP response), so a stalled loser gives up
+its connection and scheduler slot at once instead of at its next chunk.
+``routed_stream_async`` does the same for async streams by cancelling their
+tasks.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+PROVIDERS = ("gemini", "groq")
+ROUTING_WINDOW = int(os.getenv("ROUTING_WINDOW", "50"))
+ROUTING_MIN_SAMPLES = int(os.getenv("ROUTING_MIN_SAMPLES", "5"))
+HEDGE_ENABLED = os.getenv("ROUTING_HEDGE", "1").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.9"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "3.0"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.5"))
+# Share of Auto requests sent to the slower provider so a recovered provider
+# is noticed; hedging caps what these probes cost the user.
+ROUTING_EXPLORE_RATE = float(os.getenv("ROUTING_EXPLORE_RATE", "0.05"))
+# Recorded as a failed call's latency so a failing provider loses routing
+FAILURE_PENALTY_S = float(os.getenv("ROUTING_FAILURE_PENALTY", "30"))
+
+_DONE = object()
+
+logger = logging.getLogger(__name__)
+# The hedge worker whose thread is running the current stream, if any
+_current_worker = contextvars.ContextVar("hedge_worker", default=None)
+
+
+# ---------------------------
+# Latency tracking
+# ---------------------------
+class LatencyTracker:
+    def __init__(self, window=ROUTING_WINDOW):
+        self._lock = threading.Lock()
+        self._samples = {p: deque(maxlen=window) for p in PROVIDERS}
+        self.hedges_started = 0
+        self.hedges_won = 0
+
+    def record(self, provider: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(provider, deque(maxlen=ROUTING_WINDOW)).append(seconds)
+
+    def record_failure(self, provider: str):
+        self.record(provider, FAILURE_PENALTY_S)
+
+    def percentile(self, provider: str, q: float):
+        with self._lock:
+            samples = sorted(self._samples.get(provider, ()))
+        if len(samples) < ROUTING_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(q * (len(samples) - 1) + 0.5))]
+
+    def fastest(self, candidates=PROVIDERS) -> str:
+        """Lowest recent median; providers without enough samples go first so
+        both get measured."""
+        medians = {p: self.percentile(p, 0.5) for p in candidates}
+        unmeasured = [p for p in candidates if medians[p] is None]
+        if unmeasured:
+            with self._lock:
+                return min(unmeasured, key=lambda p: len(self._samples.get(p, ())))
+        return min(candidates, key=lambda p: medians[p])
+
+    def hedge_delay(self, provider: str) -> float:
+        delay = self.percentile(provider, HEDGE_PERCENTILE)
+        if delay is None:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, delay)
+
+    def stats(self) -> dict:
+        out = {}
+        for p in PROVIDERS:
+            out[p] = {
+                "samples": len(self._samples.get(p, ())),
+                "p50_s": self.percentile(p, 0.5),
+                "p90_s": self.percentile(p, 0.9),
+            }
+        out["hedges_started"] = self.hedges_started
+        out["hedges_won"] = self.hedges_won
+        return out
+
+
+_tracker = LatencyTracker()
+
+
+def get_tracker() -> LatencyTracker:
+    return _tracker
+
+
+def track_stream(provider: str, chunks):
+    """Pass chunks through, recording time to first chunk or a failure."""
+    t0 = time.perf_counter()
+    first = True
+    try:
+        for chunk in chunks:
+            if first:
+                _tracker.record(provider, time.perf_counter() - t0)
+                first = False
+            yield chunk
+    except Exception:
+        if not _cancelled():
+            _tracker.record_failure(provider)
+        raise
+
+
+async def track_stream_async(provider: str, chunks):
+    """track_stream for async chunk streams."""
+    t0 = time.perf_counter()
+    first = True
+    try:
+        async for chunk in chunks:
+            if first:
+                _tracker.record(provider, time.perf_counter() - t0)
+                first = False
+            yield chunk
+    except Exception:
+        _tracker.record_failure(provider)
+        raise
+
+
+# ---------------------------
+# Hedged streaming
+# ---------------------------
+def on_cancel(abort):
+    """Run ``abort()`` if the hedge worker streaming in this thread is
+    cancelled, e.g. to close a provider response that is blocked reading.
+    Outside a hedge worker this does nothing."""
+    worker = _current_worker.get()
+    if worker is not None:
+        worker.add_abort(abort)
+
+
+def _cancelled() -> bool:
+    worker = _current_worker.get()
+    return worker is not None and worker.cancelled.is_set()
+
+
+class _StreamWorker:
+    def __init__(self, provider: str, make_stream, events: queue.Queue):
+        self.provider = provider
+        self.cancelled = threading.Event()
+        self.chunks = queue.Queue()
+        self.started = time.perf_counter()
+        self.first_chunk = threading.Event()
+        self._make_stream = make_stream
+        self._events = events
+        self._aborts = []
+        self._aborts_lock = threading.Lock()
+        # Carry the caller's context (metrics session id) into the worker
+        ctx = contextvars.copy_context()
+        ctx.run(_current_worker.set, self)
+        self._thread = threading.Thread(
+            target=ctx.run, args=(self._run,), name=f"hedge-{provider}", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        stream = None
+        announced = False
+        try:
+            stream = self._make_stream()
+            for chunk in stream:
+                if self.cancelled.is_set():
+                    break
+                if not announced:
+                    self.first_chunk.set()
+                    self._events.put((self.provider, None))
+                    announced = True
+                self.chunks.put(chunk)
+            if not announced:
+                # Finished without output; still wake the dispatcher
+                self._events.put((self.provider, None))
+        except Exception as e:
+            if self.cancelled.is_set():
+                # Raised by our own abort; nobody is waiting for this stream
+                pass
+            elif announced:
+                # Already streaming to the user; surface the error there
+                self.chunks.put(e)
+            else:
+                self._events.put((self.provider, e))
+        finally:
+            if stream is not None and hasattr(stream, "close"):
+                stream.close()
+            self.chunks.put(_DONE)
+
+    def add_abort(self, abort):
+        with self._aborts_lock:
+            if not self.cancelled.is_set():
+                self._aborts.append(abort)
+                return
+        # Cancelled before the stream got going
+        self._abort(abort)
+
+    def _abort(self, abort):
+        try:
+            abort()
+        except Exception:
+            logger.debug("aborting %s stream failed", self.provider, exc_info=True)
+
+    def cancel(self):
+        with self._aborts_lock:
+            if self.cancelled.is_set():
+                return
+            self.cancelled.set()
+            aborts, self._aborts = self._aborts, []
+        for abort in aborts:
+            self._abort(abort)
+
+    def drain(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is _DONE:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+
+def _pick_primary() -> str:
+    primary = _tracker.fastest()
+    if random.random() < ROUTING_EXPLORE_RATE:
+        primary = next(p for p in PROVIDERS if p != primary)
+    return primary
+
+
+def routed_stream(stream_for, hedge=HEDGE_ENABLED):
+    """Stream from the currently faster provider, hedging to the other one.
+
+    ``stream_for(provider)`` must return a fresh chunk iterator that raises
+    on provider errors.
+    """
+    primary = _pick_primary()
+    if not hedge:
+        yield from stream_for(primary)
+        return
+    secondary = next(p for p in PROVIDERS if p != primary)
+
+    events = queue.Queue()
+    workers = {primary: _StreamWorker(primary, lambda: stream_for(primary), events)}
+    deadline = time.monotonic() + _tracker.hedge_delay(primary)
+    errors = {}
+    winner = None
+
+    while winner is None:
+        if secondary not in workers:
+            timeout = max(0.0, deadline - time.monotonic())
+        else:
+            timeout = None
+        try:
+            provider, error = events.get(timeout=timeout)
+        except queue.Empty:
+            # Primary is slower than its own tail latency: hedge
+            _tracker.hedges_started += 1
+            workers[secondary] = _StreamWorker(secondary, lambda: stream_for(secondary), events)
+            continue
+        if error is None:
+            winner = provider
+            break
+        errors[provider] = error
+        if secondary not in workers:
+            # Primary failed outright; fall over immediately
+            workers[secondary] = _StreamWorker(secondary, lambda: stream_for(secondary), events)
+        elif len(errors) == len(workers):
+            raise errors[primary]
+
+    for provider, worker in workers.items():
+        if provider != winner:
+            worker.cancel()
+            if provider not in errors and not worker.first_chunk.is_set():
+                # The loser never reached its first token; its latency is at
+                # least this long, which keeps a stalled provider from
+                # looking unmeasured (and so preferred) forever.
+                _tracker.record(provider, time.perf_counter() - worker.started)
+    if winner == secondary and primary not in errors:
+        _tracker.hedges_won += 1
+    try:
+        yield from workers[winner].drain()
+    finally:
+        # Reader went away early (e.g. rerun); stop the producer too
+        workers[winner].cancel()
+
+
+async def _next_chunk(stream):
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return _DONE
+
+
+async def _close(stream, task=None):
+    if task is not None and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    await stream.aclose()
+
+
+async def routed_stream_async(stream_for, hedge=HEDGE_ENABLED):
+    """routed_stream for async streams; ``stream_for(provider)`` returns a
+    fresh async generator."""
+    primary = _pick_primary()
+    if not hedge:
+        async for chunk in stream_for(primary):
+            yield chunk
+        return
+    secondary = next(p for p in PROVIDERS if p != primary)
+
+    loop = asyncio.get_running_loop()
+    streams, started, pending = {}, {}, {}   # pending: first-chunk task -> provider
+
+    def _start(provider):
+        streams[provider] = stream_for(provider)
+        started[provider] = time.perf_counter()
+        pending[asyncio.ensure_future(_next_chunk(streams[provider]))] = provider
+
+    _start(primary)
+    deadline = loop.time() + _tracker.hedge_delay(primary)
+    errors = {}
+    winner = first = None
+    try:
+        while winner is None:
+            timeout = max(0.0, deadline - loop.time()) if secondary not in streams else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Primary is slower than its own tail latency: hedge
+                _tracker.hedges_started += 1
+                _start(secondary)
+                continue
+            for task in done:
+                provider = pending.pop(task)
+                try:
+                    first = task.result()
+                except Exception as e:
+                    errors[provider] = e
+                    continue
+                winner = provider
+                break
+            if winner is None:
+                if secondary not in streams:
+                    # Primary failed outright; fall over immediately
+                    _start(secondary)
+                elif len(errors) == len(streams):
+                    raise errors[primary]
+    finally:
+        losers = {provider: task for task, provider in pending.items()}
+        for provider, stream in streams.items():
+            if provider == winner:
+                continue
+            if provider in losers and not losers[provider].done():
+                # Same reasoning as routed_stream: a stalled loser's latency
+                # is at least this long
+                _tracker.record(provider, time.perf_counter() - started[provider])
+            await _close(stream, losers.get(provider))
+
+    if winner == secondary and primary not in errors:
+        _tracker.hedges_won += 1
+    stream = streams[winner]
+    try:
+        if first is not _DONE:
+            yield first
+            async for chunk in stream:
+                yield chunk
+    finally:
+        await stream.aclose()
@@ -0,0 +1,414 @@
+"""Process-wide rate-limit scheduler in front of the Groq and Gemini APIs.
+
+Every Streamlit session shares one server process, so without coordination
+a burst of sessions blows through the provider quotas and everyone gets 429s.
+Each model gets a lane with two token buckets (requests per minute and
+tokens per minute). Requests that do not fit wait in per-session queues that
+are served round-robin, so one session firing the summary, the detailed
+report and a context summarization at once cannot starve the others.
+
+A 429 that still gets through (other processes share the API key, or the
+estimate was low) pauses the whole lane for the provider's retry-after
+(plus jittered exponential backoff) and the request is retried, up to
+RATE_LIMIT_MAX_RETRIES times.
+
+While a request waits, the listener in ``queue_listener`` (a ContextVar, so
+it follows the request into worker threads) is called with
+``{"model", "position", "wait_s", "reason"}``, and with ``None`` once the
+request is sent. Chatbot.py and show_triage use it to show the user's queue
+position instead of an error.
+
+Coroutines (the HTTP API) use acquire_async, call_async and stream_async,
+which share the same lanes; a queued coroutine waits on a waiter thread
+rather than blocking the event loop.
+
+Limits default to the providers' free tiers and can be overridden with
+RATE_LIMITS="model=rpm/tpm,...", where 0 means unlimited.
+"""
+import asyncio
+import contextvars
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from context_manager import count_tokens, message_tokens
+from metrics import current_session_id
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMITS = {
+    "llama-3.3-70b-versatile": (30, 12_000),
+    "gemini-2.5-flash": (10, 250_000),
+}
+# Tokens reserved for the reply until the real size is known
+RATE_LIMIT_OUTPUT_TOKENS = int(os.getenv("RATE_LIMIT_OUTPUT_TOKENS", "600"))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "4"))
+BACKOFF_BASE_S = float(os.getenv("RATE_LIMIT_BACKOFF_BASE", "1.0"))
+BACKOFF_MAX_S = float(os.getenv("RATE_LIMIT_BACKOFF_MAX", "30.0"))
+# How often a waiting request re-reports its queue position
+STATUS_INTERVAL_S = 0.5
+# Threads that asyncio callers park on while queued, so waiting requests hold
+# neither the event loop nor its default executor
+ASYNC_WAITERS = int(os.getenv("RATE_LIMIT_ASYNC_WAITERS", "256"))
+
+_RATE_LIMIT_ERRORS = ("RateLimitError", "ResourceExhausted", "TooManyRequests")
+
+# Benchmarks against the fake provider measure the pipeline, not the quotas
+RATE_LIMITS_DISABLED = False
+
+queue_listener = contextvars.ContextVar("queue_listener", default=None)
+
+
+def _parse_limits(spec: str) -> dict:
+    limits = dict(DEFAULT_LIMITS)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, values = item.partition("=")
+        rpm, _, tpm = values.partition("/")
+        limits[model.strip()] = (int(rpm or 0), int(tpm or 0))
+    return limits
+
+
+# ---------------------------
+# Rate-limit errors
+# ---------------------------
+def is_rate_limited(error: BaseException) -> bool:
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    return status == 429 or type(error).__name__ in _RATE_LIMIT_ERRORS
+
+
+def retry_after(error: BaseException):
+    """Seconds the provider asked us to wait, if it said."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            parsed = email.utils.parsedate_to_datetime(value)
+            if parsed is not None:
+                return max(0.0, parsed.timestamp() - time.time())
+    # google.api_core errors carry a RetryInfo detail instead of a header
+    for detail in getattr(error, "details", None) or ():
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return None
+
+
+def backoff_delay(attempt: int, hint=None) -> float:
+    """Full-jitter exponential backoff, never shorter than the provider's hint."""
+    ceiling = min(BACKOFF_MAX_S, BACKOFF_BASE_S * (2 ** attempt))
+    return (hint or 0.0) + random.uniform(0, ceiling)
+
+
+# ---------------------------
+# Buckets and lanes
+# ---------------------------
+class TokenBucket:
+    """Refills ``per_minute`` units per minute up to one minute's worth.
+
+    The level may go negative when a request turns out bigger than its
+    estimate; later requests then wait for the debt to refill.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= amount
+
+    def give(self, amount: float):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class _Lane:
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.queues = {}      # session -> deque of tickets
+        self.ring = deque()   # sessions with waiting tickets, in service order
+        self.paused_until = 0.0
+
+    def wait_time(self, tokens: int, now: float) -> float:
+        wait = self.paused_until - now
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return wait
+
+    def take(self, tokens: int, now: float):
+        if self.requests is not None:
+            self.requests.take(1, now)
+        if self.tokens is not None:
+            self.tokens.take(tokens, now)
+
+    def position(self, session, ticket) -> int:
+        """Requests served before ``ticket`` under round-robin order."""
+        depth = self.queues[session].index(ticket)
+        rank = self.ring.index(session)
+        return sum(
+            min(len(self.queues[s]), depth + (1 if i < rank else 0))
+            for i, s in enumerate(self.ring)
+        )
+
+
+# ---------------------------
+# Scheduler
+# ---------------------------
+class RequestScheduler:
+    def __init__(self, limits=None):
+        self.limits = limits if limits is not None else _parse_limits(os.getenv("RATE_LIMITS", ""))
+        self._cond = threading.Condition()
+        self._lanes = {}
+        self.granted = 0
+        self.queued = 0
+        self.rate_limited = 0
+        self.wait_seconds = 0.0
+        self._waiters = None
+
+    def _lane(self, model: str):
+        lane = self._lanes.get(model)
+        if lane is None:
+            lane = self._lanes[model] = _Lane(*self.limits.get(model, (0, 0)))
+        return lane
+
+    def _notify_listener(self, status):
+        listener = queue_listener.get()
+        if listener is None:
+            return
+        # Listeners render UI; never do that while holding the lock
+        self._cond.release()
+        try:
+            listener(status)
+        except Exception:
+            logger.debug("queue listener failed", exc_info=True)
+        finally:
+            self._cond.acquire()
+
+    def acquire(self, model: str, tokens: int, session=None):
+        """Block until ``model`` has budget for one request of ``tokens``."""
+        if RATE_LIMITS_DISABLED:
+            self.granted += 1
+            return
+        session = session or current_session_id.get()
+        ticket = object()
+        t0 = time.monotonic()
+        reported = False
+        with self._cond:
+            lane = self._lane(model)
+            unlimited = lane.requests is None and lane.tokens is None
+            if unlimited and lane.paused_until <= time.monotonic() and not lane.ring:
+                self.granted += 1
+                return
+            queue = lane.queues.get(session)
+            if queue is None:
+                queue = lane.queues[session] = deque()
+                lane.ring.append(session)
+            queue.append(ticket)
+            granted = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if lane.ring[0] == session and queue[0] is ticket:
+                        wait = lane.wait_time(tokens, now)
+                        if wait <= 0:
+                            lane.take(tokens, now)
+                            granted = True
+                            break
+                    if not reported:
+                        self.queued += 1
+                    reported = True
+                    self._notify_listener({
+                        "model": model,
+                        "position": lane.position(session, ticket),
+                        "wait_s": wait,
+                        "reason": "rate_limited" if lane.paused_until > now else "queued",
+                    })
+                    self._cond.wait(STATUS_INTERVAL_S if wait is None else min(wait, STATUS_INTERVAL_S))
+            finally:
+                queue.remove(ticket)
+                if granted or not queue:
+                    lane.ring.remove(session)
+                    if queue:
+                        lane.ring.append(session)
+                    else:
+                        del lane.queues[session]
+                self.granted += granted
+                self.wait_seconds += time.monotonic() - t0
+                self._cond.notify_all()
+                if reported:
+                    self._notify_listener(None)
+
+    def settle(self, model: str, estimated: int, actual: int):
+        """Correct the token bucket once a request's real size is known."""
+        with self._cond:
+            lane = self._lane(model)
+            if lane.tokens is not None:
+                lane.tokens.give(estimated - actual)
+            self._cond.notify_all()
+
+    def pause(self, model: str, seconds: float):
+        """Hold every request for ``model``, e.g. after a 429."""
+        with self._cond:
+            lane = self._lane(model)
+            lane.paused_until = max(lane.paused_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    def _on_rate_limit(self, model: str, error, attempt: int):
+        if attempt >= RATE_LIMIT_MAX_RETRIES:
+            raise error
+        self.rate_limited += 1
+        delay = backoff_delay(attempt, retry_after(error))
+        logger.warning("%s rate limited, retrying in %.1fs", model, delay)
+        self.pause(model, delay)
+
+    def call(self, model: str, messages: list, fn, session=None):
+        """Run ``fn()`` (one provider call) within ``model``'s budget."""
+        estimated = sum(message_tokens(m) for m in messages) + RATE_LIMIT_OUTPUT_TOKENS
+        attempt = 0
+        while True:
+            self.acquire(model, estimated, session)
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_rate_limited(e):
+                    raise
+                self._on_rate_limit(model, e, attempt)
+                attempt += 1
+                continue
+            actual = estimated - RATE_LIMIT_OUTPUT_TOKENS + count_tokens(str(result or ""))
+            self.settle(model, estimated, actual)
+            return result
+
+    def stream(self, model: str, messages: list, make_stream, session=None):
+        """Like call() for a chunk stream; only retries before the first chunk."""
+        estimated = sum(message_tokens(m) for m in messages) + RATE_LIMIT_OUTPUT_TOKENS
+        attempt = 0
+        while True:
+            self.acquire(model, estimated, session)
+            parts = []
+            try:
+                for chunk in make_stream():
+                    parts.append(chunk)
+                    yield chunk
+                return
+            except Exception as e:
+                if parts or not is_rate_limited(e):
+                    raise
+                self._on_rate_limit(model, e, attempt)
+                attempt += 1
+            finally:
+                actual = estimated - RATE_LIMIT_OUTPUT_TOKENS + count_tokens("".join(parts))
+                self.settle(model, estimated, actual if parts else estimated)
+
+    # ---------------- asyncio ----------------
+    async def acquire_async(self, model: str, tokens: int, session=None):
+        """acquire() for coroutines; blocks a waiter thread, not the loop."""
+        if RATE_LIMITS_DISABLED:
+            self.granted += 1
+            return
+        with self._cond:
+            if self._waiters is None:
+                self._waiters = ThreadPoolExecutor(ASYNC_WAITERS, thread_name_prefix="rate-limit-wait")
+        await asyncio.get_running_loop().run_in_executor(
+            self._waiters, contextvars.copy_context().run, self.acquire, model, tokens, session
+        )
+
+    async def call_async(self, model: str, messages: list, fn, session=None):
+        """call() for a coroutine function ``fn``."""
+        estimated = sum(message_tokens(m) for m in messages) + RATE_LIMIT_OUTPUT_TOKENS
+        attempt = 0
+        while True:
+            await self.acquire_async(model, estimated, session)
+            try:
+                result = await fn()
+            except Exception as e:
+                if not is_rate_limited(e):
+                    raise
+                self._on_rate_limit(model, e, attempt)
+                attempt += 1
+                continue
+            actual = estimated - RATE_LIMIT_OUTPUT_TOKENS + count_tokens(str(result or ""))
+            self.settle(model, estimated, actual)
+            return result
+
+    async def stream_async(self, model: str, messages: list, make_stream, session=None):
+        """stream() for an async chunk stream."""
+        estimated = sum(message_tokens(m) for m in messages) + RATE_LIMIT_OUTPUT_TOKENS
+        attempt = 0
+        while True:
+            await self.acquire_async(model, estimated, session)
+            parts = []
+            try:
+                async for chunk in make_stream():
+                    parts.append(chunk)
+                    yield chunk
+                return
+            except Exception as e:
+                if parts or not is_rate_limited(e):
+                    raise
+                self._on_rate_limit(model, e, attempt)
+                attempt += 1
+            finally:
+                actual = estimated - RATE_LIMIT_OUTPUT_TOKENS + count_tokens("".join(parts))
+                self.settle(model, estimated, actual if parts else estimated)
+
+    def stats(self) -> dict:
+        with self._cond:
+            waiting = sum(len(q) for lane in self._lanes.values() for q in lane.queues.values())
+        return {
+            "granted": self.granted,
+            "queued": self.queued,
+            "waiting": waiting,
+            "rate_limited": self.rate_limited,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
+
+
+def format_queue_status(status: dict) -> str:
+    if status["reason"] == "rate_limited":
+        text = "The model is rate limited; your request is"
+    else:
+        text = "High demand; your request is"
+    if status["position"]:
+        text += f" number {status['position'] + 1} in the queue"
+    else:
+        text += " next in the queue"
+    if status.get("wait_s"):
+        text += f" (about {status['wait_s']:.0f}s)"
+    return text + "..."
+
+
+_scheduler = RequestScheduler()
+
+
+def get_scheduler() -> RequestScheduler:
+    return _scheduler
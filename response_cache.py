@@ -0,0 +1,238 @@
+"""Disk-backed, content-addressed cache for LLM replies.
+
+Shared by Chatbot.py and triage_module so that Streamlit reruns (download
+clicks, widget changes) reuse text we already paid for instead of calling
+the provider again.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+CACHE_DISABLED = os.getenv("LLM_CACHE_DISABLED", "").lower() in ("1", "true", "yes")
+
+
+# ---------------------------
+# Keys
+# ---------------------------
+def normalize_messages(messages: list) -> list:
+    """Role/content pairs with per-line whitespace trimmed, so indentation in
+    f-string prompts does not split the cache."""
+    normalized = []
+    for m in messages:
+        content = str(m.get("content", ""))
+        lines = [line.strip() for line in content.strip().splitlines()]
+        normalized.append({
+            "role": str(m.get("role", "user")).strip().lower(),
+            "content": "\n".join(line for line in lines if line),
+        })
+    return normalized
+
+
+def make_key(provider: str, model: str, temperature, messages: list) -> str:
+    payload = json.dumps(
+        {
+            "provider": provider,
+            "model": model,
+            "temperature": temperature,
+            "messages": normalize_messages(messages),
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# ---------------------------
+# Cache
+# ---------------------------
+class ResponseCache:
+    """SQLite-backed LRU with TTL and a total-size bound."""
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES,
+                 max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)"
+        )
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float):
+        cur = self._conn.execute(
+            "DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)
+        )
+        self.evictions += max(cur.rowcount, 0)
+
+        count, total = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+
+        # Walk from least recently used until both bounds hold again
+        doomed = []
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            count -= 1
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+        self.evictions += len(doomed)
+
+    def get_or_generate(self, provider: str, model: str, temperature, messages: list, generate):
+        """Return the cached reply, or call ``generate()`` and store a non-empty result."""
+        if CACHE_DISABLED:
+            return generate()
+        key = make_key(provider, model, temperature, messages)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        reply = generate()
+        if reply and str(reply).strip():
+            self.set(key, str(reply))
+        return reply
+
+    def stream_through(self, provider: str, model: str, temperature, messages: list, stream):
+        """Streaming counterpart of get_or_generate.
+
+        A hit is yielded as one chunk; on a miss the chunks from ``stream()``
+        are passed through and the joined reply is stored once it completes.
+        """
+        if CACHE_DISABLED:
+            yield from stream()
+            return
+        key = make_key(provider, model, temperature, messages)
+        cached = self.get(key)
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        for chunk in stream():
+            parts.append(chunk)
+            yield chunk
+        reply = "".join(parts)
+        if reply.strip():
+            self.set(key, reply.strip())
+
+    # SQLite lookups are local and short, so the async variants run them inline
+    async def get_or_generate_async(self, provider: str, model: str, temperature, messages: list,
+                                    generate):
+        """get_or_generate for a coroutine function ``generate``."""
+        if CACHE_DISABLED:
+            return await generate()
+        key = make_key(provider, model, temperature, messages)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        reply = await generate()
+        if reply and str(reply).strip():
+            self.set(key, str(reply))
+        return reply
+
+    async def stream_through_async(self, provider: str, model: str, temperature, messages: list,
+                                   stream):
+        """stream_through for an async chunk stream."""
+        if CACHE_DISABLED:
+            async for chunk in stream():
+                yield chunk
+            return
+        key = make_key(provider, model, temperature, messages)
+        cached = self.get(key)
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        async for chunk in stream():
+            parts.append(chunk)
+            yield chunk
+        reply = "".join(parts)
+        if reply.strip():
+            self.set(key, reply.strip())
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": count,
+            "bytes": total,
+        }
+
+
+# Module-level singleton: imported modules survive Streamlit reruns, so this
+# lives for the whole server process and is shared by every session.
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+    return _cache
@@ -0,0 +1,303 @@
+"""Opt-in semantic cache for first-turn consultation questions.
+
+Many consultations open with nearly the same question ("I have a headache
+and fever"). With no history, the reply depends only on the system prompt
+and that one question, so a reply generated for one wording can serve
+another. response_cache only matches byte-identical prompts; this cache
+matches by meaning.
+
+Questions are embedded on the CPU with hashed TF-IDF: content words, with
+negations marked ("no fever" is not "fever") and light plural stemming,
+plus unordered pairs of neighbouring words, hashed into SEMANTIC_CACHE_DIM
+signed buckets. IDF weights come from the questions currently cached. A
+lookup scores every cached question of the same provider and system prompt
+in one matrix product and serves the best one if its cosine similarity is at
+least SEMANTIC_CACHE_THRESHOLD. The default threshold is deliberately
+strict; a wrong answer is worse than a slow one.
+
+Entries expire after SEMANTIC_CACHE_TTL_SECONDS, and the least recently
+used are evicted beyond SEMANTIC_CACHE_MAX_ENTRIES. The index lives in
+process memory. Hit rate and the generation time saved by hits are reported
+by ``stats()``.
+
+Off unless SEMANTIC_CACHE_ENABLED is set.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "2000"))
+SEMANTIC_CACHE_TTL_SECONDS = int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(24 * 3600)))
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", "4096"))
+# Long first messages carry specifics that rarely recur; send them upstream
+SEMANTIC_CACHE_MAX_WORDS = int(os.getenv("SEMANTIC_CACHE_MAX_WORDS", "60"))
+
+PAIR_WEIGHT = 0.5
+
+STOPWORDS = frozenset(
+    "a an and are am as at be been being but by can could did do does doing for from "
+    "got get getting had has have having he her him his i i'm i've im ive in is it it's "
+    "its just me my myself of on or our over please really she should so some that the "
+    "their them then there these they this those to too very was we were what when "
+    "which while who will with would you your hi hello hey".split()
+)
+NEGATIONS = frozenset("no not never without don't dont doesn't doesnt didn't didnt isn't "
+                      "isnt haven't havent hasn't hasnt cannot can't cant".split())
+_WORD = re.compile(r"[a-z0-9']+")
+
+
+# ---------------------------
+# Embedding
+# ---------------------------
+def _stem(word: str) -> str:
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def query_terms(text: str) -> list:
+    """Content words of ``text``; a word following a negation gets a "!" prefix."""
+    terms = []
+    negate = False
+    for word in _WORD.findall(text.lower()):
+        if word in NEGATIONS:
+            negate = True
+            continue
+        if word in STOPWORDS:
+            continue
+        terms.append(("!" if negate else "") + _stem(word))
+        negate = False
+    return terms
+
+
+def _features(terms: list) -> dict:
+    features = {}
+    for term in terms:
+        features[term] = features.get(term, 0.0) + 1.0
+    # Unordered, so "fever and headache" matches "headache and fever"
+    for left, right in zip(terms, terms[1:]):
+        pair = " ".join(sorted((left, right)))
+        features[pair] = features.get(pair, 0.0) + PAIR_WEIGHT
+    return features
+
+
+def embed(text: str, dim=SEMANTIC_CACHE_DIM):
+    """Sublinear term-frequency vector over ``dim`` signed hash buckets, or
+    None if ``text`` has no content words."""
+    import numpy as np
+
+    features = _features(query_terms(text))
+    if not features:
+        return None
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature, count in features.items():
+        # crc32, unlike hash(), is the same in every process
+        h = zlib.crc32(feature.encode("utf-8"))
+        weight = 1.0 + np.log(count) if count > 1 else count
+        vector[h % dim] += weight if h & 0x80000000 else -weight
+    return vector
+
+
+def namespace_for(provider: str, system_prompt: str) -> str:
+    """Replies are only shared between questions asked of the same provider
+    under the same system prompt."""
+    return f"{provider}:{hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()[:16]}"
+
+
+# ---------------------------
+# Index
+# ---------------------------
+class SemanticCache:
+    """In-memory vector index of first-turn questions and their replies."""
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+                 ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS, dim=SEMANTIC_CACHE_DIM):
+        import numpy as np
+
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.dim = dim
+        self._lock = threading.Lock()
+        # One row per slot; freed slots are reused
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._namespaces = np.zeros(0, dtype=np.int32)
+        self._live = np.zeros(0, dtype=bool)
+        self._df = np.zeros(dim, dtype=np.float32)   # live rows with each bucket set
+        self._namespace_ids = {}
+        self._entries = OrderedDict()   # slot -> entry dict, least recently used first
+        self._free = []
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.evictions = 0
+        self.seconds_saved = 0.0
+        self.lookup_seconds = 0.0
+
+    def _idf(self):
+        import numpy as np
+
+        n = len(self._entries)
+        return np.log((1.0 + n) / (1.0 + self._df)) + 1.0
+
+    def lookup(self, namespace: str, query: str):
+        """The cached entry closest to ``query`` if it clears the threshold, else None."""
+        import numpy as np
+
+        started = time.perf_counter()
+        vector = embed(query, self.dim)
+        with self._lock:
+            entry = None
+            ns = self._namespace_ids.get(namespace)
+            if vector is not None and ns is not None and self._entries:
+                self._expire(time.time())
+                rows = np.flatnonzero(self._live & (self._namespaces == ns))
+                if rows.size:
+                    idf = self._idf()
+                    weighted = self._vectors[rows] * idf
+                    q = vector * idf
+                    norms = np.linalg.norm(weighted, axis=1) * np.linalg.norm(q)
+                    scores = (weighted @ q) / np.maximum(norms, 1e-12)
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.threshold:
+                        slot = int(rows[best])
+                        self._entries.move_to_end(slot)
+                        entry = self._entries[slot]
+                        entry["hits"] += 1
+            elapsed = time.perf_counter() - started
+            self.lookup_seconds += elapsed
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.seconds_saved += max(entry["latency"] - elapsed, 0.0)
+            return entry
+
+    def add(self, namespace: str, query: str, reply: str, latency: float):
+        """Cache ``reply`` for ``query``; ``latency`` is what generating it took."""
+        import numpy as np
+
+        vector = embed(query, self.dim)
+        if vector is None:
+            return
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            while len(self._entries) >= self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._live)
+                grow = max(16, len(self._live))
+                self._vectors = np.vstack([self._vectors, np.zeros((grow, self.dim), dtype=np.float32)])
+                self._namespaces = np.concatenate([self._namespaces, np.zeros(grow, dtype=np.int32)])
+                self._live = np.concatenate([self._live, np.zeros(grow, dtype=bool)])
+                self._free.extend(range(len(self._live) - 1, slot, -1))
+            ns = self._namespace_ids.setdefault(namespace, len(self._namespace_ids))
+            self._vectors[slot] = vector
+            self._namespaces[slot] = ns
+            self._live[slot] = True
+            self._df += vector != 0
+            self._entries[slot] = {
+                "query": query,
+                "reply": reply,
+                "latency": latency,
+                "created_at": now,
+                "hits": 0,
+            }
+
+    def _drop(self, slot: int):
+        del self._entries[slot]
+        self._df -= self._vectors[slot] != 0
+        self._live[slot] = False
+        self._free.append(slot)
+
+    def _expire(self, now: float):
+        cutoff = now - self.ttl_seconds
+        expired = [slot for slot, entry in self._entries.items() if entry["created_at"] < cutoff]
+        for slot in expired:
+            self._drop(slot)
+        self.evictions += len(expired)
+
+    # ---------------- streaming ----------------
+    def stream_through(self, namespace: str, query: str, stream):
+        """Serve a close-enough cached reply as one chunk, or pass through
+        ``stream()`` and cache its reply once it completes."""
+        if len(query.split()) > SEMANTIC_CACHE_MAX_WORDS:
+            self.skipped += 1
+            yield from stream()
+            return
+        entry = self.lookup(namespace, query)
+        if entry is not None:
+            yield entry["reply"]
+            return
+        started = time.perf_counter()
+        parts = []
+        for chunk in stream():
+            parts.append(chunk)
+            yield chunk
+        reply = "".join(parts).strip()
+        if reply:
+            self.add(namespace, query, reply, time.perf_counter() - started)
+
+    # Lookups are a few milliseconds of numpy, so the async variant runs them inline
+    async def stream_through_async(self, namespace: str, query: str, stream):
+        """stream_through for an async chunk stream."""
+        if len(query.split()) > SEMANTIC_CACHE_MAX_WORDS:
+            self.skipped += 1
+            async for chunk in stream():
+                yield chunk
+            return
+        entry = self.lookup(namespace, query)
+        if entry is not None:
+            yield entry["reply"]
+            return
+        started = time.perf_counter()
+        parts = []
+        async for chunk in stream():
+            parts.append(chunk)
+            yield chunk
+        reply = "".join(parts).strip()
+        if reply:
+            self.add(namespace, query, reply, time.perf_counter() - started)
+
+    def clear(self):
+        with self._lock:
+            for slot in list(self._entries):
+                self._drop(slot)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped": self.skipped,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "entries": len(self._entries),
+            "evictions": self.evictions,
+            "seconds_saved": self.seconds_saved,
+            "avg_lookup_ms": (1000 * self.lookup_seconds / lookups) if lookups else 0.0,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> SemanticCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SemanticCache()
+    return _cache
@@ -0,0 +1,402 @@
+"""Triage session storage.
+
+The chat page hands a consultation to the triage page by saving a session
+payload; the triage page loads it back on every rerun. The default backend
+is an embedded SQLite database indexed on session_id, patient_id and
+created_at, with an in-process read cache and TTL-based expiry. The old
+one-JSON-file-per-session layout is kept as a backend and can be imported
+with:
+
+    python session_store.py migrate triage_sessions
+
+With several app replicas behind a load balancer, SESSION_STORE_BACKEND=redis
+keeps the handoff in a Redis-compatible server (REDIS_URL) that every
+replica can reach, instead of on one replica's disk.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+TRIAGE_DIR = "triage_sessions"
+SESSION_STORE_BACKEND = os.getenv("SESSION_STORE_BACKEND", "sqlite")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "triage_sessions.sqlite3")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", str(30 * 24 * 3600)))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "256"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "medical_assistant:")
+
+
+def _dumps(payload: dict) -> str:
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+
+class SessionStore:
+    """Interface shared by the storage backends."""
+
+    def save(self, session_id: str, payload: dict):
+        raise NotImplementedError
+
+    def load(self, session_id: str):
+        raise NotImplementedError
+
+    def delete(self, session_id: str):
+        raise NotImplementedError
+
+    def list_by_patient(self, patient_id, limit=50) -> list:
+        raise NotImplementedError
+
+    def iter_sessions(self, since=None, until=None):
+        """Yield (session_id, payload) pairs, oldest first, for sessions
+        created at or after ``since`` and before ``until``."""
+        raise NotImplementedError
+
+    def compact(self) -> int:
+        """Drop expired sessions; return how many were removed."""
+        return 0
+
+
+# ---------------------------
+# Legacy JSON directory
+# ---------------------------
+class JSONDirSessionStore(SessionStore):
+    def __init__(self, directory=TRIAGE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, f"{session_id}.json")
+
+    def save(self, session_id, payload):
+        with open(self._path(session_id), "w") as f:
+            json.dump(payload, f)
+
+    def load(self, session_id):
+        path = self._path(session_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def delete(self, session_id):
+        path = self._path(session_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def list_by_patient(self, patient_id, limit=50):
+        # No index here: this is the slow path the SQLite backend replaces
+        matches = []
+        for session_id, payload in self.iter_sessions():
+            if payload.get("patient_id") == patient_id:
+                matches.append(session_id)
+        return matches[-limit:][::-1]
+
+    def iter_sessions(self, since=None, until=None):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".json"):
+                    entries.append((entry.stat().st_mtime, entry))
+        entries.sort(key=lambda item: item[0])
+        for mtime, entry in entries:
+            if (since is not None and mtime < since) or (until is not None and mtime >= until):
+                continue
+            with open(entry.path, "r") as f:
+                yield entry.name[:-len(".json")], json.load(f)
+
+
+# ---------------------------
+# SQLite
+# ---------------------------
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path=SESSION_DB_PATH, ttl_seconds=SESSION_TTL_SECONDS,
+                 cache_size=SESSION_CACHE_SIZE):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                patient_id INTEGER,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                expires_at REAL,
+                payload TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_patient ON sessions(patient_id, created_at);
+            CREATE INDEX IF NOT EXISTS sessions_created ON sessions(created_at);
+            CREATE INDEX IF NOT EXISTS sessions_expires ON sessions(expires_at);
+            """
+        )
+
+    # ---------------- read cache ----------------
+    def _cache_get(self, session_id):
+        entry = self._cache.get(session_id)
+        if entry is None:
+            return None
+        payload, expires_at = entry
+        if expires_at is not None and expires_at < time.time():
+            del self._cache[session_id]
+            return None
+        self._cache.move_to_end(session_id)
+        return payload
+
+    def _cache_put(self, session_id, payload, expires_at):
+        self._cache[session_id] = (payload, expires_at)
+        self._cache.move_to_end(session_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    # ---------------- api ----------------
+    def save(self, session_id, payload, created_at=None):
+        now = time.time()
+        created_at = created_at or now
+        expires_at = (now + self.ttl_seconds) if self.ttl_seconds else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (session_id, patient_id, created_at, updated_at, expires_at, payload)"
+                " VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(session_id) DO UPDATE SET"
+                " patient_id = excluded.patient_id, updated_at = excluded.updated_at,"
+                " expires_at = excluded.expires_at, payload = excluded.payload",
+                (session_id, payload.get("patient_id"), created_at, now, expires_at, _dumps(payload)),
+            )
+            self._cache_put(session_id, payload, expires_at)
+
+    def load(self, session_id):
+        with self._lock:
+            cached = self._cache_get(session_id)
+            if cached is not None:
+                return cached
+            row = self._conn.execute(
+                "SELECT payload, expires_at FROM sessions WHERE session_id = ?"
+                " AND (expires_at IS NULL OR expires_at >= ?)",
+                (session_id, time.time()),
+            ).fetchone()
+            if row is None:
+                return None
+            payload = json.loads(row[0])
+            self._cache_put(session_id, payload, row[1])
+            return payload
+
+    def delete(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._cache.pop(session_id, None)
+
+    def list_by_patient(self, patient_id, limit=50):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT session_id FROM sessions WHERE patient_id = ?"
+                " AND (expires_at IS NULL OR expires_at >= ?)"
+                " ORDER BY created_at DESC LIMIT ?",
+                (patient_id, time.time(), limit),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def iter_sessions(self, since=None, until=None):
+        # Page through by created_at so a long scan never holds the lock
+        cursor_time, cursor_id = (since or 0.0), ""
+        until = until if until is not None else float("inf")
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT session_id, created_at, payload FROM sessions"
+                    " WHERE (created_at > ? OR (created_at = ? AND session_id > ?))"
+                    " AND created_at < ? AND (expires_at IS NULL OR expires_at >= ?)"
+                    " ORDER BY created_at, session_id LIMIT 500",
+                    (cursor_time, cursor_time, cursor_id, until, time.time()),
+                ).fetchall()
+            if not rows:
+                return
+            for session_id, created_at, payload in rows:
+                yield session_id, json.loads(payload)
+            cursor_id, cursor_time = rows[-1][0], rows[-1][1]
+
+    def compact(self):
+        with self._lock:
+            cur = self._conn.execute(
+                "DELETE FROM sessions WHERE expires_at IS NOT NULL AND expires_at < ?",
+                (time.time(),),
+            )
+            removed = max(cur.rowcount, 0)
+            self._cache.clear()
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.execute("VACUUM")
+        return removed
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+# ---------------------------
+# Redis
+# ---------------------------
+_redis = {}
+_redis_lock = threading.Lock()
+
+
+def get_redis_client(url=REDIS_URL):
+    """One pooled client per URL for the whole process."""
+    with _redis_lock:
+        client = _redis.get(url)
+        if client is None:
+            import redis
+            client = _redis[url] = redis.Redis.from_url(url)
+        return client
+
+
+class RedisSessionStore(SessionStore):
+    """Payloads as JSON strings with a TTL, plus sorted sets (scored by
+    created_at) indexing them by creation time and by patient."""
+
+    def __init__(self, url=REDIS_URL, ttl_seconds=SESSION_TTL_SECONDS, prefix=REDIS_PREFIX):
+        self.redis = get_redis_client(url)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def _key(self, session_id):
+        return f"{self.prefix}triage:{session_id}"
+
+    def _created_key(self):
+        return f"{self.prefix}triage_created"
+
+    def _patient_key(self, patient_id):
+        return f"{self.prefix}triage_patient:{patient_id}"
+
+    def save(self, session_id, payload, created_at=None):
+        created_at = created_at or time.time()
+        pipe = self.redis.pipeline()
+        pipe.set(self._key(session_id), _dumps(payload), ex=self.ttl_seconds or None)
+        # nx: re-saving a session keeps its original creation time
+        pipe.zadd(self._created_key(), {session_id: created_at}, nx=True)
+        if payload.get("patient_id") is not None:
+            pipe.zadd(self._patient_key(payload["patient_id"]), {session_id: created_at}, nx=True)
+        pipe.execute()
+
+    def load(self, session_id):
+        data = self.redis.get(self._key(session_id))
+        return json.loads(data) if data is not None else None
+
+    def delete(self, session_id):
+        payload = self.load(session_id) or {}
+        pipe = self.redis.pipeline()
+        pipe.delete(self._key(session_id))
+        pipe.zrem(self._created_key(), session_id)
+        if payload.get("patient_id") is not None:
+            pipe.zrem(self._patient_key(payload["patient_id"]), session_id)
+        pipe.execute()
+
+    def list_by_patient(self, patient_id, limit=50):
+        ids = [i.decode() for i in self.redis.zrevrange(self._patient_key(patient_id), 0, limit - 1)]
+        pipe = self.redis.pipeline()
+        for session_id in ids:
+            pipe.exists(self._key(session_id))
+        # Index entries outlive payloads that expired
+        return [i for i, alive in zip(ids, pipe.execute() if ids else []) if alive]
+
+    def iter_sessions(self, since=None, until=None):
+        low = since if since is not None else "-inf"
+        high = f"({until}" if until is not None else "+inf"
+        offset = 0
+        while True:
+            ids = self.redis.zrangebyscore(self._created_key(), low, high, start=offset, num=500)
+            if not ids:
+                return
+            offset += len(ids)
+            values = self.redis.mget([self._key(i.decode()) for i in ids])
+            for session_id, data in zip(ids, values):
+                if data is not None:
+                    yield session_id.decode(), json.loads(data)
+
+    def _drop_stale(self, index_key) -> int:
+        """Remove members of sorted set ``index_key`` whose payload expired."""
+        ids = self.redis.zrange(index_key, 0, -1)
+        if not ids:
+            return 0
+        pipe = self.redis.pipeline()
+        for session_id in ids:
+            pipe.exists(self._key(session_id.decode()))
+        stale = [i for i, alive in zip(ids, pipe.execute()) if not alive]
+        if stale:
+            self.redis.zrem(index_key, *stale)
+        return len(stale)
+
+    def compact(self):
+        """Drop index entries whose payload has expired, from the creation
+        index and every per-patient index."""
+        removed = self._drop_stale(self._created_key())
+        for index_key in self.redis.scan_iter(match=self._patient_key("*")):
+            self._drop_stale(index_key)
+        return removed
+
+
+# ---------------------------
+# Factory + migration
+# ---------------------------
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if SESSION_STORE_BACKEND == "json":
+                    _store = JSONDirSessionStore(TRIAGE_DIR)
+                elif SESSION_STORE_BACKEND == "redis":
+                    _store = RedisSessionStore(REDIS_URL)
+                else:
+                    _store = SQLiteSessionStore(SESSION_DB_PATH)
+    return _store
+
+
+def migrate_json_dir(directory: str, store: SQLiteSessionStore) -> int:
+    """Import every <session_id>.json in ``directory``; file mtime becomes created_at."""
+    imported = 0
+    with os.scandir(directory) as it:
+        for entry in it:
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path, "r") as f:
+                    payload = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"skipping {entry.name}: {e}")
+                continue
+            store.save(entry.name[:-len(".json")], payload, created_at=entry.stat().st_mtime)
+            imported += 1
+    return imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Triage session store maintenance")
+    parser.add_argument("--db", default=SESSION_DB_PATH, help="SQLite database path")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate = sub.add_parser("migrate", help="import legacy JSON session files")
+    migrate.add_argument("directory", nargs="?", default=TRIAGE_DIR)
+    sub.add_parser("compact", help="drop expired sessions and vacuum")
+    args = parser.parse_args(argv)
+
+    store = SQLiteSessionStore(args.db)
+    if args.command == "migrate":
+        count = migrate_json_dir(args.directory, store)
+        print(f"Imported {count} sessions into {args.db} ({store.count()} total).")
+    else:
+        removed = store.compact()
+        print(f"Removed {removed} expired sessions from {args.db}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Frame-throttled rendering of streamed LLM replies into a Streamlit placeholder.
+
+Re-rendering the whole accumulated reply on every chunk (plus a sleep per
+chunk) makes long replies quadratic and adds artificial latency. The renderer
+buffers chunks and only pushes to the placeholder when a frame interval has
+passed or enough new text has piled up, so the number of re-renders is bounded
+by elapsed time rather than by chunk count.
+"""
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+STREAM_FRAME_INTERVAL = float(os.getenv("STREAM_FRAME_INTERVAL", "0.08"))
+STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", "400"))
+CURSOR = "▌"
+
+
+class StreamRenderer:
+    def __init__(self, placeholder, render=None, frame_interval=STREAM_FRAME_INTERVAL,
+                 flush_chars=STREAM_FLUSH_CHARS, cursor=CURSOR):
+        self.placeholder = placeholder
+        self.render = render or (lambda text: placeholder.markdown(text))
+        self.frame_interval = frame_interval
+        self.flush_chars = flush_chars
+        self.cursor = cursor
+        self.parts = []
+        self.pending_chars = 0
+        self.frames = 0
+        self.started_at = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+        self._last_flush = self.started_at
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def write(self, chunk: str):
+        if not chunk:
+            return
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.parts.append(chunk)
+        self.pending_chars += len(chunk)
+        # Always paint the first token immediately; it is what the user waits on
+        if (self.frames == 0
+                or now - self._last_flush >= self.frame_interval
+                or self.pending_chars >= self.flush_chars):
+            self._flush(now, self.cursor)
+
+    def _flush(self, now: float, suffix: str = ""):
+        # Collapse the buffer so later joins stay cheap
+        if len(self.parts) > 1:
+            self.parts = [self.text]
+        self.render(self.text + suffix)
+        self.frames += 1
+        self.pending_chars = 0
+        self._last_flush = now
+
+    def close(self) -> str:
+        now = time.perf_counter()
+        self.finished_at = now
+        self._flush(now)
+        m = self.metrics()
+        logger.info(
+            "stream finished: ttft=%.3fs total=%.3fs chars=%d frames=%d",
+            m["ttft_s"] or 0.0, m["total_s"], m["chars"], m["frames"],
+        )
+        return self.text
+
+    def consume(self, chunks) -> str:
+        """Render every chunk from an iterable and return the full text."""
+        for chunk in chunks:
+            self.write(chunk)
+        return self.close()
+
+    def metrics(self) -> dict:
+        end = self.finished_at or time.perf_counter()
+        ttft = (self.first_token_at - self.started_at) if self.first_token_at else None
+        return {
+            "ttft_s": ttft,
+            "total_s": end - self.started_at,
+            "chars": len(self.text),
+            "frames": self.frames,
+        }
+
+
+def format_metrics(m: dict) -> str:
+    ttft = f"{m['ttft_s']:.2f}s" if m.get("ttft_s") is not None else "n/a"
+    return f"First token {ttft} · total {m['total_s']:.2f}s · {m['frames']} frames"
@@ -0,0 +1,356 @@
+"""Append-only consultation transcripts.
+
+The triage handoff used to carry a full copy of the conversation, system
+prompt included, rewritten on every save. Each consultation's transcript is
+now one append-only file in TRANSCRIPT_DIR, and a chat turn appends just
+its new messages.
+
+Records are framed as
+
+    <length:u32> <flags:u8> <payload> <length:u32>
+
+and the trailing length lets readers walk back from the end of the file, so
+``tail()`` reads only the last few records. Payloads are compact JSON
+arrays: ["u", text] and ["a", text] for turns, ["s", ref] for a system
+prompt, ["x"] where the history was reset. System prompts are stored once,
+by reference, under TRANSCRIPT_DIR/prompts.
+
+With TRANSCRIPT_ZSTD set (needs the zstandard package), turn records are
+zstd-compressed using the consultation's system prompt as a raw-content
+dictionary, so the disclaimer every reply repeats from the prompt costs a
+few bytes.
+
+A transcript expires TRANSCRIPT_TTL_SECONDS after its last append (0 keeps
+them forever); ``compact()`` deletes expired logs and prompts no remaining
+log refers to:
+
+    python transcript_log.py tail <session_id> -n 10
+    python transcript_log.py compact
+"""
+import argparse
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+
+TRANSCRIPT_DIR = os.getenv("TRANSCRIPT_DIR", "transcripts")
+TRANSCRIPT_ZSTD = os.getenv("TRANSCRIPT_ZSTD", "").lower() in ("1", "true", "yes")
+TRANSCRIPT_ZSTD_LEVEL = int(os.getenv("TRANSCRIPT_ZSTD_LEVEL", "3"))
+TRANSCRIPT_TTL_SECONDS = int(os.getenv("TRANSCRIPT_TTL_SECONDS", str(30 * 24 * 3600)))
+
+_HEADER = struct.Struct("<IB")
+_TRAILER = struct.Struct("<I")
+FLAG_ZSTD = 1
+# Compressing very short records only adds the zstd frame overhead
+MIN_COMPRESS_BYTES = 64
+
+_ROLE_CODES = {"user": "u", "assistant": "a"}
+_CODE_ROLES = {code: role for role, code in _ROLE_CODES.items()}
+# st.session_state key holding how many messages are already in the log
+_SYNCED_KEY = "_transcript_synced"
+
+
+def _dumps(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def prompt_ref(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class TranscriptLog:
+    def __init__(self, directory=TRANSCRIPT_DIR, compress=TRANSCRIPT_ZSTD,
+                 level=TRANSCRIPT_ZSTD_LEVEL, ttl_seconds=TRANSCRIPT_TTL_SECONDS):
+        self.directory = directory
+        self.compress = compress
+        self.level = level
+        self.ttl_seconds = ttl_seconds
+        self._prompts = {}          # ref -> text
+        self._zstd = {}             # (ref, "c" | "d") -> compressor / decompressor
+        # Reentrant: appends decode the file's first record; zstd objects are not thread-safe
+        self._lock = threading.RLock()
+        self.bytes_appended = 0
+        os.makedirs(os.path.join(directory, "prompts"), exist_ok=True)
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, f"{session_id}.log")
+
+    # ---------------- system prompts ----------------
+    def _store_prompt(self, text: str) -> str:
+        ref = prompt_ref(text)
+        path = os.path.join(self.directory, "prompts", f"{ref}.txt")
+        try:
+            # The mtime marks the prompt as in use, so compact() keeps it
+            os.utime(path)
+        except FileNotFoundError:
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, path)
+        self._prompts[ref] = text
+        return ref
+
+    def _load_prompt(self, ref: str) -> str:
+        text = self._prompts.get(ref)
+        if text is None:
+            with open(os.path.join(self.directory, "prompts", f"{ref}.txt"), encoding="utf-8") as f:
+                text = self._prompts[ref] = f.read()
+        return text
+
+    # ---------------- compression ----------------
+    def _codec(self, ref, kind):
+        """zstd compressor ("c") or decompressor ("d") primed with prompt ``ref``."""
+        codec = self._zstd.get((ref, kind))
+        if codec is None:
+            import zstandard
+
+            dictionary = None
+            if ref is not None:
+                dictionary = zstandard.ZstdCompressionDict(
+                    self._load_prompt(ref).encode("utf-8"), dict_type=zstandard.DICT_TYPE_RAWCONTENT
+                )
+            if kind == "c":
+                codec = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+            else:
+                codec = zstandard.ZstdDecompressor(dict_data=dictionary)
+            self._zstd[(ref, kind)] = codec
+        return codec
+
+    def _frame(self, record: list, ref) -> bytes:
+        payload, flags = _dumps(record), 0
+        if self.compress and record[0] in _CODE_ROLES and len(payload) >= MIN_COMPRESS_BYTES:
+            packed = self._codec(ref, "c").compress(payload)
+            if len(packed) < len(payload):
+                payload, flags = packed, FLAG_ZSTD
+        return _HEADER.pack(len(payload), flags) + payload + _TRAILER.pack(len(payload))
+
+    def _decode(self, flags: int, payload: bytes, ref) -> list:
+        if flags & FLAG_ZSTD:
+            with self._lock:
+                payload = self._codec(ref, "d").decompress(payload)
+        return json.loads(payload)
+
+    # ---------------- writing ----------------
+    def append(self, session_id: str, messages: list, reset=False) -> int:
+        """Append ``messages``; ``reset`` first marks earlier records as
+        superseded. Returns the bytes written."""
+        path = self._path(session_id)
+        with self._lock:
+            # Every turn in a file is compressed against the file's first prompt
+            ref = self._current_ref(path)
+            if ref is None and messages and messages[0]["role"] == "system" and not os.path.exists(path):
+                ref = self._store_prompt(str(messages[0]["content"]))
+            frames = [self._frame(["x"], ref)] if reset else []
+            for m in messages:
+                if m["role"] == "system":
+                    frames.append(self._frame(["s", self._store_prompt(str(m["content"]))], ref))
+                else:
+                    frames.append(self._frame([_ROLE_CODES.get(m["role"], m["role"]), str(m["content"])], ref))
+            data = b"".join(frames)
+            # One write on an O_APPEND descriptor: concurrent writers never interleave
+            with open(path, "ab") as f:
+                f.write(data)
+            self.bytes_appended += len(data)
+        return len(data)
+
+    def _current_ref(self, path):
+        """Prompt ref of the file's first record, the dictionary for its turns."""
+        try:
+            with open(path, "rb") as f:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    return None
+                length, flags = _HEADER.unpack(header)
+                record = self._decode(flags, f.read(length), None)
+        except FileNotFoundError:
+            return None
+        return record[1] if record[0] == "s" else None
+
+    # ---------------- reading ----------------
+    def _records(self, f, size):
+        """(flags, payload) for every complete frame, oldest first."""
+        pos = 0
+        while pos + _HEADER.size <= size:
+            f.seek(pos)
+            length, flags = _HEADER.unpack(f.read(_HEADER.size))
+            end = pos + _HEADER.size + length + _TRAILER.size
+            if end > size:
+                # Torn write from a crash mid-append
+                return
+            yield flags, f.read(length)
+            pos = end
+
+    def _records_reversed(self, f, size):
+        """(flags, payload) newest first, walking back along the trailers."""
+        pos = size
+        while pos > 0:
+            f.seek(pos - _TRAILER.size)
+            (length,) = _TRAILER.unpack(f.read(_TRAILER.size))
+            start = pos - _TRAILER.size - length - _HEADER.size
+            if start < 0:
+                raise ValueError("corrupt transcript frame")
+            f.seek(start)
+            header_length, flags = _HEADER.unpack(f.read(_HEADER.size))
+            if header_length != length:
+                raise ValueError("corrupt transcript frame")
+            yield flags, f.read(length)
+            pos = start
+
+    def _to_message(self, record):
+        if record[0] == "s":
+            return {"role": "system", "content": self._load_prompt(record[1])}
+        return {"role": _CODE_ROLES.get(record[0], record[0]), "content": record[1]}
+
+    def read(self, session_id: str) -> list:
+        """The whole current transcript (after the last reset), or [] if none."""
+        path = self._path(session_id)
+        messages = []
+        try:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                ref = self._current_ref(path)
+                for flags, payload in self._records(f, size):
+                    record = self._decode(flags, payload, ref)
+                    if record[0] == "x":
+                        messages = []
+                    else:
+                        messages.append(self._to_message(record))
+        except FileNotFoundError:
+            return []
+        return messages
+
+    def tail(self, session_id: str, n: int) -> list:
+        """The last ``n`` turns (system prompt excluded), reading only those
+        records from the end of the file."""
+        path = self._path(session_id)
+        try:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                ref = self._current_ref(path)
+                turns = []
+                try:
+                    for flags, payload in self._records_reversed(f, size):
+                        if len(turns) == n:
+                            break
+                        record = self._decode(flags, payload, ref)
+                        if record[0] == "x":
+                            break
+                        if record[0] != "s":
+                            turns.append(self._to_message(record))
+                except ValueError:
+                    # A torn last frame breaks the backward walk; fall back to a full scan
+                    return [m for m in self.read(session_id) if m["role"] != "system"][-n:]
+        except FileNotFoundError:
+            return []
+        return turns[::-1]
+
+    def delete(self, session_id: str):
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            pass
+
+    def compact(self) -> int:
+        """Delete transcripts not appended to within the TTL, then prompts
+        no remaining transcript refers to; return how many logs were removed."""
+        if not self.ttl_seconds:
+            return 0
+        cutoff = time.time() - self.ttl_seconds
+        removed = 0
+        live_refs = set()
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(".log") or not entry.is_file():
+                    continue
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+                    continue
+                with open(entry.path, "rb") as f:
+                    for flags, payload in self._records(f, os.fstat(f.fileno()).st_size):
+                        # Prompt records are never compressed
+                        if not flags & FLAG_ZSTD:
+                            record = json.loads(payload)
+                            if record[0] == "s":
+                                live_refs.add(record[1])
+            prompts = os.path.join(self.directory, "prompts")
+            for entry in os.scandir(prompts):
+                if not entry.name.endswith(".txt"):
+                    continue
+                ref = entry.name[:-len(".txt")]
+                # Prompts used since the cutoff may belong to a log another
+                # process is about to create
+                if ref not in live_refs and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    self._prompts.pop(ref, None)
+                    self._zstd.pop((ref, "c"), None)
+                    self._zstd.pop((ref, "d"), None)
+        return removed
+
+    def stats(self) -> dict:
+        return {"bytes_appended": self.bytes_appended, "compressed": self.compress}
+
+
+def sync_transcript(log: TranscriptLog, session_id: str, state) -> int:
+    """Append the messages in ``state["messages"]`` not yet logged; returns
+    the bytes written."""
+    messages = state.get("messages", [])
+    synced = state.get(_SYNCED_KEY, 0)
+    if len(messages) < synced:
+        written = log.append(session_id, messages, reset=True)
+    elif len(messages) > synced:
+        written = log.append(session_id, messages[synced:])
+    else:
+        written = 0
+    state[_SYNCED_KEY] = len(messages)
+    return written
+
+
+def mark_transcript_synced(state):
+    """Record that ``state["messages"]`` is already in the log, e.g. after
+    restoring a consultation that another replica logged."""
+    state[_SYNCED_KEY] = len(state.get("messages", []))
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def get_transcript_log() -> TranscriptLog:
+    global _log
+    if _log is None:
+        with _log_lock:
+            if _log is None:
+                _log = TranscriptLog()
+    return _log
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Read and maintain consultation transcripts")
+    parser.add_argument("--dir", default=TRANSCRIPT_DIR, help="transcript directory")
+    sub = parser.add_subparsers(dest="command", required=True)
+    tail = sub.add_parser("tail", help="print the last turns of a consultation")
+    tail.add_argument("session_id")
+    tail.add_argument("-n", type=int, default=10)
+    show = sub.add_parser("show", help="print a whole consultation")
+    show.add_argument("session_id")
+    sub.add_parser("compact", help="delete expired transcripts and unused prompts")
+    args = parser.parse_args(argv)
+
+    log = TranscriptLog(args.dir)
+    if args.command == "compact":
+        removed = log.compact()
+        print(f"Removed {removed} expired transcripts from {args.dir}.")
+        return
+    if args.command == "tail":
+        messages = log.tail(args.session_id, args.n)
+    else:
+        messages = log.read(args.session_id)
+    for m in messages:
+        print(f"[{m['role']}] {m['content']}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""Background jobs for the triage summary, detailed report and PDF.
+
+show_triage used to make the LLM calls and build the ReportLab document in
+the Streamlit script thread, freezing that session and (through the GIL)
+slowing every other one. It now submits jobs here and polls their status.
+LLM work runs on a thread pool; the PDF is built on a process pool.
+
+Job state lives in SQLite, so a rerun, a reload or a second tab sees the
+same job and its results. A job's id is a hash of its kind and inputs: a
+duplicate submission for the same session and inputs attaches to the
+existing job instead of starting another, unless that job failed. Report
+fields are written to the job as they complete, so the page can show
+sections before the report is finished.
+
+Jobs run in the process that accepted them. Each job records its owner
+(host and pid), and the owner renews a heartbeat while the job runs. A job
+whose heartbeat is older than TRIAGE_JOB_LEASE_SECONDS, or whose owner
+process on this host is gone, is marked failed and is retried by the next
+submission. Replicas sharing the job database therefore never fail each
+other's live jobs.
+"""
+import contextvars
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import current_session_id, observe_pdf_size, span
+from pdf_cache import get_pdf_cache, pdf_cache_key
+from request_scheduler import queue_listener
+from triage_module import (
+    PDF_TEMPLATE_VERSION,
+    build_summary_prompt,
+    build_triage_pdf,
+    generate_detailed_report,
+    generate_reply,
+)
+from triage_schema import report_sections
+
+logger = logging.getLogger(__name__)
+
+JOB_DB_PATH = os.getenv("TRIAGE_JOB_DB", "triage_jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("TRIAGE_JOB_WORKERS", "8"))
+JOB_PDF_WORKERS = int(os.getenv("TRIAGE_JOB_PDF_WORKERS", "2"))
+JOB_TTL_SECONDS = int(os.getenv("TRIAGE_JOB_TTL_SECONDS", str(24 * 3600)))
+JOB_LEASE_SECONDS = float(os.getenv("TRIAGE_JOB_LEASE_SECONDS", "60"))
+
+QUEUED, RUNNING, BUILDING_PDF, DONE, FAILED = "queued", "running", "building_pdf", "done", "failed"
+FINISHED = (DONE, FAILED)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def job_id_for(kind: str, session_id: str, inputs: dict) -> str:
+    payload = json.dumps([kind, session_id, inputs], sort_keys=True, ensure_ascii=False, default=str)
+    return f"{kind}-{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:24]}"
+
+
+class JobQueue:
+    def __init__(self, path=JOB_DB_PATH, workers=JOB_WORKERS, pdf_workers=JOB_PDF_WORKERS,
+                 ttl_seconds=JOB_TTL_SECONDS, lease_seconds=JOB_LEASE_SECONDS):
+        self.path = path
+        self.pdf_workers = pdf_workers
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+        self.host = socket.gethostname()
+        self.owner = f"{self.host}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                detail TEXT,
+                inputs TEXT NOT NULL,
+                result TEXT,
+                pdf BLOB,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_session ON jobs(session_id, created_at);
+            CREATE INDEX IF NOT EXISTS jobs_updated ON jobs(updated_at);
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+        with self._lock:
+            self._reap()
+            self._conn.execute(
+                "DELETE FROM jobs WHERE updated_at < ?", (time.time() - self.ttl_seconds,)
+            )
+        self._threads = ThreadPoolExecutor(workers, thread_name_prefix="triage-job")
+        self._processes = None
+        self.submitted = 0
+        self.attached = 0
+        threading.Thread(target=self._heartbeat, name="triage-job-heartbeat", daemon=True).start()
+
+    # ---------------- leases ----------------
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease_seconds / 4)
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status NOT IN (?, ?)",
+                    (time.time(), self.owner, DONE, FAILED),
+                )
+
+    def _is_dead(self, owner, heartbeat_at) -> bool:
+        """True if the process running an unfinished job is gone."""
+        if owner is None or heartbeat_at is None or heartbeat_at < time.time() - self.lease_seconds:
+            return True
+        host, _, pid = owner.rpartition(":")
+        # Another process on this host, e.g. the previous run of this replica
+        return host == self.host and owner != self.owner and not _pid_alive(int(pid))
+
+    def _reap(self, job_id=None):
+        """Fail unfinished jobs (all, or just ``job_id``) whose worker is gone;
+        called with the lock held."""
+        query = "SELECT job_id, owner, heartbeat_at FROM jobs WHERE status NOT IN (?, ?)"
+        params = (DONE, FAILED)
+        if job_id is not None:
+            query += " AND job_id = ?"
+            params += (job_id,)
+        now = time.time()
+        self._conn.executemany(
+            "UPDATE jobs SET status = ?, detail = NULL, error = ?, updated_at = ? WHERE job_id = ?",
+            [
+                (FAILED, "the worker running this job stopped", now, row[0])
+                for row in self._conn.execute(query, params).fetchall()
+                if self._is_dead(row[1], row[2])
+            ],
+        )
+
+    # ---------------- persistence ----------------
+    def _update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id)
+            )
+
+    def get(self, job_id):
+        """Job status dict, or None if there is no such job."""
+        with self._lock:
+            self._reap(job_id)
+            row = self._conn.execute(
+                "SELECT job_id, kind, session_id, status, detail, inputs, result, pdf, error,"
+                " created_at, updated_at FROM jobs WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(
+            ("job_id", "kind", "session_id", "status", "detail", "inputs", "result", "pdf",
+             "error", "created_at", "updated_at"),
+            row,
+        ))
+        for name in ("detail", "inputs", "result"):
+            job[name] = json.loads(job[name]) if job[name] else None
+        return job
+
+    # ---------------- submission ----------------
+    def _submit(self, kind, session_id, inputs, run):
+        job_id = job_id_for(kind, session_id, inputs)
+        now = time.time()
+        with self._lock:
+            self._reap(job_id)
+            row = self._conn.execute(
+                "SELECT status FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if row is not None and row[0] != FAILED:
+                self.attached += 1
+                return job_id
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, kind, session_id, status, inputs,"
+                " created_at, updated_at, owner, heartbeat_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, session_id, QUEUED, json.dumps(inputs, default=str), now, now,
+                 self.owner, now),
+            )
+            self.submitted += 1
+        self._threads.submit(contextvars.copy_context().run, self._run, job_id, session_id, run, inputs)
+        return job_id
+
+    def submit_summary(self, session_id, model_choice, last_assistant_reply) -> str:
+        inputs = {"model_choice": model_choice, "last_assistant_reply": last_assistant_reply}
+        return self._submit("summary", session_id, inputs, self._run_summary)
+
+    def submit_report(self, session_id, model_choice, patient_info, last_assistant_reply) -> str:
+        """Detailed report plus its PDF; ``patient_info`` is what the PDF header shows."""
+        inputs = {
+            "model_choice": model_choice,
+            "patient_info": patient_info,
+            "last_assistant_reply": last_assistant_reply,
+        }
+        return self._submit("report", session_id, inputs, self._run_report)
+
+    # ---------------- workers ----------------
+    def _run(self, job_id, session_id, run, inputs):
+        current_session_id.set(session_id)
+        # Surface the rate-limit queue position to the polling page
+        queue_listener.set(lambda status: self._update(job_id, detail=json.dumps(status)))
+        self._update(job_id, status=RUNNING)
+        try:
+            run(job_id, inputs)
+        except Exception as e:
+            logger.exception("triage job %s failed", job_id)
+            self._update(job_id, status=FAILED, detail=None, error=str(e))
+
+    def _run_summary(self, job_id, inputs):
+        prompt = build_summary_prompt(inputs["last_assistant_reply"])
+        summary = generate_reply(inputs["model_choice"], [{"role": "user", "content": prompt}])
+        self._update(job_id, status=DONE, detail=None, result=json.dumps({"summary": summary}))
+
+    def _run_report(self, job_id, inputs):
+        patient_info = inputs["patient_info"]
+        partial = {}
+
+        def _on_field(name, value):
+            partial[name] = value
+            self._update(job_id, result=json.dumps({"report": partial, "missing": []}))
+
+        report, missing = generate_detailed_report(
+            inputs["model_choice"], patient_info["name"], patient_info["age"], patient_info["sex"],
+            inputs["last_assistant_reply"], on_field=_on_field,
+        )
+        result = json.dumps({"report": report, "missing": missing})
+        sections = report_sections(report)
+        if not sections:
+            self._update(job_id, status=FAILED, detail=None, result=result,
+                         error="The AI model returned no usable report sections.")
+            return
+        self._update(job_id, status=BUILDING_PDF, detail=None, result=result)
+
+        key = pdf_cache_key(sections, patient_info, PDF_TEMPLATE_VERSION)
+        pdf_bytes = get_pdf_cache().get(key)
+        if pdf_bytes is None:
+            pool = self._pdf_pool()
+            try:
+                with span("pdf_build"):
+                    pdf_bytes = pool.submit(build_triage_pdf, sections, patient_info).result()
+            except BrokenProcessPool:
+                # A worker died; start a fresh pool for the next job
+                with self._lock:
+                    if self._processes is pool:
+                        self._processes = None
+                raise
+            observe_pdf_size(len(pdf_bytes))
+            get_pdf_cache().put(key, pdf_bytes)
+        self._update(job_id, status=DONE, pdf=pdf_bytes)
+
+    def _pdf_pool(self):
+        with self._lock:
+            if self._processes is None:
+                # spawn, not fork: the server process is full of threads
+                self._processes = ProcessPoolExecutor(
+                    self.pdf_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._processes
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._conn.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall())
+        return {"submitted": self.submitted, "attached": self.attached, **counts}
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue()
+    return _queue
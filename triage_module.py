@@ -1,23 +1,600 @@
 import html
+import os
+
+from chat_engine import GEMINI_MODEL, GROQ_MODEL, GROQ_TEMPERATURE, gemini_api_key, groq_api_key
+from consultation_state import get_consultation_store, sync_consultation
+from gemini_context import record_gemini_usage, to_gemini_contents
+from metrics import current_session_id, instrument_stream, instrument_stream_async, span
+from patient_registry import get_patient_registry
+from provider_clients import (
+    get_async_groq_client,
+    get_gemini_model,
+    get_groq_client,
+    load_env_once,
+)
+from provider_router import get_tracker, track_stream, track_stream_async
+from request_scheduler import format_queue_status, get_scheduler
+from response_cache import get_response_cache
+from session_store import get_session_store
+from triage_schema import (
+    FIELD_NAMES,
+    REPORT_SCHEMA,
+    ReportStreamParser,
+    build_repair_prompt,
+    build_report_prompt,
+    coerce_field,
+    parse_report_json,
+    ready_sections,
+    report_from_sections,
+    report_schema,
+    report_sections,
+    validate_report,
+)
+
+# Bump whenever build_triage_pdf's layout changes so cached PDFs are not reused
+PDF_TEMPLATE_VERSION = "1"
+# Follow-up requests for fields still missing from the JSON report
+REPORT_REPAIR_ATTEMPTS = int(os.getenv("REPORT_REPAIR_ATTEMPTS", "2"))
+# How often show_triage polls its background jobs for new sections
+TRIAGE_POLL_S = float(os.getenv("TRIAGE_POLL_S", "0.5"))
+
+
+def parse_sections(detailed_result):
+    """Split the detailed report into {section title: [lines]}."""
+    lines = detailed_result.split("\n")
+    sections = {}
+    current_section = None
+    current_content = []
+
+    for line in lines:
+        line = line.strip()
+
+        # Skip empty lines
+        if not line:
+            continue
+
+        # Remove markdown formatting
+        line = line.replace('**', '').replace('*', '').replace('#', '')
+
+        # Check if this is a section header (contains colon, not starting with dash)
+        if ":" in line and not line.startswith("-") and not line.startswith("•"):
+            # Save previous section if exists
+            if current_section and current_content:
+                sections[current_section] = current_content
+
+            # Start new section
+            current_section = line.replace(":", "").strip()
+            current_content = []
+        else:
+            # Add content to current section
+            if current_section:
+                current_content.append(line)
+
+    # Add the last section
+    if current_section and current_content:
+        sections[current_section] = current_content
+
+    return sections
+
+
+class TriagePDFBuilder:
+    """Builds the triage PDF; sections can be added while the report is
+    still streaming, so only the final layout pass is left at the end.
+
+    patient_info carries name, age, sex, report_id and report_date.
+    """
+
+    def __init__(self, patient_info):
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib import colors
+
+        self.patient_info = patient_info
+        self._sections = {}   # (title, lines) -> flowables
+        styles = getSampleStyleSheet()
+
+        # ---------------- CUSTOM STYLES ----------------
+        self.title_style = ParagraphStyle(
+             name='CustomTitle',
+             parent=styles['Heading1'],
+             fontSize=24,
+             textColor=colors.HexColor("#0B2E59"),
+             spaceAfter=20,
+             alignment=1,  # Center alignment
+            fontName='Helvetica-Bold'
+        )
+
+        self.section_header_style = ParagraphStyle(
+             name='SectionHeader',
+             fontSize=12,
+             textColor=colors.white,
+             fontName='Helvetica-Bold',
+             leftIndent=10,
+            spaceAfter=0,
+             spaceBefore=0
+        )
+
+        self.content_style = ParagraphStyle(
+            name='ContentText',
+            parent=styles['Normal'],
+            fontSize=13,
+            textColor=colors.black,
+            leftIndent=0,
+             spaceAfter=6,
+             leading=18
+        )
+
+        self.bullet_style = ParagraphStyle(
+            name='BulletText',
+            parent=self.content_style,
+            leftIndent=20,
+            bulletIndent=10,
+            spaceAfter=4
+        )
+
+    def add_section(self, section_title, content_lines):
+        """Lay out one section's flowables ahead of build()."""
+        key = (section_title, tuple(content_lines))
+        if key not in self._sections:
+            self._sections[key] = self._section_flowables(section_title, content_lines)
+
+    def _section_flowables(self, section_title, content_lines):
+        from reportlab.platypus import Paragraph, Spacer, Table, TableStyle
+        from reportlab.lib.units import inch
+        from reportlab.lib import colors
+
+        elements = []
+        # Section Header Bar with blue background
+        header_table = Table([
+            [Paragraph(section_title, self.section_header_style)]
+        ], colWidths=[6.5*inch])
+        header_table.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor("#4A7BA7")),
+            ('LEFTPADDING', (0, 0), (-1, -1), 10),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 10),
+            ('TOPPADDING', (0, 0), (-1, -1), 8),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+        ]))
+        elements.append(header_table)
+
+        # White Content Box
+        content_paragraphs = []
+        for item in content_lines:
+            if item.strip().startswith('-'):
+                # Convert dash to bullet point
+                text = item.strip()[1:].strip()
+                content_paragraphs.append(Paragraph(f"• {text}", self.bullet_style))
+            else:
+                # Regular paragraph
+                content_paragraphs.append(Paragraph(item, self.content_style))
+
+        content_table = Table(
+            [[content_paragraphs]],
+            colWidths=[6.5*inch]
+        )
+        content_table.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, -1), colors.white),
+            ('BOX', (0, 0), (-1, -1), 1, colors.HexColor("#C0C0C0")),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('LEFTPADDING', (0, 0), (-1, -1), 15),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 15),
+            ('TOPPADDING', (0, 0), (-1, -1), 12),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+        ]))
+        elements.append(content_table)
+        elements.append(Spacer(1, 0.25 * inch))
+        return elements
+
+    def build(self, sections):
+        """Render ``sections`` (in their order) to PDF bytes, in memory,
+        reusing flowables laid out by add_section()."""
+        from io import BytesIO
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+        from reportlab.lib.units import inch
+        from reportlab.lib import colors
+        from reportlab.lib.pagesizes import A4
+
+        patient_info = self.patient_info
+        content_style = self.content_style
+        buffer = BytesIO()
+        doc = SimpleDocTemplate(buffer, pagesize=A4,
+                           topMargin=0.75*inch,
+                           bottomMargin=0.75*inch,
+                           leftMargin=0.75*inch,
+                           rightMargin=0.75*inch)
+        elements = []
+
+        # --------------- TITLE ----------------
+        elements.append(Paragraph("Clinical Triage Report", self.title_style))
+        elements.append(Spacer(1, 0.3 * inch))
+
+        # ---------------- PATIENT INFO BOX ----------------
+        patient_data = [
+             [Paragraph("<b>Patient Name:</b>", content_style), Paragraph(str(patient_info["name"]), content_style)],
+             [Paragraph("<b>Age / Sex:</b>", content_style), Paragraph(f"{patient_info['age']} / {patient_info['sex']}", content_style)],
+             [Paragraph("<b>Report ID:</b>", content_style), Paragraph(str(patient_info["report_id"]), content_style)],
+             [Paragraph("<b>Date of Report:</b>", content_style), Paragraph(patient_info["report_date"], content_style)],
+        ]
+
+        patient_table = Table(patient_data, colWidths=[2*inch, 4*inch])
+        patient_table.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor("#E8EFF5")),
+            ('BOX', (0, 0), (-1, -1), 1.5, colors.HexColor("#4A7BA7")),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('LEFTPADDING', (0, 0), (-1, -1), 18),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 18),
+            ('TOPPADDING', (0, 0), (-1, -1), 14),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 14),
+        ]))
+
+        elements.append(patient_table)
+        elements.append(Spacer(1, 0.4 * inch))
+
+        # ---------------- RENDER SECTIONS PROPERLY ----------------
+        for section_title, content_lines in sections.items():
+            self.add_section(section_title, content_lines)
+            elements.extend(self._sections[(section_title, tuple(content_lines))])
+
+        doc.build(elements)
+        return buffer.getvalue()
+
+
+def build_triage_pdf(sections, patient_info):
+    """Render the triage report to PDF bytes, entirely in memory.
+
+    patient_info carries name, age, sex, report_id and report_date.
+    """
+    return TriagePDFBuilder(patient_info).build(sections)
+
+
+def patient_info_for(session_id: str, payload: dict) -> dict:
+    """PDF header fields for a stored triage payload; the registry wins over
+    the names saved with the session."""
+    from datetime import datetime
+
+    patient = get_patient_registry().get_by_id(payload.get("patient_id"))
+    if patient is not None:
+        name, age, sex = patient["patient_name"], patient["age"], patient["sex"]
+    else:
+        name = payload.get("patient_name", "Unknown")
+        age = payload.get("patient_age", "-")
+        sex = payload.get("patient_sex", "-")
+    return {
+        "name": str(name),
+        "age": age,
+        "sex": sex,
+        "report_id": session_id,
+        "report_date": datetime.now().strftime("%d %B %Y"),
+    }
+
+
+def report_filename(info: dict) -> str:
+    import re
+
+    clean_name = re.sub(r'[^A-Za-z0-9]', '', info["name"]) or "Patient"
+    return f"{clean_name}_TriageReport_{info['report_id']}.pdf"
+
+
+# ---------------- MODEL HELPER ----------------
+def _resolve_model(model_choice):
+    """(model_choice, provider, model name, temperature); "Auto" picks the
+    provider that is currently faster."""
+    if model_choice.startswith("Auto"):
+        model_choice = "Gemini" if get_tracker().fastest() == "gemini" else "Groq (Llama)"
+    if model_choice.startswith("Gemini"):
+        return model_choice, "gemini", GEMINI_MODEL, None
+    return model_choice, "groq", GROQ_MODEL, GROQ_TEMPERATURE
+
+
+def _json_mode(model_choice, json_schema):
+    """Provider kwargs for JSON output mode."""
+    if json_schema is None:
+        return {}
+    if model_choice.startswith("Gemini"):
+        return {"generation_config": {
+            "response_mime_type": "application/json",
+            "response_schema": json_schema,
+        }}
+    return {"response_format": {"type": "json_object"}}
+
+
+def _call_provider(model_choice, messages, json_schema=None):
+    if model_choice.startswith("Gemini"):
+        system_instruction, contents = to_gemini_contents(messages)
+        model = get_gemini_model(gemini_api_key(), GEMINI_MODEL, system_instruction)
+        resp = model.generate_content(contents, **_json_mode(model_choice, json_schema))
+        record_gemini_usage(resp)
+        return resp.text
+    else:
+        client = get_groq_client(groq_api_key())
+        resp = client.chat.completions.create(
+            model=GROQ_MODEL,
+            messages=messages,
+            temperature=GROQ_TEMPERATURE,
+            **_json_mode(model_choice, json_schema),
+        )
+        return resp.choices[0].message.content
+
+
+def _stream_provider(model_choice, messages, json_schema=None):
+    if model_choice.startswith("Gemini"):
+        system_instruction, contents = to_gemini_contents(messages)
+        model = get_gemini_model(gemini_api_key(), GEMINI_MODEL, system_instruction)
+        last = None
+        for chunk in model.generate_content(
+            contents, stream=True, **_json_mode(model_choice, json_schema)
+        ):
+            last = chunk
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunk carried no text part (e.g. a safety block)
+                continue
+            if text:
+                yield text
+        record_gemini_usage(last)
+    else:
+        client = get_groq_client(groq_api_key())
+        resp = client.chat.completions.create(
+            model=GROQ_MODEL,
+            messages=messages,
+            temperature=GROQ_TEMPERATURE,
+            stream=True,
+            **_json_mode(model_choice, json_schema),
+        )
+        for chunk in resp:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+def _timed_call(provider, model_name, model_choice, messages, json_schema=None):
+    with span("llm_call", provider=provider, llm=True):
+        return get_scheduler().call(
+            model_name, messages, lambda: _call_provider(model_choice, messages, json_schema)
+        )
+
+
+def generate_reply(model_choice, messages, json_schema=None):
+    """``json_schema`` switches the provider to JSON output mode."""
+    # Reruns (download clicks, widget changes) hit the shared response cache
+    model_choice, provider, model_name, temperature = _resolve_model(model_choice)
+    return get_response_cache().get_or_generate(
+        provider, model_name, temperature, messages,
+        lambda: _timed_call(provider, model_name, model_choice, messages, json_schema),
+    )
+
+
+def stream_reply(model_choice, messages, json_schema=None):
+    """Streaming counterpart of generate_reply, sharing its cache entries."""
+    model_choice, provider, model_name, temperature = _resolve_model(model_choice)
+    yield from get_response_cache().stream_through(
+        provider, model_name, temperature, messages,
+        lambda: track_stream(provider, instrument_stream(
+            get_scheduler().stream(
+                model_name, messages, lambda: _stream_provider(model_choice, messages, json_schema)
+            ),
+            "llm_call", provider=provider,
+        )),
+    )
+
+
+def generate_detailed_report(model_choice, patient_name, patient_age, patient_sex,
+                             last_assistant_reply, on_field=None):
+    """Stream the detailed report in JSON mode, then re-request only the
+    fields that are missing or invalid. Returns (report, missing).
+
+    ``on_field(name, value)`` is called as each valid field completes,
+    including fields filled in by the follow-up requests.
+    """
+    patient = (patient_name, patient_age, patient_sex)
+    prompt = build_report_prompt(*patient, last_assistant_reply)
+    assembler = _ReportAssembler(on_field)
+    for chunk in stream_reply(model_choice, [{"role": "user", "content": prompt}], REPORT_SCHEMA):
+        assembler.feed(chunk)
+    missing = assembler.finish()
+
+    for _ in range(REPORT_REPAIR_ATTEMPTS):
+        if not missing:
+            break
+        prompt = build_repair_prompt(missing, assembler.report, *patient, last_assistant_reply)
+        raw = generate_reply(
+            model_choice, [{"role": "user", "content": prompt}], report_schema(missing)
+        )
+        missing = assembler.repair(raw, missing)
+
+    return assembler.report, missing
+
+
+class _ReportAssembler:
+    """Collects report fields from the streamed reply, the final parse and
+    the repair replies; shared by the sync and async report generators."""
+
+    def __init__(self, on_field=None):
+        self.report = {}
+        self.on_field = on_field
+        self._parser = ReportStreamParser()
+        self._parts = []
+
+    def _accept(self, name, value):
+        if name in self.report or value is None:
+            return
+        self.report[name] = value
+        if self.on_field is not None:
+            self.on_field(name, value)
+
+    def feed(self, chunk):
+        self._parts.append(chunk)
+        for name, value in self._parser.feed(chunk):
+            self._accept(name, coerce_field(name, value))
+
+    def finish(self):
+        """Parse the whole reply; returns the fields still missing."""
+        raw = "".join(self._parts)
+        with span("section_parse") as fields:
+            data = parse_report_json(raw)
+            if not data:
+                # The model ignored JSON mode; salvage its free-text sections
+                data = report_from_sections(parse_sections(raw))
+            full, _ = validate_report(data)
+            for name, value in full.items():
+                self._accept(name, value)
+            missing = [name for name in FIELD_NAMES if name not in self.report]
+            fields["missing"] = len(missing)
+        return missing
+
+    def repair(self, raw, missing):
+        with span("report_repair") as fields:
+            patch, _ = validate_report(parse_report_json(raw))
+            for name in missing:
+                self._accept(name, patch.get(name))
+            missing = [name for name in missing if name not in self.report]
+            fields["missing"] = len(missing)
+        return missing
+
+
+# ---------------- ASYNC (HTTP API) ----------------
+async def _call_provider_async(model_choice, messages, json_schema=None):
+    if model_choice.startswith("Gemini"):
+        system_instruction, contents = to_gemini_contents(messages)
+        model = get_gemini_model(gemini_api_key(), GEMINI_MODEL, system_instruction)
+        resp = await model.generate_content_async(contents, **_json_mode(model_choice, json_schema))
+        record_gemini_usage(resp)
+        return resp.text
+    client = get_async_groq_client(groq_api_key())
+    resp = await client.chat.completions.create(
+        model=GROQ_MODEL,
+        messages=messages,
+        temperature=GROQ_TEMPERATURE,
+        **_json_mode(model_choice, json_schema),
+    )
+    return resp.choices[0].message.content
+
+
+async def _stream_provider_async(model_choice, messages, json_schema=None):
+    if model_choice.startswith("Gemini"):
+        system_instruction, contents = to_gemini_contents(messages)
+        model = get_gemini_model(gemini_api_key(), GEMINI_MODEL, system_instruction)
+        last = None
+        async for chunk in await model.generate_content_async(
+            contents, stream=True, **_json_mode(model_choice, json_schema)
+        ):
+            last = chunk
+            try:
+                text = chunk.text
+            except ValueError:
+                continue
+            if text:
+                yield text
+        record_gemini_usage(last)
+    else:
+        client = get_async_groq_client(groq_api_key())
+        resp = await client.chat.completions.create(
+            model=GROQ_MODEL,
+            messages=messages,
+            temperature=GROQ_TEMPERATURE,
+            stream=True,
+            **_json_mode(model_choice, json_schema),
+        )
+        async for chunk in resp:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+async def generate_reply_async(model_choice, messages, json_schema=None):
+    model_choice, provider, model_name, temperature = _resolve_model(model_choice)
+
+    async def _timed():
+        with span("llm_call", provider=provider, llm=True):
+            return await get_scheduler().call_async(
+                model_name, messages, lambda: _call_provider_async(model_choice, messages, json_schema)
+            )
+
+    return await get_response_cache().get_or_generate_async(
+        provider, model_name, temperature, messages, _timed
+    )
+
+
+async def stream_reply_async(model_choice, messages, json_schema=None):
+    model_choice, provider, model_name, temperature = _resolve_model(model_choice)
+    async for chunk in get_response_cache().stream_through_async(
+        provider, model_name, temperature, messages,
+        lambda: track_stream_async(provider, instrument_stream_async(
+            get_scheduler().stream_async(
+                model_name, messages,
+                lambda: _stream_provider_async(model_choice, messages, json_schema),
+            ),
+            "llm_call", provider=provider,
+        )),
+    ):
+        yield chunk
+
+
+async def generate_summary_async(model_choice, last_assistant_reply):
+    prompt = build_summary_prompt(last_assistant_reply)
+    return await generate_reply_async(model_choice, [{"role": "user", "content": prompt}])
+
+
+async def generate_detailed_report_async(model_choice, patient_name, patient_age, patient_sex,
+                                         last_assistant_reply, on_field=None):
+    """Async counterpart of generate_detailed_report."""
+    patient = (patient_name, patient_age, patient_sex)
+    prompt = build_report_prompt(*patient, last_assistant_reply)
+    assembler = _ReportAssembler(on_field)
+    async for chunk in stream_reply_async(
+        model_choice, [{"role": "user", "content": prompt}], REPORT_SCHEMA
+    ):
+        assembler.feed(chunk)
+    missing = assembler.finish()
+
+    for _ in range(REPORT_REPAIR_ATTEMPTS):
+        if not missing:
+            break
+        prompt = build_repair_prompt(missing, assembler.report, *patient, last_assistant_reply)
+        raw = await generate_reply_async(
+            model_choice, [{"role": "user", "content": prompt}], report_schema(missing)
+        )
+        missing = assembler.repair(raw, missing)
+
+    return assembler.report, missing
+
+
+def _section_card_html(title, lines):
+    items = []
+    for line in lines:
+        if line.startswith("- "):
+            items.append(f"• {html.escape(line[2:])}")
+        else:
+            items.append(html.escape(line))
+    return (
+        f'<div class="triage-box triage-section"><div class="triage-section-title">'
+        f'{html.escape(title)}</div>{"<br>".join(items)}</div>'
+    )
+
+
+# ---------------- PROMPTS ----------------
+def build_summary_prompt(last_assistant_reply):
+    return f"""
+    Provide a concise but clinically useful triage summary (5–6 bullet points).
+
+    Guidelines:
+    - Do NOT diagnose.
+    - Clearly summarize the main symptoms.
+    - Indicate overall concern level in simple language (mild/moderate concern).
+    - Include practical, immediate self-care suggestions if appropriate.
+    - Include when the patient should consider seeing a doctor.
+    - Maintain a calm, reassuring tone.
+    - Avoid overly generic advice.
+
+    Patient:
+    {last_assistant_reply}
+    """
 
 
 def show_triage():
     from datetime import datetime
-    import os
-    import json
     import re
-    import pandas as pd
     import streamlit as st
-    from dotenv import load_dotenv
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.units import inch
-    from reportlab.lib import colors
-    from reportlab.lib.pagesizes import A4
-    import google.generativeai as genai
-    from groq import Groq
 
-    load_dotenv(".env")
+    load_env_once(".env")
 
     # t.set_page_config(
     #     page_title="Clinical Triage Report",
@@ -126,6 +703,16 @@ def show_triage():
             font-size: 17px;
         }
 
+        .triage-section {
+            margin-bottom: 16px;
+        }
+
+        .triage-section-title {
+            color: #032B63;
+            font-weight: 800;
+            margin-bottom: 6px;
+        }
+
         </style>
         """, unsafe_allow_html=True
     )
@@ -172,342 +759,116 @@ medical evaluation only when necessary.
         st.error("❌ Missing triage session ID.")
         st.stop()
 
+    current_session_id.set(session_id)
+
     # ---------------- LOAD TRIAGE DATA ----------------
-    TRIAGE_DIR = "triage_sessions"
-    file_path = os.path.join(TRIAGE_DIR, f"{session_id}.json")
+    triage_data = get_session_store().load(session_id)
 
-    if not os.path.exists(file_path):
+    if triage_data is None:
         st.error("❌ Triage session not found.")
         st.stop()
 
-    with open(file_path, "r") as f:
-        triage_data = json.load(f)
-
-    messages = triage_data["messages"]
     last_assistant_reply = triage_data["last_assistant_reply"]
     model_choice = triage_data["model_choice"]
 
     # ---------------- LOAD PATIENT INFO ----------------
     patient_id = triage_data.get("patient_id")
-    patients_df = pd.read_csv("patients.csv")
-    patient_row = patients_df[patients_df["patient_id"] == patient_id]
+    with span("patient_lookup"):
+        patient = get_patient_registry().get_by_id(patient_id)
 
-    if not patient_row.empty:
-        patient_name = patient_row.iloc[0]["patient_name"]
-        patient_age = patient_row.iloc[0]["age"]
-        patient_sex = patient_row.iloc[0]["sex"]
+    if patient is not None:
+        patient_name = patient["patient_name"]
+        patient_age = patient["age"]
+        patient_sex = patient["sex"]
     else:
         patient_name = "Unknown"
         patient_age = "-"
         patient_sex = "-"
 
-    # ---------------- MODEL HELPER ----------------
-    GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-    GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-
-    def generate_reply(model_choice, messages):
-        if model_choice.startswith("Gemini"):
-            genai.configure(api_key=GEMINI_API_KEY)
-            model = genai.GenerativeModel("gemini-2.5-flash")
-            prompt = "\n\n".join(
-                [f"{m['role'].capitalize()}: {m['content']}" for m in messages]
-            )
-            return model.generate_content(prompt).text
-        else:
-            client = Groq(api_key=GROQ_API_KEY)
-            resp = client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=messages,
-                temperature=0.25,
-            )
-            return resp.choices[0].message.content
-
     # ---------------- SUMMARY BUTTON ----------------
     if not st.session_state.show_summary:
         if st.button("🩺 Generate Triage Summary"):
             st.session_state.show_summary = True
+            sync_consultation(get_consultation_store(), session_id, st.session_state)
             st.rerun()
 
-    # ---------------- GENERATE SUMMARY ----------------
+    # ---------------- SUMMARY + DETAILED REPORT (BACKGROUND JOBS) ----------------
+    # Both run as jobs on the shared worker pools; this script only submits
+    # them (reruns attach to the same jobs) and polls their stored status.
+    from triage_jobs import BUILDING_PDF, DONE, FAILED, FINISHED, get_job_queue
+
+    jobs = get_job_queue()
+    patient_info = {
+        "name": str(patient_name),
+        "age": patient_age,
+        "sex": patient_sex,
+        "report_id": session_id,
+        "report_date": datetime.now().strftime("%d %B %Y"),
+    }
+    report_job_id = jobs.submit_report(session_id, model_choice, patient_info, last_assistant_reply)
+    summary_job_id = None
     if st.session_state.show_summary:
-        summary_prompt = f"""
-        Provide a concise but clinically useful triage summary (5–6 bullet points).
-
-        Guidelines:
-        - Do NOT diagnose.
-        - Clearly summarize the main symptoms.
-        - Indicate overall concern level in simple language (mild/moderate concern).
-        - Include practical, immediate self-care suggestions if appropriate.
-        - Include when the patient should consider seeing a doctor.
-        - Maintain a calm, reassuring tone.
-        - Avoid overly generic advice.
-
-        Patient:
-        {last_assistant_reply}
-        """
-
-        summary_result = generate_reply(
-            model_choice,
-            [{"role": "user", "content": summary_prompt}]
-        )
-
-        st.markdown('<div class="triage-header">🩺 Triage Summary</div>', unsafe_allow_html=True)
-        import html
-        safe_summary = html.escape(summary_result).replace('\n', '<br>')
-        st.markdown(f'<div class="triage-box">{safe_summary}</div>', unsafe_allow_html=True)
-
-
-    # ---------------- DETAILED REPORT ----------------
-    detailed_prompt = f"""
-    You are a medical triage assistant. Create a detailed clinical triage report with the following EXACT structure.
-
-    Use this format for each section:
-
-    Section Name:
-    Content here (use dashes - for bullet points)
-
-    Patient Information:
-    Name: {patient_name}
-    Age: {patient_age}
-    Sex: {patient_sex}
-
-    Based on this conversation:
-    {last_assistant_reply}
-
-    Now provide the following sections:
-
-    Risk Level:
-    [Provide risk assessment - Low, Moderate, or High with brief explanation]
-
-    Key Symptoms:
-    - [List main symptoms with dashes]
-    - [One symptom per line]
-
-    Chief Complaint:
-    [Brief description of main presenting issue]
-
-    History of Present Illness:
-    [Detailed narrative of the patient's condition]
-
-    Home Care Advice:
-    - [Provide specific home care recommendations]
-    - [Use dashes for each point]
-
-    OTC Guidance:
-    - [Over-the-counter medication suggestions if appropriate]
-    - [Include precautions]
-
-     Monitoring Advice:
-    - [What symptoms to monitor]
-    - [When to seek further care]
-
-    Health Checks:
-    - [Recommended medical evaluations or tests if needed]
-
-    Reassurance:
-    - [Calm, supportive message to patient]
-
-    Safety Disclaimer:
-    [Standard medical disclaimer about seeking professional care]
-
-    IMPORTANT: 
-    - Use simple text, NO markdown symbols like ** or #
-    - Use dashes (-) for bullet points
-    - Each section must start with section name followed by colon (:)
-    - Provide actual medical content, not placeholders
-    """
-
-
-    detailed_result = generate_reply(
-        model_choice,
-        [{"role": "user", "content": detailed_prompt}]
-    )
-
-    if not detailed_result or len(detailed_result.strip()) < 50:
-        st.error("⚠️ The AI model returned an empty or very short response. Please try again.")
-        st.write("**What was returned:**")
-        st.code(detailed_result)
-        st.stop()
-
-    # ---------------- GENERATE PDF ----------------
-    pdf_path = f"Triage_Report_{session_id}.pdf"
-    doc = SimpleDocTemplate(pdf_path, pagesize=A4,
-                       topMargin=0.75*inch,
-                       bottomMargin=0.75*inch,
-                       leftMargin=0.75*inch,
-                       rightMargin=0.75*inch)
-    elements = []
-    styles = getSampleStyleSheet()
-
-    # ---------------- CUSTOM STYLES ----------------
-    title_style = ParagraphStyle(
-         name='CustomTitle',
-         parent=styles['Heading1'],
-         fontSize=24,
-         textColor=colors.HexColor("#0B2E59"),
-         spaceAfter=20,
-         alignment=1,  # Center alignment
-        fontName='Helvetica-Bold'
-    )
-
-    section_header_style = ParagraphStyle(
-         name='SectionHeader',
-         fontSize=12,
-         textColor=colors.white,
-         fontName='Helvetica-Bold',
-         leftIndent=10,
-        spaceAfter=0,
-         spaceBefore=0
-    )
-
-    content_style = ParagraphStyle(
-        name='ContentText',
-        parent=styles['Normal'],
-        fontSize=13,
-        textColor=colors.black,
-        leftIndent=0,
-         spaceAfter=6,
-         leading=18
-    )
-
-    bullet_style = ParagraphStyle(
-        name='BulletText',
-        parent=content_style,
-        leftIndent=20,
-        bulletIndent=10,
-        spaceAfter=4
-    )
-
-    # --------------- TITLE ----------------
-    elements.append(Paragraph("Clinical Triage Report", title_style))
-    elements.append(Spacer(1, 0.3 * inch))
-    today_date = datetime.now().strftime("%d %B %Y")
-
-
-    # ---------------- PATIENT INFO BOX ----------------
-    patient_data = [
-         [Paragraph("<b>Patient Name:</b>", content_style), Paragraph(patient_name, content_style)],
-         [Paragraph("<b>Age / Sex:</b>", content_style), Paragraph(f"{patient_age} / {patient_sex}", content_style)],
-         [Paragraph("<b>Report ID:</b>", content_style), Paragraph(session_id, content_style)],
-         [Paragraph("<b>Date of Report:</b>", content_style), Paragraph(today_date, content_style)],
-    ]
-
-    patient_table = Table(patient_data, colWidths=[2*inch, 4*inch])
-    patient_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor("#E8EFF5")),
-        ('BOX', (0, 0), (-1, -1), 1.5, colors.HexColor("#4A7BA7")),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('LEFTPADDING', (0, 0), (-1, -1), 18),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 18),
-        ('TOPPADDING', (0, 0), (-1, -1), 14),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 14),
-    ]))
-
-    elements.append(patient_table)
-    elements.append(Spacer(1, 0.4 * inch))
-
-    # ---------------- FORMAT SECTIONS CLEANLY ----------------
-    lines = detailed_result.split("\n")
-    sections = {}
-    current_section = None
-    current_content = []
-
-    for line in lines:
-        line = line.strip()
-
-        # Skip empty lines
-        if not line:
-            continue
-
-        # Remove markdown formatting
-        line = line.replace('**', '').replace('*', '').replace('#', '')
-
-        # Check if this is a section header (contains colon, not starting with dash)
-        if ":" in line and not line.startswith("-") and not line.startswith("•"):
-            # Save previous section if exists
-            if current_section and current_content:
-                sections[current_section] = current_content
-
-            # Start new section
-            current_section = line.replace(":", "").strip()
-            current_content = []
-        else:
-            # Add content to current section
-            if current_section:
-                current_content.append(line)
-
-    # Add the last section
-    if current_section and current_content:
-        sections[current_section] = current_content
-
-    # Verify we have sections
-    if len(sections) == 0:
-        st.error("⚠️ No sections were found in the AI response. The report cannot be generated.")
-        st.write("**AI Response:**")
-        st.text_area("Response", detailed_result, height=200)
-        st.stop()
-
-    # ---------------- RENDER SECTIONS PROPERLY ----------------
-    for section_title, content_lines in sections.items():
-        # Section Header Bar with blue background
-        header_table = Table([
-            [Paragraph(section_title, section_header_style)]
-        ], colWidths=[6.5*inch])
-        header_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor("#4A7BA7")),
-            ('LEFTPADDING', (0, 0), (-1, -1), 10),
-            ('RIGHTPADDING', (0, 0), (-1, -1), 10),
-            ('TOPPADDING', (0, 0), (-1, -1), 8),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ]))
-        elements.append(header_table)
-
-        # White Content Box
-        content_paragraphs = []
-        for item in content_lines:
-            if item.strip().startswith('-'):
-                # Convert dash to bullet point
-                text = item.strip()[1:].strip()
-                content_paragraphs.append(Paragraph(f"• {text}", bullet_style))
+        summary_job_id = jobs.submit_summary(session_id, model_choice, last_assistant_reply)
+    job_ids = [job_id for job_id in (summary_job_id, report_job_id) if job_id]
+
+    def _waiting(job, text):
+        status = job["detail"]
+        return f"⏳ {format_queue_status(status)}" if status else text
+
+    def _triage_panel(polling):
+        summary_job = jobs.get(summary_job_id) if summary_job_id else None
+        report_job = jobs.get(report_job_id)
+
+        if summary_job is not None:
+            st.markdown('<div class="triage-header">🩺 Triage Summary</div>', unsafe_allow_html=True)
+            if summary_job["status"] == DONE:
+                safe_summary = html.escape(summary_job["result"]["summary"] or "").replace('\n', '<br>')
+                st.markdown(f'<div class="triage-box">{safe_summary}</div>', unsafe_allow_html=True)
+            elif summary_job["status"] == FAILED:
+                st.error(f"❌ Error generating summary: {summary_job['error']}")
             else:
-                # Regular paragraph
-                content_paragraphs.append(Paragraph(item, content_style))
-
-        content_table = Table(
-            [[content_paragraphs]],
-            colWidths=[6.5*inch]
-        )
-        content_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.white),
-            ('BOX', (0, 0), (-1, -1), 1, colors.HexColor("#C0C0C0")),
-            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-            ('LEFTPADDING', (0, 0), (-1, -1), 15),
-            ('RIGHTPADDING', (0, 0), (-1, -1), 15),
-            ('TOPPADDING', (0, 0), (-1, -1), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-        ]))
-        elements.append(content_table)
-        elements.append(Spacer(1, 0.25 * inch))
-
-    # Build the PDF
-    try:
-        doc.build(elements)
-        st.success(f"✅ PDF generated successfully with {len(sections)} sections!")
-    except Exception as e:
-        st.error(f"❌ Error generating PDF: {str(e)}")
-        st.stop()
-
-    # ---------------- DOWNLOAD BUTTON ----------------
-    # Clean patient name (remove spaces)
-    clean_name = re.sub(r'[^A-Za-z0-9]', '', patient_name)
-    today = datetime.now().strftime("%d%b%Y")
+                st.info(_waiting(summary_job, "⏳ Generating triage summary..."))
+
+        # Sections appear as the job stores each completed report field
+        st.markdown('<div class="triage-header">📋 Detailed Triage Report</div>', unsafe_allow_html=True)
+        result = report_job["result"] or {}
+        report = result.get("report") or {}
+        final = report_job["status"] in (BUILDING_PDF, DONE)
+        for title, lines in ready_sections(report, final).items():
+            st.markdown(_section_card_html(title, lines), unsafe_allow_html=True)
+
+        if report_job["status"] == FAILED:
+            st.error(f"❌ Error generating detailed report: {report_job['error']}")
+        elif report_job["status"] == BUILDING_PDF:
+            st.info("⏳ Detailed report ready, building PDF...")
+        elif report_job["status"] == DONE:
+            missing = result.get("missing") or []
+            if missing:
+                st.warning(
+                    "⚠️ Some sections could not be generated: "
+                    + ", ".join(name.replace("_", " ") for name in missing)
+                )
+            st.success(f"✅ PDF generated successfully with {len(report_sections(report))} sections!")
+
+            # ---------------- DOWNLOAD BUTTON ----------------
+            # Clean patient name (remove spaces)
+            clean_name = re.sub(r'[^A-Za-z0-9]', '', str(patient_name))
+            today = datetime.now().strftime("%d%b%Y")
+
+            dynamic_filename = f"{clean_name}_TriageReport_{today}.pdf"
+
+            st.download_button(
+                label="📄 Download the Full Detailed Report",
+                data=report_job["pdf"],
+                file_name=dynamic_filename,
+                mime="application/pdf",
+            )
+        else:
+            st.info(_waiting(report_job, "⏳ Generating detailed triage report..."))
 
-    dynamic_filename = f"{clean_name}_TriageReport_{today}.pdf"
+        if polling and all(jobs.get(job_id)["status"] in FINISHED for job_id in job_ids):
+            # One full rerun redraws the panel without the polling timer
+            st.rerun()
 
-    with open(pdf_path, "rb") as f:
-        st.download_button(
-            label="📄 Download the Full Detailed Report",
-            data=f,
-            file_name=dynamic_filename,
-            mime="application/pdf",
-        )
\ No newline at end of file
+    finished = all(jobs.get(job_id)["status"] in FINISHED for job_id in job_ids)
+    st.fragment(_triage_panel, run_every=None if finished else TRIAGE_POLL_S)(not finished)
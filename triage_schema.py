@@ -0,0 +1,307 @@
+"""Fixed schema for the detailed triage report.
+
+The report is requested in the providers' JSON output mode (Gemini
+``response_schema``, Groq ``response_format=json_object``) and validated
+here, so a stray "Name: John" line can no longer turn into a section. Fields
+that are missing or malformed are listed by ``validate_report`` and can be
+re-requested on their own with ``build_repair_prompt`` instead of
+regenerating the whole report.
+
+``report_sections`` turns a validated report back into the
+{section title: [lines]} shape that build_triage_pdf and the UI use.
+``ReportStreamParser`` picks complete fields out of the report while it is
+still streaming, so sections can be shown before the reply finishes.
+"""
+import json
+import re
+
+RISK_LEVELS = ("Low", "Moderate", "High")
+
+# (field, section title, kind, instruction), in report order
+REPORT_FIELDS = (
+    ("risk_level", "Risk Level", "enum", "Overall risk: Low, Moderate or High"),
+    ("risk_rationale", None, "text", "One or two sentences explaining the risk level"),
+    ("key_symptoms", "Key Symptoms", "list", "Main symptoms, one per item"),
+    ("chief_complaint", "Chief Complaint", "text", "Brief description of the main presenting issue"),
+    ("history_of_present_illness", "History of Present Illness", "text",
+     "Narrative of the patient's condition: onset, duration, severity, course"),
+    ("home_care_advice", "Home Care Advice", "list", "Specific home care recommendations"),
+    ("otc_guidance", "OTC Guidance", "list",
+     "Over-the-counter medication suggestions if appropriate, with precautions"),
+    ("monitoring_advice", "Monitoring Advice", "list",
+     "What to monitor and when to seek further care"),
+    ("health_checks", "Health Checks", "list", "Recommended evaluations or tests, if any"),
+    ("reassurance", "Reassurance", "list", "Calm, supportive messages to the patient"),
+    ("safety_disclaimer", "Safety Disclaimer", "text",
+     "Standard disclaimer about seeking professional care"),
+)
+FIELD_NAMES = tuple(f[0] for f in REPORT_FIELDS)
+_FIELDS = {f[0]: f for f in REPORT_FIELDS}
+_BULLET = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s*")
+
+
+def _field_schema(kind, instruction):
+    if kind == "list":
+        return {"type": "array", "items": {"type": "string"}, "description": instruction}
+    if kind == "enum":
+        return {"type": "string", "enum": list(RISK_LEVELS), "description": instruction}
+    return {"type": "string", "description": instruction}
+
+
+def report_schema(fields=FIELD_NAMES) -> dict:
+    """JSON schema for ``fields``; the subset Gemini's response_schema accepts."""
+    return {
+        "type": "object",
+        "properties": {name: _field_schema(*_FIELDS[name][2:]) for name in fields},
+        "required": list(fields),
+    }
+
+
+REPORT_SCHEMA = report_schema()
+
+
+# ---------------------------
+# Prompts
+# ---------------------------
+def _field_lines(fields):
+    lines = []
+    for name in fields:
+        _, _, kind, instruction = _FIELDS[name]
+        shape = {"list": "array of strings", "enum": '"Low" | "Moderate" | "High"'}.get(kind, "string")
+        lines.append(f'    "{name}": {shape} - {instruction}')
+    return "\n".join(lines)
+
+
+def build_report_prompt(patient_name, patient_age, patient_sex, last_assistant_reply):
+    return f"""
+    You are a medical triage assistant. Create a detailed clinical triage report as a JSON object.
+
+    Patient Information:
+    Name: {patient_name}
+    Age: {patient_age}
+    Sex: {patient_sex}
+
+    Based on this conversation:
+    {last_assistant_reply}
+
+    Return ONLY a JSON object with exactly these keys:
+{_field_lines(FIELD_NAMES)}
+
+    IMPORTANT:
+    - Plain text inside strings, NO markdown symbols like ** or #
+    - List items are separate strings without leading dashes
+    - Provide actual medical content, not placeholders
+    - Do NOT diagnose
+    """
+
+
+def build_repair_prompt(fields, partial_report, patient_name, patient_age, patient_sex,
+                        last_assistant_reply):
+    """Ask only for ``fields``, with the parts already generated as context."""
+    return f"""
+    You are a medical triage assistant completing a clinical triage report (JSON).
+
+    Patient Information:
+    Name: {patient_name}
+    Age: {patient_age}
+    Sex: {patient_sex}
+
+    Based on this conversation:
+    {last_assistant_reply}
+
+    Report so far:
+    {json.dumps(partial_report, ensure_ascii=False)}
+
+    Return ONLY a JSON object with exactly these missing keys:
+{_field_lines(fields)}
+
+    Plain text only, no markdown. Do NOT diagnose.
+    """
+
+
+# ---------------------------
+# Parsing and validation
+# ---------------------------
+def parse_report_json(text: str) -> dict:
+    """Best-effort JSON object from a model reply (tolerates code fences and
+    leading chatter); {} if there is none."""
+    if not text:
+        return {}
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start:
+        return {}
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _clean(text) -> str:
+    return _BULLET.sub("", str(text).replace("**", "").replace("#", "")).strip()
+
+
+def _coerce(kind, value):
+    """Normalized value for a field, or None if it is unusable."""
+    if value is None:
+        return None
+    if kind == "list":
+        items = value if isinstance(value, list) else str(value).split("\n")
+        items = [_clean(item) for item in items if not isinstance(item, (dict, list))]
+        items = [item for item in items if item]
+        return items or None
+    if isinstance(value, list):
+        value = " ".join(str(v) for v in value)
+    if isinstance(value, dict):
+        return None
+    text = _clean(value)
+    if kind == "enum":
+        first = text.split()[0].strip(",.:;-").capitalize() if text else ""
+        return first if first in RISK_LEVELS else None
+    return text or None
+
+
+def coerce_field(name: str, value):
+    """Normalized value for one report field, or None if unusable."""
+    return _coerce(_FIELDS[name][2], value) if name in _FIELDS else None
+
+
+def validate_report(data: dict):
+    """Return (report, missing): the usable fields, and the names still needed."""
+    report, missing = {}, []
+    for name, _, kind, _ in REPORT_FIELDS:
+        value = _coerce(kind, data.get(name))
+        if value is None:
+            missing.append(name)
+        else:
+            report[name] = value
+    return report, missing
+
+
+def report_sections(report: dict) -> dict:
+    """{section title: [lines]} in report order, skipping absent fields."""
+    sections = {}
+    for name, title, kind, _ in REPORT_FIELDS:
+        if title is None or name not in report:
+            continue
+        value = report[name]
+        if name == "risk_level" and report.get("risk_rationale"):
+            sections[title] = [f"{value} - {report['risk_rationale']}"]
+        elif kind == "list":
+            sections[title] = [f"- {item}" for item in value]
+        else:
+            sections[title] = [value]
+    return sections
+
+
+def ready_sections(report: dict, final=False) -> dict:
+    """Like report_sections, but while streaming (``final=False``) holds back
+    the Risk Level section until its rationale has arrived too."""
+    sections = report_sections(report)
+    if not final and "risk_rationale" not in report:
+        sections.pop(_FIELDS["risk_level"][1], None)
+    return sections
+
+
+def report_from_sections(sections: dict) -> dict:
+    """Map free-text sections (parse_sections output) onto report fields, for
+    replies that ignored JSON mode."""
+    by_title = {title.lower(): name for name, title, _, _ in REPORT_FIELDS if title}
+    data = {}
+    for title, lines in sections.items():
+        name = by_title.get(title.strip().lower())
+        if name is None:
+            continue
+        kind = _FIELDS[name][2]
+        data[name] = lines if kind == "list" else " ".join(lines)
+        if name == "risk_level":
+            level, _, rationale = " ".join(lines).partition(" ")
+            data["risk_level"] = level
+            data["risk_rationale"] = rationale.strip(" -–:")
+    return data
+
+
+# ---------------------------
+# Streaming
+# ---------------------------
+class ReportStreamParser:
+    """Incremental parser for a streamed JSON report object.
+
+    ``feed(chunk)`` returns the (field, value) pairs whose values completed
+    in that chunk. A small state machine tracks the top-level object:
+
+        start -> key -> colon -> value -> (key ... | done)
+
+    Strings, escapes and nesting depth are tracked only far enough to find
+    where each top-level value ends; the value itself is then decoded with
+    json.loads. Leading chatter or a code fence before the "{" is skipped.
+    """
+
+    def __init__(self):
+        self.state = "start"
+        self._key = []
+        self._value = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> list:
+        fields = []
+        for ch in chunk:
+            state = self.state
+            if state == "start":
+                if ch == "{":
+                    self.state = "key"
+            elif state == "key":
+                if self._in_string:
+                    if self._escape:
+                        self._escape = False
+                        self._key.append(ch)
+                    elif ch == "\\":
+                        self._escape = True
+                        self._key.append(ch)
+                    elif ch == '"':
+                        self._in_string = False
+                        self.state = "colon"
+                    else:
+                        self._key.append(ch)
+                elif ch == '"':
+                    self._in_string = True
+                    self._key = []
+                elif ch == "}":
+                    self.state = "done"
+            elif state == "colon":
+                if ch == ":":
+                    self.state = "value"
+                    self._value = []
+                    self._depth = 0
+            elif state == "value":
+                if self._in_string:
+                    if self._escape:
+                        self._escape = False
+                    elif ch == "\\":
+                        self._escape = True
+                    elif ch == '"':
+                        self._in_string = False
+                elif ch == '"':
+                    self._in_string = True
+                elif ch in "[{":
+                    self._depth += 1
+                elif ch in "]}" and self._depth:
+                    self._depth -= 1
+                elif self._depth == 0 and ch in ",}":
+                    field = self._finish()
+                    if field is not None:
+                        fields.append(field)
+                    self.state = "key" if ch == "," else "done"
+                    continue
+                self._value.append(ch)
+        return fields
+
+    def _finish(self):
+        try:
+            key = json.loads('"' + "".join(self._key) + '"')
+            value = json.loads("".join(self._value))
+        except ValueError:
+            return None
+        return key, value